@@ -1,67 +1,228 @@
 import asyncio
 import aiohttp
-import json
 import logging
+import random
+import time
+from collections import OrderedDict, deque
 from mautrix.types import Event
 
+import hostex_json
+from hostex_latency import percentiles
+
 logger = logging.getLogger(__name__)
 
+# Transaction IDs remembered after they were handled, to acknowledge redeliveries right away
+COMPLETED_TRANSACTIONS = 1000
+
+# Keeps one connection to the homeserver's appservice websocket. A single ClientSession is
+# reused across reconnects. Every heartbeat_interval the client sends a ping request; the
+# homeserver answers each request, so a ping left unanswered for stale_timeout means the
+# connection is half-open and it is dropped. Reconnects use exponential backoff with full
+# jitter starting at backoff_initial, so a short network blip is over within a second while
+# an outage does not hammer the homeserver. Transactions that were handled but not
+# acknowledged before a disconnect are redelivered by the homeserver; those are acknowledged
+# immediately without running the events again.
 class AppserviceWebsocket:
-    def __init__(self, url, token, callback):
+    def __init__(self, url, token, callback, heartbeat_interval: float = 15, stale_timeout: float = 45,
+                 backoff_initial: float = 0.5, backoff_max: float = 60):
         self.url = url + "/_matrix/client/unstable/fi.mau.as_sync"
         self.headers = {
             "Authorization": f"Bearer {token}",
             "X-Mautrix-Websocket-Version": "3",
         }
         self.callback = callback
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_timeout = stale_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.session = None
+        self.task = None
+        self.stopping = False
+        # Cleared while a transaction is being processed, so stop() can let it finish
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.completed = OrderedDict()
+        self.request_id = 0
+        # request ID -> monotonic send time of outstanding pings
+        self.pending_pings = {}
+        self.connected = False
+        self.connects = 0
+        self.disconnects = 0
+        self.redelivered = 0
+        self.connected_at = None
+        self.last_disconnect_reason = None
+        # Set when we close the connection ourselves, since aiohttp reports that as a normal close
+        self.close_reason = None
+        self.ping_samples = deque(maxlen=200)
 
     async def start(self):
-        asyncio.create_task(self._loop())
+        if self.task and not self.task.done():
+            return
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self, timeout: float = 0):
+        if not self.task:
+            return
+        # Unacknowledged transactions are redelivered by the homeserver, so only the one in progress needs waiting for
+        self.stopping = True
+        if timeout > 0 and not self.idle.is_set():
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Websocket transaction still in progress at shutdown, it will be redelivered")
+        self.task.cancel()
+        self.task = None
+        self.stopping = False
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_initial * 2 ** attempt))
 
     async def _loop(self):
+        attempt = 0
         while True:
             try:
+                if self.session is None or self.session.closed:
+                    self.session = aiohttp.ClientSession(headers=self.headers)
                 logger.info(f"Connecting to {self.url}...")
+                async with self.session.ws_connect(self.url) as ws:
+                    if await self._run(ws):
+                        attempt = 0
+                self._disconnected(f"closed by server ({ws.close_code})")
+            except asyncio.CancelledError:
+                self.idle.set()
+                self._disconnected("stopped")
+                logger.info("Websocket was cancelled.")
+                return
+            except Exception as e:
+                self.idle.set()
+                self._disconnected(str(e) or type(e).__name__)
+                logger.error(f"Websocket error: {e}", exc_info=not isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)))
+            if self.stopping:
+                return
+            delay = self.backoff_delay(attempt)
+            attempt += 1
+            logger.info(f"Reconnecting to the websocket in {delay:.2f} seconds (attempt {attempt})")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                return
 
-                async with aiohttp.ClientSession(headers=self.headers) as sess:
-                    async with sess.ws_connect(self.url) as ws:
-                        logger.info("Websocket connected.")
+    # Returns whether the connection proved healthy, which resets the backoff
+    async def _run(self, ws: aiohttp.ClientWebSocketResponse) -> bool:
+        self.connected = True
+        self.connects += 1
+        self.connected_at = time.time()
+        self.pending_pings = {}
+        healthy = False
+        logger.info("Websocket connected.")
+        heartbeat_task = asyncio.create_task(self._heartbeat(ws)) if self.heartbeat_interval > 0 else None
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    logger.debug(f"Unhandled WS message type: {msg.type}")
+                    continue
+                logger.debug(f"Received websocket message: {msg.data}")
+                data = hostex_json.loads(msg.data)
+                command = data.get("command")
+                if command == "transaction" and data.get("status") == "ok":
+                    if self.stopping:
+                        self.close_reason = "stopping"
+                        break
+                    await self._handle_transaction(ws, data)
+                    healthy = True
+                elif command in ("response", "error"):
+                    self._handle_response(data)
+                    healthy = True
+                elif command == "ping":
+                    await self._send(ws, {"command": "response", "id": data.get("id"), "data": {}})
+                else:
+                    logger.warning("Unhandled WS command: %s", data)
+        finally:
+            if heartbeat_task:
+                heartbeat_task.cancel()
+        return healthy
 
-                        async for msg in ws:
-                            if msg.type == aiohttp.WSMsgType.TEXT:
-                                logger.debug(f"Received websocket message: {msg.data}")
-                                data = msg.json()
-                                if data["status"] == "ok" and data["command"] == "transaction":
-                                    logger.debug(f"Websocket transaction {data['txn_id']}")
-                                    for event in data["events"]:
-                                        try:
-                                            logger.debug(f"Processing event: {event}")
-                                            await self.callback(Event.deserialize(event))
-                                        except Exception as e:
-                                            logger.error(f"Error processing event: {e}", exc_info=True)
+    async def _handle_transaction(self, ws: aiohttp.ClientWebSocketResponse, data: dict):
+        txn_id = data.get("txn_id")
+        if txn_id is not None and txn_id in self.completed:
+            # Handled before the connection dropped; only the acknowledgement was lost
+            self.redelivered += 1
+            logger.debug(f"Acknowledging redelivered websocket transaction {txn_id}")
+            await self._send(ws, {"command": "response", "id": data["id"], "data": {}})
+            return
+        logger.debug(f"Websocket transaction {txn_id}")
+        self.idle.clear()
+        try:
+            for event in data["events"]:
+                try:
+                    logger.debug(f"Processing event: {event}")
+                    await self.callback(Event.deserialize(event))
+                except Exception as e:
+                    logger.error(f"Error processing event: {e}", exc_info=True)
+            if txn_id is not None:
+                self.completed[txn_id] = True
+                if len(self.completed) > COMPLETED_TRANSACTIONS:
+                    self.completed.popitem(last=False)
+            await self._send(ws, {"command": "response", "id": data["id"], "data": {}})
+        finally:
+            # Pings sent before the transaction could not be answered during it; time them from now
+            now = time.monotonic()
+            self.pending_pings = {request_id: now for request_id in self.pending_pings}
+            self.idle.set()
 
-                                    await ws.send_str(
-                                        json.dumps(
-                                            {
-                                                "command": "response",
-                                                "id": data["id"],
-                                                "data": {},
-                                            }
-                                        )
-                                    )
-                                else:
-                                    logger.warn("Unhandled WS command: %s", data)
-                            else:
-                                logger.debug(f"Unhandled WS message type: {msg.type}")
+    def _handle_response(self, data: dict):
+        sent_at = self.pending_pings.pop(data.get("id"), None)
+        if sent_at is not None:
+            self.ping_samples.append(time.monotonic() - sent_at)
+        elif data.get("command") == "error":
+            logger.warning("Websocket request failed: %s", data)
 
-                logger.info("Websocket disconnected.")
-            except asyncio.CancelledError:
-                logger.info("Websocket was cancelled.")
+    async def _heartbeat(self, ws: aiohttp.ClientWebSocketResponse):
+        while not ws.closed:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            if not self.idle.is_set():
+                # Responses are not read while a transaction is being handled
+                continue
+            if self.pending_pings and now - min(self.pending_pings.values()) > self.stale_timeout:
+                logger.warning(f"No ping response from the homeserver for {self.stale_timeout} seconds, reconnecting")
+                self.close_reason = "stale connection"
+                await ws.close()
                 return
+            self.request_id += 1
+            self.pending_pings[self.request_id] = now
+            try:
+                await self._send(ws, {"command": "ping", "id": self.request_id, "data": {"timestamp": int(time.time() * 1000)}})
             except Exception as e:
-                logger.error(f"Websocket error: {e}", exc_info=True)
+                logger.debug(f"Websocket ping failed: {e}")
+                return
 
-                try:
-                    await asyncio.sleep(5)
-                except asyncio.CancelledError:
-                    return
+    @staticmethod
+    async def _send(ws: aiohttp.ClientWebSocketResponse, payload: dict):
+        await ws.send_str(hostex_json.dumps(payload))
+
+    def _disconnected(self, reason: str):
+        if not self.connected:
+            return
+        self.connected = False
+        self.disconnects += 1
+        self.last_disconnect_reason = self.close_reason or reason
+        self.close_reason = None
+        logger.info(f"Websocket disconnected: {self.last_disconnect_reason}")
+
+    def summary(self) -> str:
+        if not self.task:
+            return "Websocket: not running"
+        state = "connected" if self.connected else "reconnecting"
+        parts = [f"Websocket: {state}", f"{self.connects} connects", f"{self.disconnects} disconnects"]
+        if self.redelivered:
+            parts.append(f"{self.redelivered} redelivered")
+        stats = percentiles(self.ping_samples)
+        if stats:
+            parts.append("ping " + ", ".join(f"{name} {value * 1000:.0f}ms" for name, value in stats.items()))
+        if self.last_disconnect_reason:
+            parts.append(f"last disconnect: {self.last_disconnect_reason}")
+        return ", ".join(parts)
@@ -3,11 +3,18 @@ import logging
 from typing import List, Dict, Any
 from datetime import datetime, timezone
 import pytz
+import time
+
+import hostex_json
+from hostex_ratelimit import RateLimiter
 
 logger = logging.getLogger(__name__)
 
 class HostexAPI:
-    def __init__(self, api_url: str, token: str, config):
+    # account_id namespaces conversation IDs ("<account>:<id>") when several Hostex accounts
+    # share one bridge; the default account keeps plain IDs.
+    def __init__(self, api_url: str, token: str, config, account_id: str = None, rate_limit: float = 0,
+                 send_rate_limit: float = 0):
         if not api_url:
             raise ValueError("Hostex API URL is required")
         if not token:
@@ -21,6 +28,22 @@ class HostexAPI:
         self.log = logger
         self.config = config
         self.timezone = config.hostex_timezone
+        self.account_id = account_id
+        self.limiter = RateLimiter(rate_limit)
+        # Hostex throttles the send endpoint separately from reads
+        self.send_limiter = RateLimiter(send_rate_limit)
+        # Shared pooled session, set by the bridge; without one each request opens its own
+        self.session = None
+        # HostexRecorder set by the bridge when hostex.record.path is configured
+        self.recorder = None
+
+    def conversation_key(self, conversation_id: str) -> str:
+        return f"{self.account_id}:{conversation_id}" if self.account_id else conversation_id
+
+    def raw_conversation_id(self, conversation_key: str) -> str:
+        if self.account_id and conversation_key.startswith(f"{self.account_id}:"):
+            return conversation_key[len(self.account_id) + 1:]
+        return conversation_key
 
     async def _make_request(self, method: str, endpoint: str, params: Dict[str, Any] = None, data: Dict[str, Any] = None) -> Any:
         url = f"{self.api_url}/{endpoint}"
@@ -29,35 +52,46 @@ class HostexAPI:
         self.log.debug(f"Params: {params}")
         self.log.debug(f"Data: {data}")
         
+        body = hostex_json.dumps(data) if data is not None else None
+        await self.limiter.acquire()
+        if self.session:
+            return await self._send_request(self.session, method, endpoint, params, data, body)
         async with aiohttp.ClientSession() as session:
-            try:
-                async with session.request(method, url, headers=self.headers, params=params, json=data) as response:
-                    response_text = await response.text()
-                    self.log.debug(f"Response status: {response.status}")
-                    self.log.debug(f"Response text: {response_text}")
-                    response.raise_for_status()
-                    json_response = await response.json()
-                    self.log.debug(f"Received response: {json_response}")
-                    return json_response
-            except aiohttp.ClientResponseError as e:
-                self.log.error(f"HTTP error when making request to Hostex API: {e.status} {e.message}")
-                self.log.error(f"Response body: {await e.response.text()}")
-                return {"error_code": e.status, "error_msg": e.message}
-            except aiohttp.ClientError as e:
-                self.log.error(f"Network error when making request to Hostex API: {e}")
-                return {"error_code": 500, "error_msg": str(e)}
-            except Exception as e:
-                self.log.error(f"Unexpected error when making request to Hostex API: {e}")
-                return {"error_code": 500, "error_msg": str(e)}
+            return await self._send_request(session, method, endpoint, params, data, body)
+
+    async def _send_request(self, session: aiohttp.ClientSession, method: str, endpoint: str, params: Dict[str, Any],
+                            data: Dict[str, Any], body: str) -> Any:
+        url = f"{self.api_url}/{endpoint}"
+        started_at = time.time()
+        try:
+            async with session.request(method, url, headers=self.headers, params=params, data=body) as response:
+                # Read the body once and decode it once, regardless of status
+                response_body = await response.read()
+                self.log.debug(f"Response status: {response.status}")
+                if self.recorder:
+                    self.recorder.record(self.account_id, method, endpoint, params, data, response.status, response_body, started_at)
+                if response.status >= 400:
+                    self.log.error(f"HTTP error when making request to Hostex API: {response.status} {response.reason}")
+                    self.log.error(f"Response body: {response_body.decode('utf-8', 'replace')}")
+                    return {"error_code": response.status, "error_msg": response.reason}
+                json_response = hostex_json.loads(response_body)
+                self.log.debug("Received response: %s", json_response)
+                return json_response
+        except aiohttp.ClientError as e:
+            self.log.error(f"Network error when making request to Hostex API: {e}")
+            return {"error_code": 500, "error_msg": str(e)}
+        except Exception as e:
+            self.log.error(f"Unexpected error when making request to Hostex API: {e}")
+            return {"error_code": 500, "error_msg": str(e)}
 
     def parse_timestamp(self, timestamp_str: str) -> datetime:
-        self.log.debug(f"Parsing timestamp: {timestamp_str}")
+        self.log.debug("Parsing timestamp: %s", timestamp_str)
         try:
             dt = datetime.fromisoformat(timestamp_str.rstrip('Z'))
             if dt.tzinfo is None:
                 dt = dt.replace(tzinfo=timezone.utc)
             local_dt = dt.astimezone(self.timezone)
-            self.log.debug(f"Parsed timestamp: {local_dt}")
+            self.log.debug("Parsed timestamp: %s", local_dt)
             return local_dt
         except Exception as e:
             self.log.error(f"Error parsing timestamp {timestamp_str}: {e}")
@@ -67,32 +101,41 @@ class HostexAPI:
         self.log.debug(f"Getting conversations with offset {offset} and limit {limit}")
         endpoint = "conversations"
         params = {"offset": offset, "limit": limit}
-        return await self._make_request("GET", endpoint, params=params)
+        response = await self._make_request("GET", endpoint, params=params)
+        if self.account_id:
+            for conv in response.get("data", {}).get("conversations", []):
+                conv["id"] = self.conversation_key(conv["id"])
+        return response
 
-    async def get_conversation_messages(self, conversation_id: str, limit: int = 20, last_message_id: str = None) -> List[Dict[str, Any]]:
-        self.log.debug(f"Getting messages for conversation {conversation_id} with limit {limit} and last_message_id {last_message_id}")
-        endpoint = f"conversations/{conversation_id}"
+    async def get_conversation(self, conversation_id: str, limit: int = 20, last_message_id: str = None) -> Dict[str, Any]:
+        # The conversation endpoint returns guest and reservation details along with the messages
+        endpoint = f"conversations/{self.raw_conversation_id(conversation_id)}"
         params = {"limit": limit}
         if last_message_id:
             params["last_message_id"] = last_message_id
         response = await self._make_request("GET", endpoint, params=params)
-        self.log.debug(f"Full response for conversation {conversation_id}: {response}")
-        messages = response.get("data", {}).get("messages", [])
+        self.log.debug("Full response for conversation %s: %s", conversation_id, response)
+        return response.get("data") or {}
+
+    async def get_conversation_messages(self, conversation_id: str, limit: int = 20, last_message_id: str = None) -> List[Dict[str, Any]]:
+        self.log.debug(f"Getting messages for conversation {conversation_id} with limit {limit} and last_message_id {last_message_id}")
+        messages = (await self.get_conversation(conversation_id, limit, last_message_id)).get("messages", [])
         self.log.debug(f"Retrieved {len(messages)} messages for conversation {conversation_id}")
         return messages
 
     async def send_message(self, conversation_id: str, message: str) -> Dict[str, Any]:
         self.log.debug(f"Sending message to conversation {conversation_id}: {message}")
-        endpoint = f"conversations/{conversation_id}"
+        endpoint = f"conversations/{self.raw_conversation_id(conversation_id)}"
         data = {"message": message}
         self.log.debug(f"Sending message to Hostex API: {data}")
+        await self.send_limiter.acquire()
         response = await self._make_request("POST", endpoint, data=data)
         self.log.debug(f"Received response from Hostex API: {response}")
         return response
 
     async def get_guest_name(self, conversation_id: str) -> str:
         self.log.debug(f"Getting guest name for conversation {conversation_id}")
-        endpoint = f"conversations/{conversation_id}"
+        endpoint = f"conversations/{self.raw_conversation_id(conversation_id)}"
         response = await self._make_request("GET", endpoint)
         guest = response.get("data", {}).get("guest", {})
         guest_name = guest.get("name", "Unknown Guest")
@@ -101,7 +144,13 @@ class HostexAPI:
 
     async def get_conversation_details(self, conversation_id: str) -> Dict[str, Any]:
         self.log.debug(f"Getting conversation details for {conversation_id}")
-        endpoint = f"conversations/{conversation_id}"
+        endpoint = f"conversations/{self.raw_conversation_id(conversation_id)}"
         response = await self._make_request("GET", endpoint)
-        self.log.debug(f"Retrieved conversation details: {response}")
+        self.log.debug("Retrieved conversation details: %s", response)
         return response
+
+    async def get_reservation(self, reservation_code: str) -> Dict[str, Any]:
+        self.log.debug(f"Getting reservation {reservation_code}")
+        response = await self._make_request("GET", "reservations", params={"reservation_code": reservation_code})
+        reservations = response.get("data", {}).get("reservations", [])
+        return reservations[0] if reservations else {}
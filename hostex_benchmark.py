@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytz
+from mautrix.util.async_db import Database
+
+from hostex_api import HostexAPI
+from hostex_bridge_core import HostexBridgeCore
+from hostex_database import HostexDatabase
+from hostex_message_handling import HostexMessageHandler
+from hostex_performance import SETTINGS
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+
+# Row counts roughly matching a busy host in peak season
+CONVERSATIONS = 500
+ROOMS = 400
+MESSAGES_PER_CONVERSATION = 40
+SENT_MESSAGES_PER_ROOM = 20
+
+# Built-in defaults, as on a bridge without a performance section
+PERFORMANCE = SimpleNamespace(**{name: spec[1] for name, spec in SETTINGS.items()})
+
+class BenchmarkConfig:
+    # The only part of the bridge config HostexAPI reads outside of requests
+    hostex_timezone = pytz.timezone("America/Los_Angeles")
+
+def iso(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def make_conversations(count: int, now: datetime) -> list:
+    rng = random.Random(count)
+    # About half of them are older than the 7-day window, like a real conversation list
+    return [
+        {
+            'id': f"conv{index}",
+            'last_message_at': iso(now - timedelta(minutes=rng.randint(0, 14 * 24 * 60))),
+            'guest': {'name': f"Guest {index}"},
+        }
+        for index in range(count)
+    ]
+
+def make_rooms(count: int, now: datetime) -> dict:
+    return {
+        f"conv{index}": {
+            'room_id': f"!room{index}:example.org",
+            'last_message_time': now - timedelta(hours=index % 200),
+            'room_name': f"Guest {index}",
+        }
+        for index in range(count)
+    }
+
+class StaticConversationsAPI:
+    def __init__(self, conversations: list):
+        self.response = {'error_code': 200, 'data': {'conversations': conversations}}
+
+    async def get_conversations(self, offset: int = 0, limit: int = 20):
+        return self.response
+
+# Each benchmark is a setup function returning the callable to time (sync or async). Setup
+# runs once, outside the measurement.
+BENCHMARKS = {}
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+@benchmark("parse_timestamp")
+async def bench_parse_timestamp(state):
+    api = state.api
+    return lambda: api.parse_timestamp("2024-07-14T18:32:05Z")
+
+@benchmark("update_conversations")
+async def bench_update_conversations(state):
+    now = datetime.now(timezone.utc)
+    bridge = SimpleNamespace(
+        hostex_api=state.api,
+        performance=PERFORMANCE,
+        hostex_apis={'default': StaticConversationsAPI(make_conversations(CONVERSATIONS, now))},
+        conversation_rooms=make_rooms(ROOMS, now),
+        all_conversations=[],
+    )
+    return lambda: HostexBridgeCore.update_conversations(bridge)
+
+def message_handler_with_history(now: float) -> HostexMessageHandler:
+    handler = HostexMessageHandler(SimpleNamespace(log=logger, performance=PERFORMANCE))
+    for room in range(ROOMS):
+        handler.matrix_sent_messages[f"!room{room}:example.org"] = {
+            # About half of them are past message_expiry_time
+            f"Reply {index} to guest {room}": now - index * 30
+            for index in range(SENT_MESSAGES_PER_ROOM)
+        }
+    return handler
+
+@benchmark("clean_old_messages")
+async def bench_clean_old_messages(state):
+    handler = message_handler_with_history(time.time())
+    snapshot = {room_id: dict(messages) for room_id, messages in handler.matrix_sent_messages.items()}
+
+    # Restoring the snapshot is part of the timing, but it is small next to the cleanup itself
+    def run():
+        handler.matrix_sent_messages = {room_id: dict(messages) for room_id, messages in snapshot.items()}
+        handler.clean_old_messages()
+    return run
+
+@benchmark("echo_lookup")
+async def bench_echo_lookup(state):
+    handler = message_handler_with_history(time.time())
+    room_id = f"!room{ROOMS // 2}:example.org"
+    return lambda: (handler.is_echo(room_id, "Reply 3 to guest 200"), handler.is_echo(room_id, "Not sent from Matrix"))
+
+@benchmark("room_to_conversation_lookup")
+async def bench_room_lookup(state):
+    bridge = SimpleNamespace(conversation_rooms=make_rooms(ROOMS, datetime.now(timezone.utc)))
+    # Worst case for a scan: the last room and a room that is not bridged
+    last_room = f"!room{ROOMS - 1}:example.org"
+    return lambda: (HostexBridgeCore.conversation_for_room(bridge, last_room),
+                    HostexBridgeCore.conversation_for_room(bridge, "!unknown:example.org"))
+
+@benchmark("db_save_message")
+async def bench_db_save_message(state):
+    counter = iter(range(10 ** 9))
+    timestamp = datetime.now(timezone.utc)
+    return lambda: state.database.save_message("conv7", f"bench-{next(counter)}", "Is early check-in possible?", timestamp, "guest")
+
+@benchmark("db_get_recent_messages")
+async def bench_db_get_recent_messages(state):
+    return lambda: state.database.get_recent_messages("conv7", limit=100)
+
+@benchmark("db_search_messages")
+async def bench_db_search_messages(state):
+    return lambda: state.database.search_messages("check-in", limit=10)
+
+@benchmark("db_processed_message_ids")
+async def bench_db_processed_message_ids(state):
+    return lambda: state.database.get_processed_message_ids("conv7")
+
+@benchmark("db_add_processed_message_id")
+async def bench_db_add_processed_message_id(state):
+    counter = iter(range(10 ** 9))
+    return lambda: state.database.add_processed_message_id("conv7", f"bench-{next(counter)}")
+
+@benchmark("db_save_room_states")
+async def bench_db_save_room_states(state):
+    rooms = make_rooms(ROOMS, datetime.now(timezone.utc))
+    return lambda: state.database.save_room_states(rooms)
+
+@benchmark("db_load_room_states")
+async def bench_db_load_room_states(state):
+    return lambda: state.database.load_room_states()
+
+async def populate(database: HostexDatabase):
+    now = datetime.now(timezone.utc)
+    bodies = ["Hi, is early check-in possible?", "The wifi password is on the fridge.",
+              "Thanks, see you tomorrow!", "Where do we park?", "Check-out is at 11am."]
+    # messages.conversation_id references room_states, and SQLite enforces foreign keys
+    await database.save_room_states(make_rooms(CONVERSATIONS, now))
+    for conv in range(CONVERSATIONS):
+        for index in range(MESSAGES_PER_CONVERSATION):
+            message_id = f"m{conv}-{index}"
+            await database.save_message(f"conv{conv}", message_id, bodies[index % len(bodies)],
+                                        now - timedelta(minutes=index * 7), "guest" if index % 2 else "host")
+            await database.add_processed_message_id(f"conv{conv}", message_id)
+    # Leave the rooms past ROOMS so db_load_room_states still loads ROOMS rows
+    await database.mark_rooms_left([f"conv{index}" for index in range(ROOMS, CONVERSATIONS)], now)
+
+async def measure(fn, rounds: int, min_time: float) -> dict:
+    # The warm-up call also tells whether the benchmark returns awaitables
+    result = fn()
+    is_async = inspect.isawaitable(result)
+    if is_async:
+        await result
+
+    async def run(number: int) -> float:
+        start = time.perf_counter()
+        if is_async:
+            for _ in range(number):
+                await fn()
+        else:
+            for _ in range(number):
+                fn()
+        return time.perf_counter() - start
+
+    # Grow the loop until one round takes at least min_time, like timeit's autorange
+    number = 1
+    while (elapsed := await run(number)) < min_time:
+        number *= 10 if elapsed < min_time / 10 else 2
+    timings = [await run(number) / number for _ in range(rounds)]
+    return {
+        'median': statistics.median(timings),
+        'min': min(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'iterations': number,
+    }
+
+def format_duration(seconds: float) -> str:
+    for unit, scale in (("ns", 1e-9), ("µs", 1e-6), ("ms", 1e-3)):
+        if seconds < scale * 1000:
+            return f"{seconds / scale:.1f} {unit}"
+    return f"{seconds:.2f} s"
+
+def load_baselines(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file).get('benchmarks', {})
+
+def save_baselines(path: str, results: dict):
+    baselines = load_baselines(path)
+    baselines.update(results)
+    document = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'saved_at': iso(datetime.now(timezone.utc)),
+        'benchmarks': baselines,
+    }
+    # Indented and sorted so baseline updates review well in a diff
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(document, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+def report(results: dict, baselines: dict, threshold: float) -> list:
+    regressions = []
+    print(f"{'benchmark':<30} {'median':>10} {'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:<30} {format_duration(result['median']):>10} {'-':>10} {'new':>8}")
+            continue
+        change = result['median'] / baseline['median'] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<30} {format_duration(result['median']):>10} "
+              f"{format_duration(baseline['median']):>10} {change:>+7.0%}{flag}")
+    return regressions
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for the bridge's hot paths")
+    parser.add_argument("-k", dest="select", default=None, help="Only run benchmarks whose name contains this")
+    parser.add_argument("--baselines", default=DEFAULT_BASELINES, help="Baseline file to compare against")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown that counts as a regression (0.2 = 20%%)")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per round")
+    args = parser.parse_args()
+
+    selected = {name: setup for name, setup in BENCHMARKS.items() if not args.select or args.select in name}
+    if not selected:
+        print(f"No benchmark matches {args.select!r}. Available: {', '.join(BENCHMARKS)}")
+        return 2
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = Database.create(f"sqlite:///{os.path.join(temp_dir, 'benchmark.db')}", upgrade_table=None, log=logger)
+        database = HostexDatabase(db)
+        state = SimpleNamespace(api=HostexAPI("https://hostex.invalid", "benchmark", BenchmarkConfig()), database=database)
+        uses_database = any(name.startswith("db_") for name in selected)
+        if uses_database:
+            await database.start()
+        results = {}
+        try:
+            if uses_database:
+                print(f"Populating SQLite with {CONVERSATIONS * MESSAGES_PER_CONVERSATION} messages...")
+                await populate(database)
+            for name, setup in selected.items():
+                fn = await setup(state)
+                results[name] = await measure(fn, args.rounds, args.min_time)
+        finally:
+            if uses_database:
+                await database.stop()
+
+    regressions = report(results, load_baselines(args.baselines), args.threshold)
+    if args.save:
+        save_baselines(args.baselines, results)
+        print(f"Saved baselines to {args.baselines}")
+    elif regressions:
+        print(f"{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
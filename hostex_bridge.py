@@ -4,13 +4,14 @@ from mautrix.util.async_db import Database
 import logging
 import os
 import argparse
+import signal
 from hostex_bridge_core import HostexBridgeCore
 from hostex_config import Config
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-async def main():
+def load_settings():
     parser = argparse.ArgumentParser(description="Hostex Bridge")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
     parser.add_argument("--config", default="config.yaml", help="Path to the config file")
@@ -29,19 +30,41 @@ async def main():
 
     if not os.path.exists(config_path):
         logger.error(f"Config file not found: {config_path}")
-        return
+        return None
 
     config = Config(config_path, '')
     config.load()
 
     if not os.path.exists(registration_path):
         logger.error(f"Registration file not found: {registration_path}")
-        return
+        return None
 
     with open(registration_path, "r") as registration_file:
         registration_data = yaml.safe_load(registration_file)
 
-    database = Database.create(f"sqlite:///{db_path}", upgrade_table=None, db_args={}, log=logger)
+    return args, config, registration_data, db_path
+
+def install_event_loop(config):
+    # The config is loaded before the loop exists so it can pick the loop implementation
+    if not config.get("bridge.uvloop", False):
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("bridge.uvloop is enabled but uvloop is not installed, using the default event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop event loop")
+
+async def main(args, config, registration_data, db_path):
+    # SQLite stays the default; set database.uri to a postgres:// URI to use asyncpg instead.
+    # For SQLite, min_size is the number of pooled connections and max_size is ignored.
+    db_uri = config.get("database.uri", None) or f"sqlite:///{db_path}"
+    db_args = {
+        "min_size": config.get("database.min_size", 1),
+        "max_size": config.get("database.max_size", 10),
+    }
+    database = Database.create(db_uri, upgrade_table=None, db_args=db_args, log=logger)
     bridge = HostexBridgeCore(config, database, registration_data, args.debug)
 
     try:
@@ -49,7 +72,15 @@ async def main():
         await bridge.async_init()
         await bridge.start()
         logger.info("Hostex bridge is running. Press Ctrl+C to stop.")
-        await asyncio.Event().wait()
+        # Deploys stop the bridge with SIGTERM; shut down through the same drain path as Ctrl+C
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, bridge.stop_event.set)
+            except NotImplementedError:
+                pass
+        await bridge.stop_event.wait()
+        logger.info("Received stop signal, stopping bridge")
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt, stopping bridge")
     except Exception as e:
@@ -60,4 +91,7 @@ async def main():
         logger.info("Hostex bridge stopped")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    settings = load_settings()
+    if settings:
+        install_event_loop(settings[1])
+        asyncio.run(main(*settings))
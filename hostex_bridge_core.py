@@ -1,15 +1,18 @@
-from mautrix.types import UserID, RoomID, Event, TextMessageEventContent, MessageType
+from mautrix.types import UserID, RoomID, Event, EventType, StateEvent, TextMessageEventContent, MessageType
 from mautrix.util.async_db import Database
 from mautrix.appservice import AppService, IntentAPI
 from mautrix.errors import MatrixInvalidToken, MExclusive
 from mautrix.util.simple_template import SimpleTemplate
 import logging
+import aiohttp
 from yarl import URL
 from datetime import datetime, timezone, timedelta
 import asyncio
 import json
 import time
 
+import hostex_json
+
 from hostex_api import HostexAPI
 from appservice_websocket import AppserviceWebsocket
 from hostex_commands import HostexCommands
@@ -17,6 +20,21 @@ from hostex_database import HostexDatabase
 from hostex_room_management import HostexRoomManager
 from hostex_message_handling import HostexMessageHandler
 from hostex_polling import HostexPoller
+from hostex_outbox import HostexOutbox
+from hostex_send_queue import HostexSendQueue
+from hostex_status import HostexStatusSnapshot
+from hostex_expiry import HostexRoomExpiry
+from hostex_jobs import HostexJobRunner
+from hostex_sharding import HostexShardManager
+from hostex_webhook import HostexWebhookReceiver
+from hostex_loop_monitor import LoopLagMonitor
+from hostex_latency import HostexLatencyTracker
+from hostex_media import HostexMediaTransfer
+from hostex_details import HostexDetailsCache
+from hostex_ghosts import HostexGhostManager
+from hostex_recording import HostexRecorder
+from hostex_memory import HostexMemoryInspector
+from hostex_performance import HostexPerformanceSettings
 
 logger = logging.getLogger(__name__)
 
@@ -44,9 +62,34 @@ class HostexBridgeCore:
         self.mxid_template = SimpleTemplate(self.config["bridge.username_template"], "userid",
                                             prefix="@", suffix=f":{self.hs_domain}", type=str)
 
+        # One API client per Hostex account. The account with ID "default" (or the single
+        # account from hostex.token) keeps plain conversation IDs; others are namespaced.
+        self.hostex_apis = {}
+        self.poll_intervals = {}
         hostex_api_url = self.config["hostex.api_url"]
-        hostex_token = self.config["hostex.token"]
-        self.hostex_api = HostexAPI(hostex_api_url, hostex_token, self.config)
+        accounts = self.config.get("hostex.accounts", None) or [{
+            "id": "default",
+            "token": self.config["hostex.token"],
+            "rate_limit": self.config.get("hostex.rate_limit", 0),
+            "send_rate_limit": self.config.get("hostex.send_rate_limit", 0),
+        }]
+        for account in accounts:
+            account_id = account["id"]
+            self.hostex_apis[account_id] = HostexAPI(
+                account.get("api_url", hostex_api_url), account["token"], self.config,
+                account_id=None if account_id == "default" else account_id,
+                rate_limit=account.get("rate_limit", 0),
+                send_rate_limit=account.get("send_rate_limit", 0),
+            )
+            self.poll_intervals[account_id] = account.get("poll_interval")
+        self.hostex_api = next(iter(self.hostex_apis.values()))
+        self.recorder = None
+        record_path = self.config.get("hostex.record.path", None)
+        if record_path:
+            self.recorder = HostexRecorder(record_path, tuple(api.token for api in self.hostex_apis.values()))
+            for api in self.hostex_apis.values():
+                api.recorder = self.recorder
+        self.http_session = None
 
         server_url = self.config["homeserver.address"]
         self.bot_mxid = UserID(f"@{registration['sender_localpart']}:{self.hs_domain}")
@@ -63,13 +106,36 @@ class HostexBridgeCore:
         self.websocket = AppserviceWebsocket(
             self.config['appservice.url'],
             self.config['appservice.as_token'],
-            self.handle_matrix_event
+            self.handle_matrix_event,
+            heartbeat_interval=self.config.get("appservice.websocket.heartbeat_interval", 15),
+            stale_timeout=self.config.get("appservice.websocket.stale_timeout", 45),
+            backoff_initial=self.config.get("appservice.websocket.backoff_initial", 0.5),
+            backoff_max=self.config.get("appservice.websocket.backoff_max", 60),
         )
 
+        self.performance = HostexPerformanceSettings(self)
         self.commands = HostexCommands(self)
         self.room_manager = HostexRoomManager(self)
         self.message_handler = HostexMessageHandler(self)
-        self.poller = HostexPoller(self)
+        self.pollers = {
+            account_id: HostexPoller(self, api, self.poll_intervals[account_id])
+            for account_id, api in self.hostex_apis.items()
+        }
+        self.poller = next(iter(self.pollers.values()))
+        self.outbox = HostexOutbox(self)
+        self.send_queue = HostexSendQueue(self)
+        self.status = HostexStatusSnapshot(self)
+        self.latency = HostexLatencyTracker(self)
+        self.media = HostexMediaTransfer(self)
+        self.details = HostexDetailsCache(self)
+        self.ghosts = HostexGhostManager(self)
+        self.memory = HostexMemoryInspector(self)
+        self.expiry = HostexRoomExpiry(self)
+        self.jobs = HostexJobRunner(self)
+        self.shards = HostexShardManager(self)
+        self.webhook = HostexWebhookReceiver(self)
+        self.loop_monitor = LoopLagMonitor(config)
+        self.running = False
         self.stop_event = asyncio.Event()
 
         # Set up single puppet
@@ -78,6 +144,10 @@ class HostexBridgeCore:
 
         self.daily_maintenance_task = None
         self.hourly_maintenance_task = None
+        self.clean_messages_task = None
+        self.load_conversations_task = None
+        self.drain_timeout = self.config.get("bridge.shutdown.drain_timeout", 10)
+        self.snapshot_max_age = self.config.get("bridge.shutdown.snapshot_max_age", 600)
 
     async def async_init(self):
         await self.appservice.start(host="0.0.0.0", port=8080)
@@ -97,11 +167,26 @@ class HostexBridgeCore:
 
     async def start(self):
         try:
+            await self.loop_monitor.start()
+            if not self.http_session:
+                # One connection pool shared by every Hostex account
+                self.http_session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.config.get("hostex.connection_limit", 20))
+                )
+                for api in self.hostex_apis.values():
+                    api.session = self.http_session
             if not self.database_started:
                 await self.database.start()
                 self.database_started = True
             await self.database.ensure_schema()
+            self.guest_prefix = await self.database.get_setting("guest_prefix", self.guest_prefix)
             await self.room_manager.load_room_states()
+            await self.details.start()
+            await self.ghosts.start()
+            warm = await self.restore_snapshot()
+            await self.jobs.start()
+            await self.shards.start()
+            await self.performance.start()
 
             self.log.info(f"AppService ID: {self.appservice.id}")
             self.log.info(f"AppService AS token: {self.appservice.as_token[:5]}...")
@@ -114,19 +199,32 @@ class HostexBridgeCore:
                 self.log.error(f"Failed to connect to Matrix homeserver: {e}", exc_info=True)
                 return
 
-            await self.room_manager.ensure_admin_room()
-            await self.room_manager.load_conversations()
+            if self.shards.is_leader:
+                await self.room_manager.ensure_admin_room()
+            if warm:
+                # Room states came from the database; refresh the conversation list once everything is running
+                self.load_conversations_task = asyncio.create_task(self.room_manager.load_conversations())
+            else:
+                await self.room_manager.load_conversations()
 
-            await self.websocket.start()
+            # Pending sends are queued before the websocket can add new ones behind them
+            await self.send_queue.start()
+            if self.shards.is_leader:
+                await self.websocket.start()
+            self.running = True
 
-            await self.poller.start_polling()
+            await self.outbox.start()
+            await self.expiry.start()
+            for poller in self.pollers.values():
+                await poller.start_polling()
+            await self.webhook.start()
 
             # Start maintenance tasks
             self.daily_maintenance_task = asyncio.create_task(self.run_daily_maintenance())
             self.hourly_maintenance_task = asyncio.create_task(self.run_hourly_maintenance())
 
             # Start the clean_old_messages_loop
-            asyncio.create_task(self.clean_old_messages_loop())
+            self.clean_messages_task = asyncio.create_task(self.clean_old_messages_loop())
 
         except Exception as e:
             self.log.error(f"Error starting the bridge: {e}", exc_info=True)
@@ -135,11 +233,49 @@ class HostexBridgeCore:
 
     async def stop(self):
         try:
+            self.running = False
+            deadline = time.monotonic() + self.drain_timeout
+
+            def remaining():
+                return max(0, deadline - time.monotonic())
+
+            # Stop intake first: pollers, then webhooks and Matrix transactions after their in-flight work
+            for poller in self.pollers.values():
+                await poller.stop()
+            if self.load_conversations_task:
+                self.load_conversations_task.cancel()
+                self.load_conversations_task = None
+            await self.webhook.drain(remaining())
+            await self.webhook.stop()
+            await self.websocket.stop(remaining())
+            await self.jobs.stop()
+            # Deliveries that miss the deadline stay in the outbox table and resume on the next start
+            await self.outbox.drain(remaining())
+            await self.outbox.stop()
+            # Same for sends to Hostex, which stay in the send_queue table
+            await self.send_queue.drain(remaining())
+            await self.send_queue.stop()
+            await self.expiry.stop()
+            if self.database_started:
+                await self.save_snapshot()
+            # Only give up our conversations once our own deliveries are done
+            await self.shards.stop()
+            await self.loop_monitor.stop()
+            await self.performance.stop()
+            await self.media.stop()
+            await self.details.stop()
             if self.daily_maintenance_task:
                 self.daily_maintenance_task.cancel()
             if self.hourly_maintenance_task:
                 self.hourly_maintenance_task.cancel()
-
+            if self.clean_messages_task:
+                self.clean_messages_task.cancel()
+
+            if self.http_session:
+                await self.http_session.close()
+                self.http_session = None
+            if self.recorder:
+                self.recorder.close()
             if hasattr(self.appservice, 'runner'):
                 await self.appservice.stop()
             if self.database_started:
@@ -148,6 +284,46 @@ class HostexBridgeCore:
         except Exception as e:
             self.log.error(f"Error stopping the bridge: {e}", exc_info=True)
 
+    def snapshot_key(self):
+        # Each worker keeps its own caches. A generated worker ID changes on every restart, so
+        # only workers with a configured worker_id can find their snapshot again.
+        if not self.shards.enabled:
+            return "warm_snapshot"
+        if not self.config.get("bridge.workers.worker_id", None):
+            return None
+        return f"warm_snapshot:{self.shards.worker_id}"
+
+    async def save_snapshot(self):
+        # Flush in-memory room state and keep the hot caches for a quick restart
+        try:
+            await self.database.save_room_states(self.shards.owned_rooms())
+            key = self.snapshot_key()
+            if not key:
+                return
+            snapshot = self.message_handler.snapshot()
+            snapshot['saved_at'] = time.time()
+            await self.database.set_setting(key, hostex_json.dumps(snapshot))
+        except Exception as e:
+            self.log.error(f"Failed to save shutdown snapshot: {e}", exc_info=True)
+
+    async def restore_snapshot(self) -> bool:
+        key = self.snapshot_key()
+        data = await self.database.get_setting(key) if key else None
+        if not data:
+            return False
+        await self.database.set_setting(key, None)
+        try:
+            snapshot = hostex_json.loads(data)
+        except hostex_json.DecodeError:
+            return False
+        age = time.time() - snapshot.get('saved_at', 0)
+        if age > self.snapshot_max_age:
+            self.log.info(f"Ignoring shutdown snapshot from {int(age)} seconds ago")
+            return False
+        self.message_handler.restore(snapshot)
+        self.log.info(f"Restored shutdown snapshot from {age:.1f} seconds ago")
+        return True
+
     async def run_daily_maintenance(self):
         while True:
             try:
@@ -176,20 +352,56 @@ class HostexBridgeCore:
             try:
                 await asyncio.sleep(60)  # Clean every minute
                 self.message_handler.clean_old_messages()
+                if self.shards.enabled:
+                    await self.database.delete_sent_messages(time.time() - self.performance.message_expiry_time)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 self.log.error(f"Error in clean_old_messages_loop: {e}", exc_info=True)
 
     async def handle_matrix_event(self, event: Event):
-        if event.sender == self.puppet_mxid:
-            return  # Ignore events from the puppet account
+        if isinstance(event, StateEvent) and event.type == EventType.ROOM_MEMBER:
+            self.room_manager.handle_member_event(event.room_id, event.state_key, event.content.membership)
+
+        if event.sender == self.puppet_mxid or self.ghosts.is_ghost(event.sender):
+            return  # Ignore events from the puppet account and guest ghosts
         
         if event.sender.endswith(":beeper.com"):
             await self.message_handler.handle_matrix_event(event)
         elif event.sender.endswith(":beeper.local"):
             self.log.debug(f"Received event from bot or bridge: {event}")
 
+    async def on_leadership_change(self, is_leader: bool):
+        if not self.running:
+            return
+        if is_leader:
+            self.log.info(f"Worker {self.shards.worker_id} took over the admin room and websocket")
+            await self.room_manager.load_room_states()
+            await self.room_manager.ensure_admin_room()
+            # Finish what the previous leader left in the send queue, ahead of new events
+            await self.send_queue.start()
+            await self.websocket.start()
+        else:
+            self.log.info(f"Worker {self.shards.worker_id} lost the admin lease, stopping websocket and send queue")
+            await self.websocket.stop()
+            # The new leader resumes the send_queue rows; sending them here too would deliver them twice
+            await self.send_queue.stop()
+
+    def api_for(self, conversation_key: str) -> HostexAPI:
+        account_id, sep, _ = conversation_key.partition(":")
+        if sep and account_id in self.hostex_apis:
+            return self.hostex_apis[account_id]
+        return self.hostex_apis.get("default", self.hostex_api)
+
+    def conversation_for_room(self, room_id: RoomID):
+        return next((conv_id for conv_id, data in self.conversation_rooms.items() if data['room_id'] == room_id), None)
+
+    def poller_for(self, conversation_key: str) -> HostexPoller:
+        account_id, sep, _ = conversation_key.partition(":")
+        if sep and account_id in self.pollers:
+            return self.pollers[account_id]
+        return self.pollers.get("default", self.poller)
+
     def get_mxid_from_id(self, hostex_id: str) -> UserID:
         return UserID(self.mxid_template.format_full(hostex_id))
 
@@ -200,16 +412,19 @@ class HostexBridgeCore:
         await self.room_manager.load_conversations()
 
     async def update_conversations(self):
-        conversations = await self.hostex_api.get_conversations()
-        one_week_ago = datetime.now(timezone.utc) - timedelta(days=7)
+        conversations = []
+        for api in self.hostex_apis.values():
+            response = await api.get_conversations(limit=self.performance.conversation_page_size)
+            conversations.extend(response.get('data', {}).get('conversations', []))
+        window_start = datetime.now(timezone.utc) - timedelta(days=self.performance.active_window_days)
         updated_conversations = []
 
-        for conv in conversations.get('data', {}).get('conversations', []):
+        for conv in conversations:
             last_message_at = self.hostex_api.parse_timestamp(conv['last_message_at'])
             if last_message_at.tzinfo is None:
                 last_message_at = last_message_at.replace(tzinfo=timezone.utc)
             
-            if last_message_at >= one_week_ago:
+            if last_message_at >= window_start:
                 if conv['id'] not in self.conversation_rooms:
                     updated_conversations.append(conv)
                 else:
@@ -1,10 +1,15 @@
-from mautrix.types import RoomID, UserID
-from datetime import datetime, timezone, timedelta
+from mautrix.types import RoomID, UserID, TextMessageEventContent, MessageType, Format
+import html
 import logging
 from tabulate import tabulate
 
+from hostex_status import FILTERS
+
 logger = logging.getLogger(__name__)
 
+CONVERSATION_COMMANDS = ("!help", "!backfill", "!messages", "!search")
+SEARCH_PAGE_SIZE = 10
+
 class HostexCommands:
     def __init__(self, bridge):
         self.bridge = bridge
@@ -17,8 +22,8 @@ class HostexCommands:
         command = message.lower().strip()
         if command == "help":
             await self.send_help(self.bridge.admin_room_id)
-        elif command == "status":
-            await self.send_status(self.bridge.admin_room_id)
+        elif command == "status" or command.startswith("status "):
+            await self.send_status(self.bridge.admin_room_id, command)
         elif command == "cleanup":
             await self.cleanup_rooms(self.bridge.admin_room_id)
         elif command.startswith("debug"):
@@ -29,9 +34,25 @@ class HostexCommands:
             await self.force_room_creation(self.bridge.admin_room_id)
         elif command == "force_maintenance":
             await self.force_maintenance(self.bridge.admin_room_id)
+        elif command.startswith("search"):
+            await self.search_messages(self.bridge.admin_room_id, message.strip()[len("search"):])
+        elif command == "jobs":
+            await self.list_jobs(self.bridge.admin_room_id)
+        elif command.startswith("cancel"):
+            await self.cancel_job(self.bridge.admin_room_id, command)
+        elif command == "memory" or command.startswith("memory "):
+            await self.send_memory(self.bridge.admin_room_id, command)
+        elif command == "set" or command.startswith("set "):
+            await self.set_performance(self.bridge.admin_room_id, command)
+        elif command == "latency" or command.startswith("latency "):
+            await self.send_latency(self.bridge.admin_room_id, message.strip()[len("latency"):].strip())
         else:
             await self.bridge.puppet_intent.send_text(self.bridge.admin_room_id, "Unknown command. Type 'help' for a list of commands.")
 
+    def is_conversation_command(self, message: str) -> bool:
+        parts = message.strip().split(maxsplit=1)
+        return bool(parts) and parts[0].lower() in CONVERSATION_COMMANDS
+
     async def handle_conversation_command(self, room_id: RoomID, message: str):
         command = message.lower().strip()
         if command == "!help":
@@ -40,6 +61,12 @@ class HostexCommands:
             await self.backfill_messages(room_id, command)
         elif command == "!messages":
             await self.show_recent_messages(room_id)
+        elif command.startswith("!search"):
+            conversation_id = self.bridge.conversation_for_room(room_id)
+            if conversation_id:
+                await self.search_messages(room_id, message.strip()[len("!search"):], conversation_id)
+            else:
+                await self.bridge.puppet_intent.send_text(room_id, "This room is not associated with a Hostex conversation.")
         else:
             await self.bridge.puppet_intent.send_text(room_id, "Unknown command. Type '!help' for a list of commands.")
 
@@ -47,12 +74,18 @@ class HostexCommands:
         help_text = (
             "Available commands:\n"
             "help - Show this help message\n"
-            "status - Show bridge status and conversation information\n"
-            "cleanup - Remove rooms for conversations older than a week\n"
+            "status [all|active|lagging] [page] - Show bridge status and conversation information\n"
+            "cleanup - Remove rooms for conversations outside the active window\n"
             "debug on/off - Turn debug mode on or off\n"
             "prefix <new_prefix> - Change the guest name prefix\n"
             "force_room_creation - Force creation of rooms for all conversations\n"
-            "force_maintenance - Force maintenance tasks (leave old rooms, ensure user in rooms, load conversations)"
+            "force_maintenance - Force maintenance tasks (leave old rooms, ensure user in rooms, load conversations)\n"
+            "search <query> [--page N] - Search message history across all conversations\n"
+            "jobs - List running and recent background jobs\n"
+            "cancel <job_id> - Cancel a running background job\n"
+            "latency [conversation_id] - Show p50/p95/p99 delivery latency per stage\n"
+            "memory [snapshot|diff|stop] - Show memory use of bridge structures or trace allocations with tracemalloc\n"
+            "set [<name> <value|default>] - Show or change performance settings without a restart"
         )
         await self.bridge.puppet_intent.send_text(room_id, help_text)
 
@@ -61,64 +94,41 @@ class HostexCommands:
             "Available commands:\n"
             "!help - Show this help message\n"
             "!backfill [number] - Backfill messages (default: 20, max: 100)\n"
-            "!messages - Show recent messages stored in the database"
+            "!messages - Show recent messages stored in the database\n"
+            "!search <query> [--page N] - Search this conversation's message history"
         )
         await self.bridge.puppet_intent.send_text(room_id, help_text)
 
-    async def send_status(self, room_id: RoomID):
+    async def send_status(self, room_id: RoomID, command: str = "status"):
         try:
-            status_text = f"Last poll time: {self.bridge.last_poll_time or 'Never'}\n\n"
-            
-            table_data = []
-            conversations = await self.bridge.update_conversations()
-            for conv in conversations:
-                name = conv.get('guest', {}).get('name', 'Unknown')
-                phone = conv.get('guest', {}).get('phone', '')
-                last_activity = conv.get('last_message_at', 'Unknown')
-                conversation_id = conv.get('id', 'Unknown')
-                room_id_info = self.bridge.conversation_rooms.get(conversation_id, {}).get('room_id', 'Not bridged')
-
-                if isinstance(phone, str) and len(phone) > 4:
-                    phone = f"...{phone[-4:]}"
+            status_filter = "all"
+            page = 1
+            for arg in command.split()[1:]:
+                if arg in FILTERS:
+                    status_filter = arg
+                elif arg.isdigit():
+                    page = int(arg)
                 else:
-                    phone = "N/A"
-
-                table_data.append([name, phone, last_activity, room_id_info])
+                    await self.bridge.puppet_intent.send_text(room_id, f"Unknown status filter '{arg}'. Use one of: {', '.join(FILTERS)}")
+                    return
 
-            table_data.sort(key=lambda x: x[2], reverse=True)  # Sort by last activity, most recent first
-            
-            table_headers = ["Name", "Last 4 of Phone", "Last Activity", "Room ID"]
-            status_text += tabulate(table_data, headers=table_headers, tablefmt="grid")
-            
-            await self.bridge.puppet_intent.send_text(self.bridge.admin_room_id, status_text)
+            plain_text, html_text = self.bridge.status.render(status_filter, page)
+            content = TextMessageEventContent(
+                msgtype=MessageType.NOTICE,
+                body=plain_text,
+                format=Format.HTML,
+                formatted_body=html_text,
+            )
+            await self.bridge.puppet_intent.send_message(room_id, content)
         except Exception as e:
             logger.error(f"Error sending status message: {e}", exc_info=True)
 
     async def cleanup_rooms(self, room_id: RoomID):
-        removed_rooms = 0
-        one_week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        
-        for conv_id, room_data in list(self.bridge.conversation_rooms.items()):
-            last_message_time = room_data.get('last_message_time')
-            if last_message_time:
-                if last_message_time.tzinfo is None:
-                    last_message_time = last_message_time.replace(tzinfo=timezone.utc)
-                
-                if last_message_time < one_week_ago:
-                    try:
-                        # Check if the user is in the room before trying to leave
-                        members = await self.bridge.puppet_intent.get_joined_members(room_data['room_id'])
-                        if self.bridge.user_id in members:
-                            await self.bridge.puppet_intent.leave_room(room_data['room_id'])
-                        del self.bridge.conversation_rooms[conv_id]
-                        removed_rooms += 1
-                    except Exception as e:
-                        logger.error(f"Error processing room {room_data['room_id']} for conversation {conv_id}: {e}")
-        
-        await self.bridge.database.save_room_states(self.bridge.conversation_rooms)
-        
-        cleanup_message = f"Cleanup complete. Removed {removed_rooms} room(s)."
-        await self.bridge.puppet_intent.send_text(room_id, cleanup_message)
+        async def run(job):
+            removed_rooms = await self.bridge.expiry.expire_due()
+            return f"Cleanup complete. Removed {removed_rooms} room(s)."
+
+        self.bridge.jobs.submit("cleanup", room_id, run)
 
     async def set_debug_mode(self, room_id: RoomID, command: str):
         self.bridge.debug = command.endswith("on")
@@ -128,18 +138,25 @@ class HostexCommands:
         new_prefix = command.split(maxsplit=1)[1] if len(command.split()) > 1 else ""
         if new_prefix:
             self.bridge.guest_prefix = new_prefix
+            await self.bridge.database.set_setting("guest_prefix", new_prefix)
             await self.bridge.puppet_intent.send_text(room_id, f"Guest name prefix changed to: {self.bridge.guest_prefix}")
-            await self.update_room_names()
+
+            # A newer prefix supersedes a rename that is still running
+            for job in list(self.bridge.jobs.jobs.values()):
+                if job.name == "rename_rooms":
+                    self.bridge.jobs.cancel(job.id)
+
+            async def run(job):
+                async def progress(done, total, failed):
+                    await job.progress(f"Renamed {done}/{total} rooms ({failed} failed)")
+
+                total, failed = await self.bridge.room_manager.update_room_names(progress)
+                return f"Room rename complete: {total - failed} renamed, {failed} failed."
+
+            self.bridge.jobs.submit("rename_rooms", room_id, run)
         else:
             await self.bridge.puppet_intent.send_text(room_id, f"Current guest name prefix: {self.bridge.guest_prefix}")
 
-    async def update_room_names(self):
-        for conv_id, room_data in self.bridge.conversation_rooms.items():
-            conv = next((c for c in self.bridge.all_conversations if c.get('id') == conv_id), None)
-            if conv:
-                room_name = f"{self.bridge.guest_prefix} {conv.get('guest', {}).get('name', 'Unknown')}"
-                await self.bridge.puppet_intent.set_room_name(room_data['room_id'], room_name)
-
     async def backfill_messages(self, room_id: RoomID, command: str):
         parts = command.split()
         limit = 20
@@ -150,9 +167,9 @@ class HostexCommands:
             except ValueError:
                 await self.bridge.puppet_intent.send_text(room_id, "Invalid number. Using default of 20 messages.")
 
-        conversation_id = next((conv_id for conv_id, data in self.bridge.conversation_rooms.items() if data['room_id'] == room_id), None)
+        conversation_id = self.bridge.conversation_for_room(room_id)
         if conversation_id:
-            messages = await self.bridge.hostex_api.get_conversation_messages(conversation_id, limit)
+            messages = await self.bridge.api_for(conversation_id).get_conversation_messages(conversation_id, limit)
             messages.sort(key=lambda x: x['created_at'])  # Sort oldest to newest
             for message in messages:
                 await self.bridge.message_handler.process_hostex_message(conversation_id, message)
@@ -161,7 +178,7 @@ class HostexCommands:
             await self.bridge.puppet_intent.send_text(room_id, "This room is not associated with a Hostex conversation.")
 
     async def show_recent_messages(self, room_id: RoomID):
-        conversation_id = next((conv_id for conv_id, data in self.bridge.conversation_rooms.items() if data['room_id'] == room_id), None)
+        conversation_id = self.bridge.conversation_for_room(room_id)
         if conversation_id:
             messages = await self.bridge.database.get_recent_messages(conversation_id, limit=100)
             if messages:
@@ -182,24 +199,136 @@ class HostexCommands:
         else:
             await self.bridge.puppet_intent.send_text(room_id, "This room is not associated with a Hostex conversation.")
 
+    async def search_messages(self, room_id: RoomID, args: str, conversation_id: str = None):
+        terms = args.split()
+        page = 1
+        if len(terms) >= 2 and terms[-2] == "--page" and terms[-1].isdigit():
+            page = max(1, int(terms[-1]))
+            terms = terms[:-2]
+        query = " ".join(terms)
+        if not query:
+            await self.bridge.puppet_intent.send_text(room_id, "Usage: search <query> [--page N]")
+            return
+
+        # Fetch one extra row to know whether there is a next page
+        results = await self.bridge.database.search_messages(
+            query, conversation_id, limit=SEARCH_PAGE_SIZE + 1, offset=(page - 1) * SEARCH_PAGE_SIZE
+        )
+        has_more = len(results) > SEARCH_PAGE_SIZE
+        results = results[:SEARCH_PAGE_SIZE]
+        if not results:
+            await self.bridge.puppet_intent.send_text(room_id, f"No messages found for '{query}'.")
+            return
+
+        guest_names = self.bridge.status.conversations
+        plain_lines = [f"Results for '{query}' (page {page}):"]
+        html_items = []
+        for msg in results:
+            timestamp = msg['timestamp'].strftime('%Y-%m-%d %H:%M') if msg['timestamp'] else "Unknown"
+            who = "Guest" if msg['sender_role'] == 'guest' else "Host"
+            guest = guest_names.get(msg['conversation_id'], {}).get('name', msg['conversation_id'])
+            content = msg['content'][:200] + ('...' if len(msg['content']) > 200 else '')
+            plain_lines.append(f"{timestamp} {guest} ({who}): {content}")
+            html_items.append(
+                f"<li><b>{html.escape(timestamp)}</b> {html.escape(str(guest))} ({who}): {html.escape(content)}</li>"
+            )
+        html_body = f"<p>Results for <code>{html.escape(query)}</code> (page {page}):</p><ul>{''.join(html_items)}</ul>"
+        if has_more:
+            command = "!search" if conversation_id else "search"
+            hint = f"More results: {command} {query} --page {page + 1}"
+            plain_lines.append(hint)
+            html_body += f"<p>{html.escape(hint)}</p>"
+
+        content = TextMessageEventContent(
+            msgtype=MessageType.NOTICE,
+            body="\n".join(plain_lines),
+            format=Format.HTML,
+            formatted_body=html_body,
+        )
+        await self.bridge.puppet_intent.send_message(room_id, content)
+
     async def force_room_creation(self, room_id: RoomID):
-        await self.bridge.puppet_intent.send_text(room_id, "Forcing room creation for all conversations...")
-        conversations = await self.bridge.hostex_api.get_conversations()
-        for conv in conversations.get('data', {}).get('conversations', []):
-            conv_id = conv['id']
-            guest_name = conv['guest']['name']
-            if conv_id not in self.bridge.conversation_rooms:
+        async def run(job):
+            await job.progress("Fetching conversations...")
+            conversations = []
+            for api in self.bridge.hostex_apis.values():
+                response = await api.get_conversations(limit=self.bridge.performance.conversation_page_size)
+                conversations.extend(response.get('data', {}).get('conversations', []))
+            conversations = [
+                conv for conv in conversations
+                if conv['id'] not in self.bridge.conversation_rooms and self.bridge.shards.owns(conv['id'])
+            ]
+            created_count = 0
+            errors = []
+            for index, conv in enumerate(conversations, start=1):
+                conv_id = conv['id']
                 try:
-                    new_room_id, created = await self.bridge.room_manager.create_conversation_room(conv_id, guest_name)
-                    if created:
-                        await self.bridge.puppet_intent.send_text(room_id, f"Created room for conversation {conv_id} with guest {guest_name}: {new_room_id}")
-                    else:
-                        await self.bridge.puppet_intent.send_text(room_id, f"Room already exists for conversation {conv_id} with guest {guest_name}: {new_room_id}")
+                    # Goes through the same path as polling, so the room is tracked, persisted and backfilled
+                    last_message_at = self.bridge.api_for(conv_id).parse_timestamp(conv['last_message_at'])
+                    if await self.bridge.room_manager.add_conversation_room(conv, last_message_at):
+                        created_count += 1
                 except Exception as e:
-                    await self.bridge.puppet_intent.send_text(room_id, f"Error creating room for conversation {conv_id}: {str(e)}")
-        await self.bridge.puppet_intent.send_text(room_id, "Forced room creation complete.")
+                    errors.append(f"{conv_id}: {e}")
+                await job.progress(f"Processed {index}/{len(conversations)} conversations, created {created_count} room(s)")
+            result = f"Forced room creation complete. Created {created_count} room(s)."
+            if errors:
+                result += f" {len(errors)} error(s): " + "; ".join(errors[:5])
+            return result
+
+        self.bridge.jobs.submit("force_room_creation", room_id, run)
 
     async def force_maintenance(self, room_id: RoomID):
-        await self.bridge.puppet_intent.send_text(room_id, "Forcing maintenance tasks...")
-        await self.bridge.force_maintenance()
-        await self.bridge.puppet_intent.send_text(room_id, "Maintenance tasks completed.")
+        async def run(job):
+            await job.progress("Leaving old rooms...")
+            await self.bridge.room_manager.leave_old_rooms()
+            await job.progress("Ensuring user is in rooms...")
+            await self.bridge.room_manager.ensure_user_in_rooms()
+            await job.progress("Loading conversations...")
+            await self.bridge.room_manager.load_conversations()
+            return "Maintenance tasks completed."
+
+        self.bridge.jobs.submit("force_maintenance", room_id, run)
+
+    async def list_jobs(self, room_id: RoomID):
+        await self.bridge.puppet_intent.send_notice(room_id, await self.bridge.jobs.describe_jobs())
+
+    async def cancel_job(self, room_id: RoomID, command: str):
+        parts = command.split()
+        if len(parts) != 2:
+            await self.bridge.puppet_intent.send_text(room_id, "Usage: cancel <job_id>")
+        elif self.bridge.jobs.cancel(parts[1]):
+            await self.bridge.puppet_intent.send_text(room_id, f"Cancelling job {parts[1]}.")
+        else:
+            await self.bridge.puppet_intent.send_text(room_id, f"No running job with ID {parts[1]}.")
+
+    async def send_latency(self, room_id: RoomID, conversation_id: str):
+        await self.bridge.puppet_intent.send_notice(room_id, self.bridge.latency.report(conversation_id or None))
+
+    async def send_memory(self, room_id: RoomID, command: str):
+        action = command.split()[1] if len(command.split()) > 1 else ""
+        if action == "snapshot":
+            text = self.bridge.memory.take_snapshot()
+        elif action == "diff":
+            text = self.bridge.memory.diff()
+        elif action == "stop":
+            text = self.bridge.memory.stop()
+        elif not action:
+            text = self.bridge.memory.report()
+        else:
+            text = "Usage: memory [snapshot|diff|stop]"
+        await self.bridge.puppet_intent.send_notice(room_id, text)
+
+    async def set_performance(self, room_id: RoomID, command: str):
+        args = command.split()[1:]
+        if not args:
+            await self.bridge.puppet_intent.send_notice(room_id, self.bridge.performance.describe())
+            return
+        if len(args) != 2:
+            await self.bridge.puppet_intent.send_text(room_id, "Usage: set <name> <value|default>")
+            return
+        try:
+            result = await self.bridge.performance.set(args[0], args[1])
+        except ValueError as e:
+            await self.bridge.puppet_intent.send_text(room_id, f"Not changed: {e}")
+            return
+        await self.bridge.puppet_intent.send_text(room_id, f"Performance setting updated: {result}")
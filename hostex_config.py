@@ -3,6 +3,8 @@ from typing import Any
 import pytz
 import yaml
 
+from hostex_performance import SETTINGS
+
 class Config(BaseFileConfig):
     def __init__(self, path: str, base_path: str):
         super().__init__(path, base_path)
@@ -15,11 +17,71 @@ class Config(BaseFileConfig):
         helper.copy("hostex.api_url")
         helper.copy("hostex.token")
         helper.copy("hostex.timezone")  # New configuration option
+        helper.copy("hostex.accounts")
+        helper.copy("hostex.rate_limit")
+        helper.copy("hostex.send_rate_limit")
+        helper.copy("hostex.connection_limit")
+        helper.copy("hostex.media.concurrency")
+        helper.copy("hostex.media.max_size")
+        helper.copy("hostex.media.max_attempts")
+        helper.copy("hostex.media.retry_delay")
+        helper.copy("hostex.media.resume_attempts")
+        helper.copy("hostex.media.temp_dir")
+        helper.copy("hostex.media.thumbnail_size")
+        helper.copy("hostex.media.thumbnail_workers")
+        helper.copy("hostex.details.concurrency")
+        helper.copy("hostex.record.path")
+        helper.copy("hostex.webhook.enabled")
+        helper.copy("hostex.webhook.secret")
+        helper.copy("hostex.webhook.path")
+        helper.copy("hostex.webhook.reconcile_interval")
+        helper.copy("hostex.webhook.silence_timeout")
+        helper.copy("hostex.webhook.queue_size")
+        helper.copy("hostex.webhook.forward_interval")
         helper.copy("appservice.url")
         helper.copy("appservice.as_token")
+        helper.copy("appservice.websocket.heartbeat_interval")
+        helper.copy("appservice.websocket.stale_timeout")
+        helper.copy("appservice.websocket.backoff_initial")
+        helper.copy("appservice.websocket.backoff_max")
         helper.copy("admin.user_id")
         helper.copy("bridge.username_template")
         helper.copy("bridge.double_puppet_server_map")
+        helper.copy("bridge.workers.enabled")
+        helper.copy("bridge.workers.worker_id")
+        helper.copy("bridge.workers.heartbeat_interval")
+        helper.copy("bridge.workers.lease_timeout")
+        helper.copy("bridge.workers.virtual_nodes")
+        helper.copy("bridge.ghosts.enabled")
+        helper.copy("bridge.maintenance_concurrency")
+        helper.copy("bridge.homeserver_rate_limit")
+        helper.copy("bridge.uvloop")
+        helper.copy("bridge.loop_monitor.enabled")
+        helper.copy("bridge.loop_monitor.interval")
+        helper.copy("bridge.loop_monitor.block_threshold")
+        helper.copy("bridge.loop_monitor.window")
+        helper.copy("bridge.latency.window")
+        helper.copy("bridge.shutdown.drain_timeout")
+        helper.copy("bridge.shutdown.snapshot_max_age")
+        helper.copy("bridge.memory.tracemalloc_frames")
+        helper.copy("bridge.outbox.workers")
+        helper.copy("bridge.outbox.queue_size")
+        helper.copy("bridge.outbox.max_attempts")
+        helper.copy("bridge.outbox.retry_delay")
+        helper.copy("bridge.outbox.max_retry_delay")
+        helper.copy("bridge.send_queue.workers")
+        helper.copy("bridge.send_queue.max_attempts")
+        helper.copy("bridge.send_queue.retry_delay")
+        helper.copy("bridge.send_queue.max_retry_delay")
+        helper.copy("bridge.send_queue.reactions")
+        helper.copy("bridge.jobs.concurrency")
+        helper.copy("bridge.jobs.edit_interval")
+        helper.copy("bridge.status.lag_threshold")
+        for name in SETTINGS:
+            helper.copy(f"performance.{name}")
+        helper.copy("database.uri")
+        helper.copy("database.min_size")
+        helper.copy("database.max_size")
 
     def __getitem__(self, key: str) -> Any:
         if "." in key:
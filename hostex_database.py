@@ -1,10 +1,11 @@
 # hostex_database.py
 
 import logging
-from mautrix.util.async_db import Database
+from mautrix.util.async_db import Database, Scheme
 from datetime import datetime, timezone
 import sqlite3
-import json
+
+import hostex_json
 
 logger = logging.getLogger(__name__)
 
@@ -21,11 +22,38 @@ def convert_datetime(val):
         logger.warning(f"Invalid timestamp found: {val}")
         return None
 
+def normalize_timestamp(ts):
+    if isinstance(ts, datetime) and ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts
+
 class HostexDatabase:
     def __init__(self, database: Database):
         self.db = database
-        sqlite3.register_adapter(datetime, adapt_datetime)
-        sqlite3.register_converter("timestamp", convert_datetime)
+        if self.db.scheme == Scheme.SQLITE:
+            sqlite3.register_adapter(datetime, adapt_datetime)
+            sqlite3.register_converter("timestamp", convert_datetime)
+        # Schema upgrades, applied in order. Append new ones, never reorder.
+        self.upgrades = [
+            self.upgrade_v1,
+            self.upgrade_v2,
+            self.upgrade_v3,
+            self.upgrade_v4,
+            self.upgrade_v5,
+            self.upgrade_v6,
+            self.upgrade_v7,
+            self.upgrade_v8,
+            self.upgrade_v9,
+            self.upgrade_v10,
+            self.upgrade_v11,
+            self.upgrade_v12,
+            self.upgrade_v13,
+            self.upgrade_v14,
+        ]
+
+    @property
+    def is_postgres(self) -> bool:
+        return self.db.scheme in (Scheme.POSTGRES, Scheme.COCKROACH)
 
     async def start(self):
         await self.db.start()
@@ -37,131 +65,409 @@ class HostexDatabase:
     async def ensure_schema(self):
         async with self.db.acquire() as conn:
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS room_states (
-                    conversation_id TEXT PRIMARY KEY,
-                    room_id TEXT NOT NULL,
-                    last_message TEXT,
-                    last_message_time TIMESTAMP
-                )
-            """)
-            
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id TEXT PRIMARY KEY,
-                    conversation_id TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP NOT NULL,
-                    sender_role TEXT NOT NULL,
-                    FOREIGN KEY (conversation_id) REFERENCES room_states(conversation_id)
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY
                 )
             """)
+            current_version = await conn.fetchval("SELECT MAX(version) FROM schema_version") or 0
+            for version, upgrade in enumerate(self.upgrades, start=1):
+                if version <= current_version:
+                    continue
+                logger.info(f"Upgrading database schema to v{version}")
+                async with conn.transaction():
+                    await upgrade(conn)
+                    await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", version)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS last_poll_time (
-                    id INTEGER PRIMARY KEY,
-                    timestamp TIMESTAMP
-                )
-            """)
+    async def upgrade_v1(self, conn):
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS room_states (
+                conversation_id TEXT PRIMARY KEY,
+                room_id TEXT NOT NULL,
+                last_message TEXT,
+                last_message_time TIMESTAMP WITH TIME ZONE
+            )
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                conversation_id TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                sender_role TEXT NOT NULL,
+                FOREIGN KEY (conversation_id) REFERENCES room_states(conversation_id)
+            )
+        """)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS processed_messages (
-                    conversation_id TEXT,
-                    message_id TEXT,
-                    PRIMARY KEY (conversation_id, message_id)
-                )
-            """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS last_poll_time (
+                id INTEGER PRIMARY KEY,
+                timestamp TIMESTAMP WITH TIME ZONE
+            )
+        """)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS puppets (
-                    user_id TEXT PRIMARY KEY,
-                    puppet_data TEXT NOT NULL
-                )
-            """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                conversation_id TEXT,
+                message_id TEXT,
+                PRIMARY KEY (conversation_id, message_id)
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS puppets (
+                user_id TEXT PRIMARY KEY,
+                puppet_data TEXT NOT NULL
+            )
+        """)
+
+    async def upgrade_v2(self, conn):
+        await conn.execute("""
+            CREATE TABLE worker_heartbeats (
+                worker_id TEXT PRIMARY KEY,
+                last_heartbeat TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE worker_leases (
+                name TEXT PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE worker_poll_times (
+                worker_id TEXT PRIMARY KEY,
+                timestamp TIMESTAMP WITH TIME ZONE
+            )
+        """)
+
+    async def upgrade_v3(self, conn):
+        await conn.execute("""
+            CREATE TABLE outbox (
+                conversation_id TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                enqueued_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                PRIMARY KEY (conversation_id, message_id)
+            )
+        """)
+
+    async def upgrade_v4(self, conn):
+        # Rooms we left are kept (their messages reference them) but no longer loaded
+        await conn.execute("ALTER TABLE room_states ADD COLUMN left_at TIMESTAMP WITH TIME ZONE")
+
+    async def upgrade_v5(self, conn):
+        await conn.execute("ALTER TABLE room_states ADD COLUMN room_name TEXT")
+        await conn.execute("""
+            CREATE TABLE bridge_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+
+    async def upgrade_v6(self, conn):
+        await conn.execute("""
+            CREATE TABLE jobs (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                finished_at TIMESTAMP WITH TIME ZONE
+            )
+        """)
+
+    async def upgrade_v7(self, conn):
+        if self.is_postgres:
+            await conn.execute("CREATE INDEX messages_content_fts ON messages USING GIN (to_tsvector('simple', content))")
+            return
+        # External-content FTS5 index over messages, kept in sync by triggers
+        await conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='rowid')")
+        await conn.execute("""
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+            END
+        """)
+        await conn.execute("""
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+            END
+        """)
+        await conn.execute("""
+            CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+                INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+            END
+        """)
+        await conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    async def upgrade_v8(self, conn):
+        # Uploaded media keyed by content hash, plus the Hostex URLs known to have that content
+        await conn.execute("""
+            CREATE TABLE media_cache (
+                content_hash TEXT PRIMARY KEY,
+                mxc TEXT NOT NULL,
+                mime_type TEXT NOT NULL,
+                size BIGINT NOT NULL,
+                info TEXT,
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE media_sources (
+                url TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL REFERENCES media_cache(content_hash)
+            )
+        """)
+
+    async def upgrade_v9(self, conn):
+        # last_message_at is the raw Hostex value the details were fetched at; topic is what was last published
+        await conn.execute("""
+            CREATE TABLE conversation_details (
+                conversation_id TEXT PRIMARY KEY,
+                last_message_at TEXT,
+                reservation_code TEXT,
+                details TEXT NOT NULL,
+                topic TEXT,
+                updated_at TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+        """)
+
+    async def upgrade_v10(self, conn):
+        # Matrix -> Hostex sends waiting for delivery; id keeps them in arrival order
+        id_column = "BIGSERIAL PRIMARY KEY" if self.is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"
+        await conn.execute(f"""
+            CREATE TABLE send_queue (
+                id {id_column},
+                event_id TEXT NOT NULL UNIQUE,
+                conversation_id TEXT NOT NULL,
+                room_id TEXT NOT NULL,
+                body TEXT NOT NULL,
+                sent_at DOUBLE PRECISION,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )
+        """)
+
+    async def upgrade_v11(self, conn):
+        if self.is_postgres:
+            return
+        # messages has a TEXT primary key, so its implicit rowid (which messages_fts was keyed on)
+        # can be renumbered by VACUUM. Rebuild it with an INTEGER PRIMARY KEY alias, which SQLite
+        # keeps stable, and key the full-text index on that instead.
+        for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+            await conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        await conn.execute("DROP TABLE IF EXISTS messages_fts")
+        await conn.execute("""
+            CREATE TABLE messages_v11 (
+                seq INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                conversation_id TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                sender_role TEXT NOT NULL,
+                FOREIGN KEY (conversation_id) REFERENCES room_states(conversation_id)
+            )
+        """)
+        await conn.execute("""
+            INSERT INTO messages_v11 (seq, id, conversation_id, content, timestamp, sender_role)
+            SELECT rowid, id, conversation_id, content, timestamp, sender_role FROM messages
+        """)
+        await conn.execute("DROP TABLE messages")
+        await conn.execute("ALTER TABLE messages_v11 RENAME TO messages")
+        await conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='seq')")
+        await conn.execute("""
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.seq, new.content);
+            END
+        """)
+        await conn.execute("""
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.seq, old.content);
+            END
+        """)
+        await conn.execute("""
+            CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.seq, old.content);
+                INSERT INTO messages_fts (rowid, content) VALUES (new.seq, new.content);
+            END
+        """)
+        await conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    async def upgrade_v12(self, conn):
+        # Bodies sent from Matrix, so the worker owning a conversation can skip their echo even
+        # when the leader did the send; content is stored as a hash to keep the key short
+        await conn.execute("""
+            CREATE TABLE sent_messages (
+                room_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                sent_at DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (room_id, content_hash)
+            )
+        """)
+
+    async def upgrade_v13(self, conn):
+        # The failure reaction of a send that is still being retried, redacted once it goes through
+        await conn.execute("ALTER TABLE send_queue ADD COLUMN failed_reaction TEXT")
+
+    async def upgrade_v14(self, conn):
+        # Webhooks received by a worker that does not own the conversation, for the owner to handle
+        id_column = "BIGSERIAL PRIMARY KEY" if self.is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"
+        await conn.execute(f"""
+            CREATE TABLE webhook_events (
+                id {id_column},
+                account_id TEXT NOT NULL,
+                conversation_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                received_at TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+        """)
 
     async def save_message(self, conversation_id: str, message_id: str, content: str, timestamp: datetime, sender_role: str):
         async with self.db.acquire() as conn:
             await conn.execute(
-                "INSERT OR REPLACE INTO messages (id, conversation_id, content, timestamp, sender_role) VALUES (?, ?, ?, ?, ?)",
-                message_id, conversation_id, content, timestamp, sender_role
+                """
+                INSERT INTO messages (id, conversation_id, content, timestamp, sender_role) VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (id) DO UPDATE SET conversation_id = excluded.conversation_id, content = excluded.content,
+                    timestamp = excluded.timestamp, sender_role = excluded.sender_role
+                """,
+                message_id, conversation_id, content, normalize_timestamp(timestamp), sender_role
             )
 
     async def get_recent_messages(self, conversation_id: str, limit: int = 100):
         async with self.db.acquire() as conn:
             rows = await conn.fetch(
-                "SELECT id, content, timestamp, sender_role FROM messages WHERE conversation_id = ? ORDER BY timestamp DESC LIMIT ?",
+                "SELECT id, content, timestamp, sender_role FROM messages WHERE conversation_id = $1 ORDER BY timestamp DESC LIMIT $2",
                 conversation_id, limit
             )
         return [dict(row) for row in rows]
 
+    async def search_messages(self, query: str, conversation_id: str = None, limit: int = 10, offset: int = 0):
+        async with self.db.acquire() as conn:
+            if self.is_postgres:
+                sql = """
+                    SELECT id, conversation_id, content, timestamp, sender_role
+                    FROM messages, plainto_tsquery('simple', $1) query
+                    WHERE to_tsvector('simple', content) @@ query
+                """
+                args = [query]
+                if conversation_id:
+                    sql += " AND conversation_id = $2"
+                    args.append(conversation_id)
+                sql += f" ORDER BY ts_rank(to_tsvector('simple', content), query) DESC, timestamp DESC LIMIT ${len(args) + 1} OFFSET ${len(args) + 2}"
+            else:
+                # Quote every term so user input can't be parsed as FTS5 query syntax
+                match = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+                sql = """
+                    SELECT m.id, m.conversation_id, m.content, m.timestamp, m.sender_role
+                    FROM messages_fts JOIN messages m ON m.seq = messages_fts.rowid
+                    WHERE messages_fts MATCH $1
+                """
+                args = [match]
+                if conversation_id:
+                    sql += " AND m.conversation_id = $2"
+                    args.append(conversation_id)
+                sql += f" ORDER BY bm25(messages_fts), m.timestamp DESC LIMIT ${len(args) + 1} OFFSET ${len(args) + 2}"
+            rows = await conn.fetch(sql, *args, limit, offset)
+        return [dict(row) for row in rows]
+
     async def load_room_states(self):
         async with self.db.acquire() as conn:
-            rows = await conn.fetch("SELECT conversation_id, room_id, last_message, last_message_time FROM room_states")
+            rows = await conn.fetch(
+                "SELECT conversation_id, room_id, last_message, last_message_time, room_name FROM room_states WHERE left_at IS NULL"
+            )
             result = []
             for row in rows:
-                last_message_time = row['last_message_time']
-                if last_message_time and last_message_time.tzinfo is None:
-                    last_message_time = last_message_time.replace(tzinfo=timezone.utc)
                 result.append({
                     'conversation_id': row['conversation_id'],
                     'room_id': row['room_id'],
                     'last_message': row['last_message'],
-                    'last_message_time': last_message_time
+                    'last_message_time': normalize_timestamp(row['last_message_time']),
+                    'room_name': row['room_name']
                 })
             return result
 
     async def save_room_states(self, room_states):
         async with self.db.acquire() as conn:
             for conv_id, room_data in room_states.items():
-                last_message_time = room_data.get('last_message_time')
-                if isinstance(last_message_time, datetime):
-                    if last_message_time.tzinfo is None:
-                        last_message_time = last_message_time.replace(tzinfo=timezone.utc)
-                    last_message_time = last_message_time.isoformat()
-                
                 await conn.execute(
-                    "INSERT OR REPLACE INTO room_states (conversation_id, room_id, last_message, last_message_time) VALUES (?, ?, ?, ?)",
-                    conv_id, str(room_data['room_id']), room_data.get('last_message'), last_message_time
+                    """
+                    INSERT INTO room_states (conversation_id, room_id, last_message, last_message_time, room_name)
+                    VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT (conversation_id) DO UPDATE SET room_id = excluded.room_id, last_message = excluded.last_message,
+                        last_message_time = excluded.last_message_time, room_name = excluded.room_name, left_at = NULL
+                    """,
+                    conv_id, str(room_data['room_id']), room_data.get('last_message'),
+                    normalize_timestamp(room_data.get('last_message_time')), room_data.get('room_name')
                 )
 
+    async def save_room_name(self, conversation_id: str, room_name: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("UPDATE room_states SET room_name = $1 WHERE conversation_id = $2", room_name, conversation_id)
+
+    async def mark_rooms_left(self, conversation_ids, left_at: datetime):
+        if not conversation_ids:
+            return
+        async with self.db.acquire() as conn:
+            await conn.executemany(
+                "UPDATE room_states SET left_at = $1 WHERE conversation_id = $2",
+                [(normalize_timestamp(left_at), conv_id) for conv_id in conversation_ids]
+            )
+
     async def get_last_processed_message_id(self, conversation_id: str):
         async with self.db.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT id FROM messages WHERE conversation_id = ? ORDER BY timestamp DESC LIMIT 1",
+                "SELECT id FROM messages WHERE conversation_id = $1 ORDER BY timestamp DESC LIMIT 1",
                 conversation_id
             )
         return row['id'] if row else None
 
-    async def get_last_poll_time(self):
+    async def get_last_poll_time(self, poll_key: str = None):
+        # poll_key identifies a worker and/or account; rows live in worker_poll_times
         async with self.db.acquire() as conn:
-            result = await conn.fetchval("SELECT timestamp FROM last_poll_time WHERE id = 1")
+            if poll_key:
+                result = await conn.fetchval("SELECT timestamp FROM worker_poll_times WHERE worker_id = $1", poll_key)
+            else:
+                result = await conn.fetchval("SELECT timestamp FROM last_poll_time WHERE id = 1")
             if result:
-                if result.tzinfo is None:
-                    result = result.replace(tzinfo=timezone.utc)
-                return result
+                return normalize_timestamp(result)
             return datetime.min.replace(tzinfo=timezone.utc)
 
-    async def set_last_poll_time(self, timestamp):
-        if timestamp.tzinfo is None:
-            timestamp = timestamp.replace(tzinfo=timezone.utc)
+    async def set_last_poll_time(self, timestamp, poll_key: str = None):
         async with self.db.acquire() as conn:
+            if poll_key:
+                await conn.execute("""
+                    INSERT INTO worker_poll_times (worker_id, timestamp) VALUES ($1, $2)
+                    ON CONFLICT (worker_id) DO UPDATE SET timestamp = excluded.timestamp
+                """, poll_key, normalize_timestamp(timestamp))
+                return
             await conn.execute("""
-                INSERT OR REPLACE INTO last_poll_time (id, timestamp) VALUES (1, ?)
-            """, timestamp)
+                INSERT INTO last_poll_time (id, timestamp) VALUES (1, $1)
+                ON CONFLICT (id) DO UPDATE SET timestamp = excluded.timestamp
+            """, normalize_timestamp(timestamp))
 
     async def get_processed_message_ids(self, conversation_id):
         async with self.db.acquire() as conn:
-            rows = await conn.fetch("SELECT message_id FROM processed_messages WHERE conversation_id = ?", conversation_id)
+            rows = await conn.fetch("SELECT message_id FROM processed_messages WHERE conversation_id = $1", conversation_id)
             return set(row['message_id'] for row in rows)
 
     async def add_processed_message_id(self, conversation_id, message_id):
         async with self.db.acquire() as conn:
-            await conn.execute("INSERT OR IGNORE INTO processed_messages (conversation_id, message_id) VALUES (?, ?)",
+            await conn.execute("INSERT INTO processed_messages (conversation_id, message_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
                                conversation_id, message_id)
 
     async def save_puppet_data(self, user_id: str, puppet_data: str):
         async with self.db.acquire() as conn:
             await conn.execute(
-                "INSERT OR REPLACE INTO puppets (user_id, puppet_data) VALUES (?, ?)",
+                """
+                INSERT INTO puppets (user_id, puppet_data) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET puppet_data = excluded.puppet_data
+                """,
                 user_id, puppet_data
             )
 
@@ -169,3 +475,233 @@ class HostexDatabase:
         async with self.db.acquire() as conn:
             rows = await conn.fetch("SELECT user_id, puppet_data FROM puppets")
             return [(row['user_id'], row['puppet_data']) for row in rows]
+
+    async def record_worker_heartbeat(self, worker_id: str, timestamp: datetime):
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO worker_heartbeats (worker_id, last_heartbeat) VALUES ($1, $2)
+                ON CONFLICT (worker_id) DO UPDATE SET last_heartbeat = excluded.last_heartbeat
+            """, worker_id, normalize_timestamp(timestamp))
+
+    async def get_live_workers(self, cutoff: datetime):
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT worker_id FROM worker_heartbeats WHERE last_heartbeat >= $1",
+                                    normalize_timestamp(cutoff))
+            return [row['worker_id'] for row in rows]
+
+    async def acquire_lease(self, name: str, worker_id: str, expires_at: datetime, now: datetime):
+        # Takes or renews the lease if it is ours or has expired, then returns the current holder.
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO worker_leases (name, worker_id, expires_at) VALUES ($1, $2, $3)
+                ON CONFLICT (name) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at
+                WHERE worker_leases.worker_id = excluded.worker_id OR worker_leases.expires_at < $4
+            """, name, worker_id, normalize_timestamp(expires_at), normalize_timestamp(now))
+            return await conn.fetchval("SELECT worker_id FROM worker_leases WHERE name = $1", name)
+
+    async def remove_worker(self, worker_id: str, *lease_names: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM worker_heartbeats WHERE worker_id = $1", worker_id)
+            for name in lease_names:
+                await conn.execute("DELETE FROM worker_leases WHERE name = $1 AND worker_id = $2", name, worker_id)
+
+    async def enqueue_outbox_message(self, conversation_id: str, message_id: str, payload: dict):
+        # Marking the message as processed and queueing it happen atomically, so a fetched
+        # message is either waiting in the outbox or was never seen.
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO outbox (conversation_id, message_id, payload, enqueued_at) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT DO NOTHING
+                """, conversation_id, message_id, hostex_json.dumps(payload), datetime.now(timezone.utc))
+                await conn.execute("INSERT INTO processed_messages (conversation_id, message_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                                   conversation_id, message_id)
+
+    async def get_pending_outbox_messages(self):
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT conversation_id, message_id, payload, attempts FROM outbox ORDER BY enqueued_at")
+            return [
+                {
+                    'conversation_id': row['conversation_id'],
+                    'message_id': row['message_id'],
+                    'payload': hostex_json.loads(row['payload']),
+                    'attempts': row['attempts'],
+                }
+                for row in rows
+            ]
+
+    async def delete_outbox_message(self, conversation_id: str, message_id: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM outbox WHERE conversation_id = $1 AND message_id = $2", conversation_id, message_id)
+
+    async def record_outbox_failure(self, conversation_id: str, message_id: str, error: str):
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = $3 WHERE conversation_id = $1 AND message_id = $2",
+                conversation_id, message_id, error
+            )
+
+    async def enqueue_send(self, event_id: str, conversation_id: str, room_id: str, body: str, sent_at: float):
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO send_queue (event_id, conversation_id, room_id, body, sent_at) VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (event_id) DO NOTHING
+            """, event_id, conversation_id, room_id, body, sent_at)
+
+    async def get_pending_sends(self):
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT event_id, conversation_id, room_id, body, sent_at, attempts, failed_reaction FROM send_queue ORDER BY id"
+            )
+            return [dict(row) for row in rows]
+
+    async def delete_send(self, event_id: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM send_queue WHERE event_id = $1", event_id)
+
+    async def record_send_failure(self, event_id: str, error: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("UPDATE send_queue SET attempts = attempts + 1, last_error = $2 WHERE event_id = $1", event_id, error)
+
+    async def record_sent_message(self, room_id: str, content_hash: str, sent_at: float):
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO sent_messages (room_id, content_hash, sent_at) VALUES ($1, $2, $3)
+                ON CONFLICT (room_id, content_hash) DO UPDATE SET sent_at = excluded.sent_at
+            """, room_id, content_hash, sent_at)
+
+    async def was_sent_since(self, room_id: str, content_hash: str, since: float) -> bool:
+        async with self.db.acquire() as conn:
+            sent_at = await conn.fetchval(
+                "SELECT sent_at FROM sent_messages WHERE room_id = $1 AND content_hash = $2", room_id, content_hash
+            )
+            return sent_at is not None and sent_at >= since
+
+    async def delete_sent_messages(self, before: float):
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM sent_messages WHERE sent_at < $1", before)
+
+    async def set_send_failed_reaction(self, event_id: str, reaction_id: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("UPDATE send_queue SET failed_reaction = $2 WHERE event_id = $1", event_id, reaction_id)
+
+    async def stage_webhook_event(self, account_id: str, conversation_id: str, payload: dict):
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO webhook_events (account_id, conversation_id, payload, received_at) VALUES ($1, $2, $3, $4)",
+                account_id, conversation_id, hostex_json.dumps(payload), datetime.now(timezone.utc)
+            )
+
+    async def get_staged_webhook_events(self):
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT id, account_id, conversation_id, payload FROM webhook_events ORDER BY id")
+            return [
+                {
+                    'id': row['id'],
+                    'account_id': row['account_id'],
+                    'conversation_id': row['conversation_id'],
+                    'payload': hostex_json.loads(row['payload']),
+                }
+                for row in rows
+            ]
+
+    async def delete_webhook_events(self, event_ids):
+        if not event_ids:
+            return
+        async with self.db.acquire() as conn:
+            await conn.executemany("DELETE FROM webhook_events WHERE id = $1", [(event_id,) for event_id in event_ids])
+
+    async def get_setting(self, key: str, default: str = None):
+        async with self.db.acquire() as conn:
+            value = await conn.fetchval("SELECT value FROM bridge_settings WHERE key = $1", key)
+            return default if value is None else value
+
+    async def set_setting(self, key: str, value: str):
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO bridge_settings (key, value) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """, key, value)
+
+    async def save_job(self, job):
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO jobs (id, name, status, result, created_at, finished_at) VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (id) DO UPDATE SET status = excluded.status, result = excluded.result, finished_at = excluded.finished_at
+            """, job.id, job.name, job.status, job.result, normalize_timestamp(job.created_at), normalize_timestamp(job.finished_at))
+
+    async def mark_interrupted_jobs(self):
+        async with self.db.acquire() as conn:
+            await conn.execute("UPDATE jobs SET status = 'interrupted' WHERE status IN ('queued', 'running')")
+
+    async def get_recent_jobs(self, limit: int = 10):
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT id, name, status, result FROM jobs ORDER BY created_at DESC LIMIT $1", limit)
+            return [dict(row) for row in rows]
+
+    async def get_media_by_url(self, url: str):
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT c.content_hash, c.mxc, c.mime_type, c.size, c.info FROM media_sources s
+                JOIN media_cache c ON c.content_hash = s.content_hash WHERE s.url = $1
+            """, url)
+            return self._media_row(row)
+
+    async def get_media_by_hash(self, content_hash: str):
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT content_hash, mxc, mime_type, size, info FROM media_cache WHERE content_hash = $1", content_hash
+            )
+            return self._media_row(row)
+
+    @staticmethod
+    def _media_row(row):
+        if not row:
+            return None
+        media = dict(row)
+        media['info'] = hostex_json.loads(media['info']) if media['info'] else {}
+        return media
+
+    async def save_media(self, content_hash: str, url: str, mxc: str, mime_type: str, size: int, info: dict):
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO media_cache (content_hash, mxc, mime_type, size, info, created_at) VALUES ($1, $2, $3, $4, $5, $6)
+                    ON CONFLICT (content_hash) DO NOTHING
+                """, content_hash, mxc, mime_type, size, hostex_json.dumps(info), datetime.now(timezone.utc))
+                await self._save_media_source(conn, url, content_hash)
+
+    async def add_media_source(self, url: str, content_hash: str):
+        async with self.db.acquire() as conn:
+            await self._save_media_source(conn, url, content_hash)
+
+    @staticmethod
+    async def _save_media_source(conn, url: str, content_hash: str):
+        await conn.execute("""
+            INSERT INTO media_sources (url, content_hash) VALUES ($1, $2)
+            ON CONFLICT (url) DO UPDATE SET content_hash = excluded.content_hash
+        """, url, content_hash)
+
+    async def load_conversation_details(self):
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT conversation_id, last_message_at, reservation_code, details, topic FROM conversation_details")
+            return {
+                row['conversation_id']: {
+                    'last_message_at': row['last_message_at'],
+                    'reservation_code': row['reservation_code'],
+                    'details': hostex_json.loads(row['details']),
+                    'topic': row['topic'],
+                }
+                for row in rows
+            }
+
+    async def save_conversation_details(self, conversation_id: str, entry: dict):
+        async with self.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO conversation_details (conversation_id, last_message_at, reservation_code, details, topic, updated_at)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (conversation_id) DO UPDATE SET
+                    last_message_at = excluded.last_message_at, reservation_code = excluded.reservation_code,
+                    details = excluded.details, topic = excluded.topic, updated_at = excluded.updated_at
+            """, conversation_id, entry['last_message_at'], entry['reservation_code'],
+                hostex_json.dumps(entry['details']), entry['topic'], datetime.now(timezone.utc))
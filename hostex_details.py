@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+def first_value(*sources, keys):
+    for source in sources:
+        for key in keys:
+            value = source.get(key) if isinstance(source, dict) else None
+            if value not in (None, ""):
+                return value
+    return None
+
+# Guest and reservation details per bridged conversation, shown in the room topic. Details are
+# refetched only when Hostex reports a new last_message_at for the conversation, and the
+# reservation endpoint is only hit when the conversation points at a different reservation.
+# The topic is set only when its text changed. Everything is persisted so a restart does not
+# refetch or republish anything.
+class HostexDetailsCache:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.concurrency = bridge.config.get("hostex.details.concurrency", 5)
+        self.entries = {}
+        self.refresh_task = None
+        self.pending = {}
+
+    async def start(self):
+        self.entries = await self.bridge.database.load_conversation_details()
+
+    async def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+
+    def forget(self, conversation_id: str):
+        # A new room for the conversation needs its topic published again
+        self.entries.pop(conversation_id, None)
+
+    def get(self, conversation_id: str) -> dict:
+        entry = self.entries.get(conversation_id)
+        return entry['details'] if entry else {}
+
+    def is_stale(self, conv: dict) -> bool:
+        entry = self.entries.get(conv['id'])
+        return not entry or entry['last_message_at'] != conv.get('last_message_at')
+
+    def schedule_refresh(self, conversations: list):
+        # Queue stale bridged conversations; one background task works through them in batches
+        for conv in conversations:
+            conv_id = conv['id']
+            if conv_id in self.bridge.conversation_rooms and self.bridge.shards.owns(conv_id) and self.is_stale(conv):
+                self.pending[conv_id] = conv
+        if self.pending and (not self.refresh_task or self.refresh_task.done()):
+            self.refresh_task = asyncio.create_task(self.refresh_pending())
+
+    async def refresh_pending(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh(conv):
+            async with semaphore:
+                try:
+                    data = await self.bridge.api_for(conv['id']).get_conversation(conv['id'], limit=1)
+                    await self.observe(conv, data)
+                except Exception as e:
+                    self.bridge.log.warning(f"Failed to refresh details for conversation {conv['id']}: {e}")
+
+        while self.pending:
+            batch, self.pending = list(self.pending.values()), {}
+            await asyncio.gather(*(refresh(conv) for conv in batch))
+
+    async def observe(self, conv: dict, data: dict):
+        # Called with a conversation response the bridge already fetched, so polling gets details for free
+        conv_id = conv['id']
+        self.pending.pop(conv_id, None)
+        entry = self.entries.get(conv_id) or {'last_message_at': None, 'reservation_code': None, 'details': {}, 'topic': None}
+        guest = data.get('guest') or conv.get('guest') or {}
+        activities = data.get('activities') or []
+        activity = next((item for item in activities if isinstance(item, dict) and item.get('reservation_code')), {})
+        reservation_code = activity.get('reservation_code') or (data.get('reservation') or {}).get('reservation_code')
+
+        reservation = entry['details'].get('reservation') or {}
+        if reservation_code and reservation_code != entry['reservation_code']:
+            reservation = await self.bridge.api_for(conv_id).get_reservation(reservation_code) or {}
+
+        details = {
+            'guest_name': first_value(guest, keys=('name',)),
+            'guest_phone': first_value(guest, keys=('phone',)),
+            'guest_email': first_value(guest, keys=('email',)),
+            'guest_avatar': first_value(guest, keys=('avatar', 'avatar_url')),
+            'reservation_code': reservation_code,
+            'property': first_value(reservation.get('property') or {}, reservation, activity, keys=('title', 'property_title')),
+            'check_in_date': first_value(reservation, activity, keys=('check_in_date',)),
+            'check_out_date': first_value(reservation, activity, keys=('check_out_date',)),
+            'guests': first_value(reservation, activity, keys=('number_of_guests',)),
+            'status': first_value(reservation, activity, keys=('status',)),
+            'reservation': reservation,
+        }
+        entry = {
+            'last_message_at': conv.get('last_message_at'),
+            # Only remember the code once its reservation was fetched, so a failed lookup is retried
+            'reservation_code': reservation_code if reservation else None,
+            'details': details,
+            'topic': entry['topic'],
+        }
+        topic = self.topic_for(details)
+        if topic and topic != entry['topic'] and await self.publish_topic(conv_id, topic):
+            entry['topic'] = topic
+        self.entries[conv_id] = entry
+        await self.bridge.database.save_conversation_details(conv_id, entry)
+
+    @staticmethod
+    def topic_for(details: dict) -> str:
+        parts = []
+        if details.get('property'):
+            parts.append(str(details['property']))
+        if details.get('check_in_date') or details.get('check_out_date'):
+            parts.append(f"{details.get('check_in_date') or '?'} → {details.get('check_out_date') or '?'}")
+        if details.get('guests'):
+            parts.append(f"{details['guests']} guest(s)")
+        if details.get('status'):
+            parts.append(str(details['status']))
+        if details.get('reservation_code'):
+            parts.append(f"Reservation {details['reservation_code']}")
+        if details.get('guest_phone'):
+            parts.append(f"Phone {details['guest_phone']}")
+        return " | ".join(parts)
+
+    async def publish_topic(self, conversation_id: str, topic: str) -> bool:
+        room_data = self.bridge.conversation_rooms.get(conversation_id)
+        if not room_data:
+            return False
+        try:
+            await self.bridge.room_manager.homeserver_limiter.acquire()
+            await self.bridge.puppet_intent.set_room_topic(room_data['room_id'], topic)
+            self.bridge.log.info(f"Updated topic for conversation {conversation_id}")
+            return True
+        except Exception as e:
+            self.bridge.log.error(f"Failed to set topic for conversation {conversation_id}: {e}")
+            return False
@@ -0,0 +1,117 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Min-heap of room expiry deadlines keyed on last_message_time. Deadlines are pushed as
+# messages flow; superseded heap entries are skipped lazily when they reach the top. A
+# background task sleeps until the earliest deadline and leaves the rooms that aged out.
+class HostexRoomExpiry:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.concurrency = bridge.config.get("bridge.maintenance_concurrency", 5)
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.expiry_loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    @property
+    def max_age(self) -> timedelta:
+        return timedelta(days=self.bridge.performance.active_window_days)
+
+    def reschedule(self):
+        # The active window changed; recompute every deadline from the rooms' last message times
+        self.heap = []
+        self.deadlines = {}
+        for conv_id, room_data in self.bridge.conversation_rooms.items():
+            self.touch(conv_id, room_data.get('last_message_time'))
+        self.wakeup.set()
+
+    def touch(self, conv_id: str, last_message_time: datetime):
+        if not last_message_time:
+            return
+        if last_message_time.tzinfo is None:
+            last_message_time = last_message_time.replace(tzinfo=timezone.utc)
+        deadline = (last_message_time + self.max_age).timestamp()
+        if self.deadlines.get(conv_id) == deadline:
+            return
+        self.deadlines[conv_id] = deadline
+        heapq.heappush(self.heap, (deadline, conv_id))
+        if self.heap[0][1] == conv_id:
+            self.wakeup.set()
+
+    def forget(self, conv_id: str):
+        # The stale heap entry is dropped when it reaches the top
+        self.deadlines.pop(conv_id, None)
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, conv_id = heapq.heappop(self.heap)
+            if self.deadlines.get(conv_id) != deadline:
+                continue
+            del self.deadlines[conv_id]
+            if conv_id in self.bridge.conversation_rooms and self.bridge.shards.owns(conv_id):
+                due.append(conv_id)
+        return due
+
+    def next_deadline(self):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    async def expiry_loop(self):
+        while True:
+            try:
+                self.wakeup.clear()
+                next_deadline = self.next_deadline()
+                timeout = None if next_deadline is None else max(0, next_deadline - time.time())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                await self.expire_due()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error in room expiry loop: {e}", exc_info=True)
+                await asyncio.sleep(60)
+
+    async def expire_due(self) -> int:
+        due = self._pop_due(time.time())
+        if not due:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def leave(conv_id):
+            room_id = self.bridge.conversation_rooms[conv_id]['room_id']
+            async with semaphore:
+                try:
+                    await self.bridge.puppet_intent.leave_room(room_id)
+                    self.bridge.log.info(f"Left room {room_id} for old conversation {conv_id}")
+                except Exception as e:
+                    self.bridge.log.error(f"Error leaving room {room_id} for conversation {conv_id}: {str(e)}")
+                    # Try again in a day
+                    self.touch(conv_id, datetime.now(timezone.utc) - self.max_age + timedelta(days=1))
+                    return None
+            del self.bridge.conversation_rooms[conv_id]
+            self.bridge.room_manager.puppet_rooms.discard(room_id)
+            self.bridge.latency.forget(conv_id)
+            return conv_id
+
+        left = [conv_id for conv_id in await asyncio.gather(*(leave(conv_id) for conv_id in due)) if conv_id]
+        await self.bridge.database.mark_rooms_left(left, datetime.now(timezone.utc))
+        return len(left)
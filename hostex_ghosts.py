@@ -0,0 +1,88 @@
+import logging
+
+from mautrix.appservice import IntentAPI
+from mautrix.types import UserID
+
+import hostex_json
+
+logger = logging.getLogger(__name__)
+
+def escape_localpart(value: str) -> str:
+    # Matrix user ID escaping: uppercase becomes _x, underscore is doubled, anything else outside [a-z0-9.=-/] is =xx
+    escaped = []
+    for char in value:
+        if char == "_":
+            escaped.append("__")
+        elif "A" <= char <= "Z":
+            escaped.append(f"_{char.lower()}")
+        elif char.isascii() and (char.isdigit() or "a" <= char <= "z" or char in ".=-/"):
+            escaped.append(char)
+        else:
+            escaped.append("".join(f"={byte:02x}" for byte in char.encode("utf-8")))
+    return "".join(escaped)
+
+# One ghost Matrix user per Hostex guest, named after bridge.username_template. Intents are
+# created on first use and kept, and each ghost's profile (registration, display name, avatar)
+# is cached in the puppets table so the homeserver is only called when something changed.
+class HostexGhostManager:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.enabled = bool(bridge.config.get("bridge.ghosts.enabled", False))
+        self.intents = {}
+        self.profiles = {}
+
+    async def start(self):
+        if not self.enabled:
+            return
+        for user_id, puppet_data in await self.bridge.database.get_all_puppets():
+            try:
+                self.profiles[user_id] = hostex_json.loads(puppet_data)
+            except hostex_json.DecodeError:
+                self.bridge.log.warning(f"Ignoring unreadable profile cache for {user_id}")
+
+    def mxid_for(self, conversation_id: str) -> UserID:
+        # Hostex has no stable guest ID in the conversation list; a conversation has exactly one guest
+        return self.bridge.get_mxid_from_id(escape_localpart(conversation_id))
+
+    def is_ghost(self, user_id: str) -> bool:
+        return self.enabled and self.bridge.mxid_template.parse(user_id) is not None
+
+    def intent_for(self, user_id: UserID) -> IntentAPI:
+        intent = self.intents.get(user_id)
+        if intent is None:
+            intent = self.intents[user_id] = self.bridge.appservice.intent.user(user_id)
+        return intent
+
+    def guest_profile(self, conversation_id: str) -> tuple:
+        details = self.bridge.details.get(conversation_id)
+        status_entry = self.bridge.status.conversations.get(conversation_id) or {}
+        name = status_entry.get('name') or details.get('guest_name') or "Unknown Guest"
+        return name, details.get('guest_avatar')
+
+    async def get_intent(self, conversation_id: str) -> IntentAPI:
+        user_id = self.mxid_for(conversation_id)
+        intent = self.intent_for(user_id)
+        name, avatar_source = self.guest_profile(conversation_id)
+        await self.sync_profile(user_id, intent, name, avatar_source)
+        return intent
+
+    async def sync_profile(self, user_id: UserID, intent: IntentAPI, name: str, avatar_source: str = None):
+        profile = self.profiles.get(user_id, {})
+        changed = dict(profile)
+        if not profile.get('registered'):
+            await intent.ensure_registered()
+            changed['registered'] = True
+        if profile.get('displayname') != name:
+            await intent.set_displayname(name)
+            changed['displayname'] = name
+        if avatar_source and profile.get('avatar_source') != avatar_source:
+            try:
+                media = await self.bridge.media.transfer({'url': avatar_source})
+                await intent.set_avatar_url(media['mxc'])
+                changed['avatar_source'] = avatar_source
+                changed['avatar_url'] = media['mxc']
+            except Exception as e:
+                self.bridge.log.warning(f"Failed to update avatar of {user_id}: {e}")
+        if changed != profile:
+            self.profiles[user_id] = changed
+            await self.bridge.database.save_puppet_data(user_id, hostex_json.dumps(changed))
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+
+from mautrix.types import TextMessageEventContent, MessageType
+
+logger = logging.getLogger(__name__)
+
+class HostexJob:
+    def __init__(self, runner, name: str, room_id):
+        self.runner = runner
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.room_id = room_id
+        self.status = "queued"
+        self.progress_text = "Queued"
+        self.result = None
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at = None
+        self.task = None
+        self.event_id = None
+        self.last_edit = 0
+
+    async def progress(self, text: str, force: bool = False):
+        self.progress_text = text
+        # Edits are throttled so a job touching many rooms doesn't flood the admin room
+        if force or time.monotonic() - self.last_edit >= self.runner.edit_interval:
+            await self.runner.update_status_message(self)
+
+    def describe(self) -> str:
+        return f"[{self.id}] {self.name}: {self.status} - {self.result or self.progress_text}"
+
+# Runs long admin commands as cancellable background tasks so they never hold up the
+# websocket callback. Each job keeps a single status message in the admin room that is
+# edited as it progresses; finished jobs are stored in the jobs table.
+class HostexJobRunner:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.semaphore = asyncio.Semaphore(bridge.config.get("bridge.jobs.concurrency", 2))
+        self.edit_interval = bridge.config.get("bridge.jobs.edit_interval", 2)
+        self.jobs = {}
+
+    async def start(self):
+        await self.bridge.database.mark_interrupted_jobs()
+
+    async def stop(self):
+        tasks = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        # Let the jobs record their cancellation before the database closes
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, name: str, room_id, func) -> HostexJob:
+        job = HostexJob(self, name, room_id)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, func))
+        return job
+
+    async def _run(self, job: HostexJob, func):
+        await self.update_status_message(job)
+        try:
+            async with self.semaphore:
+                job.status = "running"
+                await self.bridge.database.save_job(job)
+                await job.progress("Started", force=True)
+                job.result = await func(job)
+                job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            self.bridge.log.error(f"Job {job.id} ({job.name}) failed: {e}", exc_info=True)
+            job.status = "failed"
+            job.result = str(e)
+        finally:
+            job.finished_at = datetime.now(timezone.utc)
+            try:
+                await self.bridge.database.save_job(job)
+                await self.update_status_message(job)
+            except Exception as e:
+                self.bridge.log.error(f"Failed to record result of job {job.id}: {e}")
+            self.jobs.pop(job.id, None)
+
+    async def update_status_message(self, job: HostexJob):
+        content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=job.describe())
+        if job.event_id:
+            content.set_edit(job.event_id)
+        try:
+            event_id = await self.bridge.puppet_intent.send_message(job.room_id, content)
+            if not job.event_id:
+                job.event_id = event_id
+            job.last_edit = time.monotonic()
+        except Exception as e:
+            self.bridge.log.warning(f"Failed to update status message for job {job.id}: {e}")
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if not job or not job.task or job.task.done():
+            return False
+        job.task.cancel()
+        return True
+
+    async def describe_jobs(self, limit: int = 10) -> str:
+        lines = [job.describe() for job in self.jobs.values()]
+        for row in await self.bridge.database.get_recent_jobs(limit):
+            if row['id'] not in self.jobs:
+                lines.append(f"[{row['id']}] {row['name']}: {row['status']} - {row['result'] or ''}")
+        return "\n".join(lines) if lines else "No jobs."
@@ -0,0 +1,53 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# One JSON codec for Hostex REST responses, webhooks and appservice websocket traffic.
+# Uses orjson or msgspec when installed, otherwise the stdlib json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Exception types raised by loads() for malformed input
+DecodeError = (ValueError,)
+
+if orjson is not None:
+    backend = "orjson"
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+elif msgspec is not None:
+    backend = "msgspec"
+    DecodeError = (ValueError, msgspec.DecodeError)
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return _decoder.decode(data)
+
+    def dumps(obj) -> str:
+        return _encoder.encode(obj).decode("utf-8")
+
+else:
+    backend = "json"
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+logger.debug(f"Using {backend} for JSON encoding")
@@ -0,0 +1,67 @@
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Stages of a message's trip through the bridge:
+#   hostex_to_fetch  - Hostex created_at until the poller or webhook fetched it
+#   fetch_to_matrix  - fetched until the Matrix send completed
+#   matrix_to_hostex - Matrix event timestamp until Hostex answered send_message
+STAGES = ("hostex_to_fetch", "fetch_to_matrix", "matrix_to_hostex")
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {name: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for name, fraction in PERCENTILES}
+
+# Rolling latency samples per conversation and stage, plus a bridge-wide window per stage.
+# Only the most recent samples are kept so memory stays bounded however long the bridge runs.
+class HostexLatencyTracker:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.window = bridge.config.get("bridge.latency.window", 200)
+        self.overall = {stage: deque(maxlen=self.window * 10) for stage in STAGES}
+        self.conversations = {}
+
+    def record(self, conversation_id: str, stage: str, seconds: float):
+        seconds = max(0.0, seconds)
+        self.overall[stage].append(seconds)
+        stages = self.conversations.get(conversation_id)
+        if stages is None:
+            stages = self.conversations[conversation_id] = {stage: deque(maxlen=self.window) for stage in STAGES}
+        stages[stage].append(seconds)
+
+    def forget(self, conversation_id: str):
+        self.conversations.pop(conversation_id, None)
+
+    @staticmethod
+    def _format_stage(stage: str, samples) -> str:
+        stats = percentiles(samples)
+        if not stats:
+            return f"{stage}: no samples"
+        return f"{stage}: " + ", ".join(f"{name} {value:.2f}s" for name, value in stats.items()) + f" (n={len(samples)})"
+
+    def report(self, conversation_id: str = None, slowest: int = 5) -> str:
+        if conversation_id:
+            stages = self.conversations.get(conversation_id)
+            if not stages:
+                return f"No latency samples for conversation {conversation_id}."
+            return "\n".join([f"Latency for conversation {conversation_id}:"] + [self._format_stage(stage, stages[stage]) for stage in STAGES])
+
+        lines = ["Latency across all conversations:"] + [self._format_stage(stage, self.overall[stage]) for stage in STAGES]
+        # Rank conversations by their worst p95 to show where to look first
+        ranked = []
+        for conv_id, stages in self.conversations.items():
+            worst = max(((percentiles(samples).get("p95", 0), stage) for stage, samples in stages.items()), default=(0, None))
+            if worst[1]:
+                ranked.append((worst[0], worst[1], conv_id))
+        ranked.sort(reverse=True)
+        if ranked:
+            lines.append("")
+            lines.append("Slowest conversations (worst p95):")
+            for p95, stage, conv_id in ranked[:slowest]:
+                name = self.bridge.conversation_rooms.get(conv_id, {}).get('room_name') or conv_id
+                lines.append(f"{name} ({conv_id}): {stage} {p95:.2f}s")
+        return "\n".join(lines)
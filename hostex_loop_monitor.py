@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Opt-in event loop health monitor. A task on the loop measures how late its sleeps wake
+# up (scheduling lag) and keeps a rolling window for percentiles. A watchdog thread notices
+# when the loop stops ticking for longer than block_threshold and logs the stack of the loop
+# thread, which points at the callback that is blocking it.
+class LoopLagMonitor:
+    def __init__(self, config):
+        self.enabled = bool(config.get("bridge.loop_monitor.enabled", False))
+        self.interval = config.get("bridge.loop_monitor.interval", 0.5)
+        self.block_threshold = config.get("bridge.loop_monitor.block_threshold", 1.0)
+        self.samples = deque(maxlen=config.get("bridge.loop_monitor.window", 1200))
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    async def start(self):
+        if not self.enabled or self.task:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self.sample_loop())
+        self.watchdog = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+        logger.info(f"Event loop monitor started (block threshold {self.block_threshold}s)")
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def sample_loop(self):
+        while True:
+            try:
+                started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self.samples.append(max(0.0, now - started - self.interval))
+                self.last_tick = now
+            except asyncio.CancelledError:
+                break
+
+    def watch(self):
+        reported_tick = None
+        while not self.stopped.wait(self.block_threshold / 2):
+            last_tick = self.last_tick
+            blocked_for = time.monotonic() - last_tick
+            if blocked_for < self.block_threshold + self.interval or reported_tick == last_tick:
+                continue
+            # Report each stall once
+            reported_tick = last_tick
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+            logger.warning(f"Event loop blocked for {blocked_for:.2f}s, loop thread stack:\n{stack}")
+
+    def percentiles(self) -> dict:
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+
+        def pick(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1]}
+
+    def summary(self) -> str:
+        stats = self.percentiles()
+        if not stats:
+            return "Loop lag: not monitored" if not self.enabled else "Loop lag: no samples yet"
+        return "Loop lag: " + ", ".join(f"{name} {value * 1000:.1f}ms" for name, value in stats.items())
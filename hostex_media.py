@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import io
+import logging
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+import aiohttp
+from mautrix.types import MediaMessageEventContent, MessageType, ImageInfo, FileInfo
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+SNIFF_SIZE = 8192
+
+class MediaTooLarge(Exception):
+    pass
+
+def attachments_of(message: dict) -> list:
+    # Hostex sends either a single attachment object or a list; normalise to a list of dicts with a url
+    attachments = message.get('attachments') or message.get('attachment') or []
+    if isinstance(attachments, dict):
+        attachments = [attachments]
+    result = []
+    for attachment in attachments:
+        if isinstance(attachment, str):
+            attachment = {'url': attachment}
+        if isinstance(attachment, dict) and attachment.get('url'):
+            result.append(attachment)
+    return result
+
+def msgtype_for(mime_type: str) -> MessageType:
+    if mime_type.startswith("image/"):
+        return MessageType.IMAGE
+    if mime_type.startswith("video/"):
+        return MessageType.VIDEO
+    if mime_type.startswith("audio/"):
+        return MessageType.AUDIO
+    return MessageType.FILE
+
+def make_thumbnail(path: str, max_dimension: int):
+    # Runs in a worker process: decodes the image, applies EXIF rotation and re-encodes a JPEG thumbnail
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        width, height = image.size
+        if width <= max_dimension and height <= max_dimension:
+            return width, height, None
+        image.thumbnail((max_dimension, max_dimension))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        return width, height, (image.size[0], image.size[1], buffer.getvalue())
+
+# Moves Hostex attachments into the Matrix media repository, uploading each distinct file once.
+# Downloads run on the bridge's pooled HTTP session and are spooled to a temporary file while
+# being hashed, so memory use does not grow with file size. The SHA-256 of the content keys the
+# media_cache table; a known hash (or a known Hostex URL) reuses the existing mxc:// URI instead
+# of uploading again. Image decoding and thumbnailing run in a process pool.
+class HostexMediaTransfer:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.semaphore = asyncio.Semaphore(bridge.config.get("hostex.media.concurrency", 3))
+        self.max_size = bridge.config.get("hostex.media.max_size", 50 * 1024 * 1024)
+        self.max_attempts = bridge.config.get("hostex.media.max_attempts", 3)
+        self.retry_delay = bridge.config.get("hostex.media.retry_delay", 2)
+        self.resume_attempts = bridge.config.get("hostex.media.resume_attempts", 3)
+        self.temp_dir = bridge.config.get("hostex.media.temp_dir", None)
+        self.thumbnail_size = bridge.config.get("hostex.media.thumbnail_size", 800)
+        self.thumbnail_workers = bridge.config.get("hostex.media.thumbnail_workers", None)
+        self.executor = None
+
+    async def stop(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        return self.bridge.http_session
+
+    @staticmethod
+    def filename_for(attachment: dict) -> str:
+        name = attachment.get('name') or attachment.get('file_name')
+        if not name:
+            name = os.path.basename(urlparse(attachment['url']).path) or "attachment"
+        return name
+
+    @staticmethod
+    def sniff_mime_type(head: bytes, filename: str, declared: str = None) -> str:
+        if magic is not None and head:
+            try:
+                return magic.from_buffer(head, mime=True)
+            except Exception as e:
+                logger.debug(f"MIME sniffing failed for {filename}: {e}")
+        if declared and declared != "application/octet-stream":
+            return declared.split(";")[0].strip()
+        return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    async def _download(self, url: str, file) -> tuple:
+        # Writes the body to file and returns (sha256 hex, size, head, declared content type).
+        # A dropped connection is resumed with a Range request.
+        digest = hashlib.sha256()
+        received = 0
+        head = b""
+        resumes = 0
+        response = await self._session().get(url)
+        try:
+            if response.status >= 400:
+                raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                  status=response.status, message=response.reason)
+            total = response.content_length
+            declared = response.headers.get("Content-Type")
+            if total and total > self.max_size:
+                raise MediaTooLarge(f"{url} is {total} bytes, limit is {self.max_size}")
+            while True:
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        received += len(chunk)
+                        if received > self.max_size:
+                            raise MediaTooLarge(f"{url} exceeds {self.max_size} bytes")
+                        if len(head) < SNIFF_SIZE:
+                            head += chunk[:SNIFF_SIZE - len(head)]
+                        digest.update(chunk)
+                        # Disk writes go to a thread so a slow temp directory doesn't stall the event loop
+                        await asyncio.to_thread(file.write, chunk)
+                    break
+                except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if not total or received >= total or resumes >= self.resume_attempts:
+                        raise
+                    resumes += 1
+                    self.bridge.log.warning(f"Download of {url} interrupted at {received}/{total} bytes ({e}), resuming")
+                    response.release()
+                    response = await self._session().get(url, headers={"Range": f"bytes={received}-"})
+                    if response.status != 206:
+                        raise aiohttp.ClientPayloadError(f"Server did not honour range request for {url} (HTTP {response.status})")
+        finally:
+            response.release()
+        await asyncio.to_thread(file.flush)
+        return digest.hexdigest(), received, head, declared
+
+    @staticmethod
+    async def _read_chunks(path: str):
+        file = await asyncio.to_thread(open, path, "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(file.read, CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            await asyncio.to_thread(file.close)
+
+    async def _image_info(self, path: str, info: dict) -> dict:
+        if Image is None:
+            return info
+        if not self.executor:
+            # spawn rather than fork: the bridge process has threads (aiosqlite, loop watchdog)
+            self.executor = ProcessPoolExecutor(max_workers=self.thumbnail_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        try:
+            width, height, thumbnail = await asyncio.get_running_loop().run_in_executor(
+                self.executor, make_thumbnail, path, self.thumbnail_size
+            )
+        except Exception as e:
+            self.bridge.log.warning(f"Failed to decode image {path}: {e}")
+            return info
+        info.update(w=width, h=height)
+        if thumbnail:
+            thumb_width, thumb_height, data = thumbnail
+            info['thumbnail_url'] = await self.bridge.puppet_intent.upload_media(data, mime_type="image/jpeg", filename="thumbnail.jpg")
+            info['thumbnail_info'] = {"mimetype": "image/jpeg", "size": len(data), "w": thumb_width, "h": thumb_height}
+        return info
+
+    async def _transfer_once(self, url: str, filename: str) -> dict:
+        with tempfile.NamedTemporaryFile(dir=self.temp_dir, prefix="hostex-media-") as file:
+            content_hash, size, head, declared = await self._download(url, file)
+            cached = await self.bridge.database.get_media_by_hash(content_hash)
+            if cached:
+                await self.bridge.database.add_media_source(url, content_hash)
+                self.bridge.log.debug(f"Reusing {cached['mxc']} for {url} (same content)")
+                return cached
+            mime_type = self.sniff_mime_type(head, filename, declared)
+            mxc = await self.bridge.puppet_intent.upload_media(
+                self._read_chunks(file.name), mime_type=mime_type, filename=filename, size=size
+            )
+            info = {"mimetype": mime_type, "size": size}
+            if mime_type.startswith("image/"):
+                info = await self._image_info(file.name, info)
+        await self.bridge.database.save_media(content_hash, url, mxc, mime_type, size, info)
+        self.bridge.log.info(f"Uploaded attachment {filename} ({size} bytes, {mime_type}) as {mxc}")
+        return {"content_hash": content_hash, "mxc": mxc, "mime_type": mime_type, "size": size, "info": info}
+
+    async def transfer(self, attachment: dict) -> dict:
+        url = attachment['url']
+        cached = await self.bridge.database.get_media_by_url(url)
+        if cached:
+            return cached
+        filename = self.filename_for(attachment)
+        async with self.semaphore:
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    return await self._transfer_once(url, filename)
+                except MediaTooLarge:
+                    raise
+                except Exception as e:
+                    if attempt >= self.max_attempts:
+                        raise
+                    self.bridge.log.warning(f"Transfer of {url} failed (attempt {attempt}): {e}")
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    async def build_content(self, attachment: dict) -> MediaMessageEventContent:
+        media = await self.transfer(attachment)
+        msgtype = msgtype_for(media['mime_type'])
+        info = media['info'] or {"mimetype": media['mime_type'], "size": media['size']}
+        info_type = ImageInfo if msgtype == MessageType.IMAGE else FileInfo
+        return MediaMessageEventContent(
+            msgtype=msgtype,
+            body=self.filename_for(attachment),
+            url=media['mxc'],
+            info=info_type.deserialize(info),
+        )
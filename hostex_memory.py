@@ -0,0 +1,121 @@
+import logging
+import os
+import sys
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+def deep_size(obj, seen: set = None) -> int:
+    # Approximate retained size: the object plus everything reachable through containers, counted once
+    if seen is None:
+        seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return total
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # Peak rather than current outside Linux; ru_maxrss is KiB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+# Reports the approximate size of the bridge's long-lived in-memory structures and wraps
+# tracemalloc so the admin room can take a snapshot and later diff against it.
+class HostexMemoryInspector:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.frames = bridge.config.get("bridge.memory.tracemalloc_frames", 1)
+        self.snapshot = None
+
+    def structures(self) -> dict:
+        # name -> (value, entry count). Objects are not followed, only containers, so locks and
+        # intents count as their own size.
+        bridge = self.bridge
+        locks = [poller.conversation_locks for poller in bridge.pollers.values()]
+        queued = [list(queue._queue) for queue in bridge.outbox.queues] + [list(held) for held in bridge.outbox.held.values()]
+        sending = [list(queue._queue) for queue in bridge.send_queue.queues] + [list(held) for held in bridge.send_queue.held.values()]
+        return {
+            "conversation_rooms": (bridge.conversation_rooms, len(bridge.conversation_rooms)),
+            "all_conversations": (bridge.all_conversations, len(bridge.all_conversations)),
+            "matrix_sent_messages": (bridge.message_handler.matrix_sent_messages,
+                                     sum(len(messages) for messages in bridge.message_handler.matrix_sent_messages.values())),
+            "processed_events": (bridge.message_handler.processed_events, len(bridge.message_handler.processed_events)),
+            "status snapshot": (bridge.status.conversations, len(bridge.status.conversations)),
+            "conversation details": (bridge.details.entries, len(bridge.details.entries)),
+            "latency samples": (bridge.latency.conversations, len(bridge.latency.conversations)),
+            "expiry heap": (bridge.expiry.heap, len(bridge.expiry.heap)),
+            "room memberships": ((bridge.room_manager.puppet_rooms, bridge.room_manager.user_memberships),
+                                 len(bridge.room_manager.user_memberships)),
+            "ghost profiles": (bridge.ghosts.profiles, len(bridge.ghosts.profiles)),
+            "poller conversation locks": (locks, sum(len(part) for part in locks)),
+            "outbox queues": (queued, sum(len(part) for part in queued)),
+            "send queues": (sending, sum(len(part) for part in sending)),
+        }
+
+    def report(self) -> str:
+        lines = [f"Process RSS: {format_bytes(current_rss())}"]
+        sizes = []
+        for name, (value, count) in self.structures().items():
+            sizes.append((deep_size(value), name, count))
+        for size, name, count in sorted(sizes, reverse=True):
+            lines.append(f"{name}: {format_bytes(size)} ({count} entries)")
+        if tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            lines.append(f"tracemalloc: {format_bytes(traced)} traced, {format_bytes(peak)} peak")
+        return "\n".join(lines)
+
+    def take_snapshot(self, limit: int = 10) -> str:
+        if not tracemalloc.is_tracing():
+            # Only allocations made after this point are traced, so the first snapshot is the baseline
+            tracemalloc.start(self.frames)
+            self.snapshot = tracemalloc.take_snapshot()
+            return "Started tracemalloc and took a baseline snapshot. Run 'memory diff' later to see what grew."
+        self.snapshot = tracemalloc.take_snapshot()
+        stats = self.snapshot.statistics("lineno")[:limit]
+        return "\n".join([f"Top {len(stats)} allocation sites:"] + [self._format_stat(stat) for stat in stats])
+
+    def diff(self, limit: int = 10) -> str:
+        if not tracemalloc.is_tracing() or self.snapshot is None:
+            return "No snapshot yet. Run 'memory snapshot' first."
+        current = tracemalloc.take_snapshot()
+        stats = current.compare_to(self.snapshot, "lineno")[:limit]
+        lines = [f"Top {len(stats)} allocation changes since the last snapshot:"]
+        for stat in stats:
+            frame = stat.traceback[0]
+            lines.append(f"{frame.filename}:{frame.lineno}: {format_bytes(stat.size_diff)} "
+                         f"({stat.count_diff:+d} blocks, now {format_bytes(stat.size)})")
+        return "\n".join(lines)
+
+    def stop(self) -> str:
+        if not tracemalloc.is_tracing():
+            return "tracemalloc is not running."
+        tracemalloc.stop()
+        self.snapshot = None
+        return "Stopped tracemalloc."
+
+    @staticmethod
+    def _format_stat(stat) -> str:
+        frame = stat.traceback[0]
+        return f"{frame.filename}:{frame.lineno}: {format_bytes(stat.size)} ({stat.count} blocks)"
@@ -1,28 +1,32 @@
 from mautrix.types import MessageEvent, MessageType, RoomID, TextMessageEventContent, EventType
 from datetime import datetime, timezone
+import hashlib
 import logging
 import time
 import asyncio
 
+from hostex_media import attachments_of, MediaTooLarge
+
 logger = logging.getLogger(__name__)
 
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
 class HostexMessageHandler:
     def __init__(self, bridge):
         self.bridge = bridge
         self.processed_events = set()
         self.matrix_sent_messages = {}  # {room_id: {message_content: timestamp}}
-        self.message_expiry_time = 300  # 5 minutes
 
     async def handle_matrix_event(self, event):
-        self.bridge.log.debug(f"Received event: {event}")
+        self.bridge.log.debug("Received event: %s", event)
         
         if event.event_id in self.processed_events:
             self.bridge.log.debug(f"Skipping already processed event: {event.event_id}")
             return
         
         self.processed_events.add(event.event_id)
-        if len(self.processed_events) > 1000:
-            self.processed_events.pop()
+        self.trim_processed_events()
 
         if isinstance(event, MessageEvent) and event.content.msgtype == MessageType.TEXT:
             self.bridge.log.debug(f"Received text message in room {event.room_id} from {event.sender}: {event.content.body}")
@@ -31,27 +35,33 @@ class HostexMessageHandler:
                 self.bridge.log.debug(f"Handling admin command: {event.content.body}")
                 await self.bridge.commands.handle_admin_command(event.room_id, event.content.body)
             elif event.sender != self.bridge.puppet_mxid:
+                if self.bridge.commands.is_conversation_command(event.content.body):
+                    await self.bridge.commands.handle_conversation_command(event.room_id, event.content.body)
+                    return
                 # Handle messages from any user in the room except our puppet
-                await self.send_hostex_message(event.room_id, event.content.body, event.sender)
+                await self.send_hostex_message(event.room_id, event.event_id, event.content.body, event.sender, event.timestamp / 1000)
         else:
             self.bridge.log.debug(f"Received non-text event: {event}")
 
-    async def process_hostex_message(self, conversation_id: str, message: dict):
+    # Returns False when the message could not be delivered yet and is worth retrying
+    async def process_hostex_message(self, conversation_id: str, message: dict, txn_id: str = None) -> bool:
         self.bridge.log.debug(f"Processing Hostex message: {message}")
         
         room_data = self.bridge.conversation_rooms.get(conversation_id)
         if not room_data:
-            self.bridge.log.error(f"No room found for conversation {conversation_id}")
-            return
+            # The room may not be created or loaded yet; the outbox retries once it exists
+            self.bridge.log.warning(f"No room found for conversation {conversation_id}, will retry")
+            return False
         room_id = room_data['room_id']
 
-        content = message.get('content', '')
+        content = message.get('content') or ''
         timestamp_str = message.get('created_at')
+        await self.save_history(conversation_id, message)
         
         # Check if this message was recently sent from Matrix
-        if room_id in self.matrix_sent_messages and content in self.matrix_sent_messages[room_id]:
+        if self.is_echo(room_id, content) or await self.is_shared_echo(room_id, content):
             self.bridge.log.debug(f"Skipping echo of message sent from Matrix: {content}")
-            return
+            return True
 
         message_content = TextMessageEventContent(
             msgtype=MessageType.TEXT,
@@ -69,39 +79,104 @@ class HostexMessageHandler:
                 await self.bridge.room_manager.ensure_puppet_in_room(room_id)
             except Exception as e:
                 self.bridge.log.error(f"Failed to ensure puppet in room {room_id}: {e}")
-                return
+                return False
 
-            event_id = await self.bridge.puppet_intent.send_message(room_id, message_content, timestamp=timestamp_ms)
-            
-            self.bridge.log.info(f"Successfully sent message to room {room_id}. Event ID: {event_id}")
+            intent = self.bridge.puppet_intent
+            if self.bridge.ghosts.enabled and (message.get('sender_role') or 'guest') == 'guest':
+                intent = await self.bridge.ghosts.get_intent(conversation_id)
+                await intent.ensure_joined(room_id)
+
+            attachments = attachments_of(message)
+            if content or not attachments:
+                event_id = await intent.send_message(room_id, message_content, timestamp=timestamp_ms, txn_id=txn_id)
+                self.bridge.log.info(f"Successfully sent message to room {room_id}. Event ID: {event_id}")
+            for index, attachment in enumerate(attachments):
+                await self.send_attachment(intent, room_id, attachment, timestamp_ms, f"{txn_id}-media-{index}" if txn_id else None)
         
             self.bridge.conversation_rooms[conversation_id]['last_message'] = content
             self.bridge.conversation_rooms[conversation_id]['last_message_time'] = timestamp
+            self.bridge.expiry.touch(conversation_id, timestamp)
+            return True
         except Exception as e:
             self.bridge.log.error(f"Failed to process message for room {room_id}: {e}", exc_info=True)
+            # Our cached membership may be stale, re-check it on the next attempt
+            self.bridge.room_manager.puppet_rooms.discard(room_id)
+            return False
+
+    async def send_attachment(self, intent, room_id: RoomID, attachment: dict, timestamp_ms: int, txn_id: str = None):
+        try:
+            media_content = await self.bridge.media.build_content(attachment)
+        except MediaTooLarge as e:
+            self.bridge.log.warning(f"Not bridging attachment: {e}")
+            media_content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=f"Attachment too large to bridge: {attachment['url']}")
+        event_id = await intent.send_message(room_id, media_content, timestamp=timestamp_ms, txn_id=txn_id)
+        self.bridge.log.info(f"Sent attachment to room {room_id}. Event ID: {event_id}")
+
+    async def save_history(self, conversation_id: str, message: dict):
+        # Keeps the searchable message history; failures here must not block delivery
+        if not message.get('id') or not message.get('created_at'):
+            return
+        try:
+            await self.bridge.database.save_message(
+                conversation_id, message['id'], message.get('content') or '',
+                self.bridge.hostex_api.parse_timestamp(message['created_at']),
+                message.get('sender_role') or 'guest'
+            )
+        except Exception as e:
+            self.bridge.log.warning(f"Failed to save message {message['id']} to history: {e}")
 
-    async def send_hostex_message(self, room_id: RoomID, message: str, sender: str):
-        conversation_id = next((conv_id for conv_id, data in self.bridge.conversation_rooms.items() if data['room_id'] == room_id), None)
+    async def send_hostex_message(self, room_id: RoomID, event_id: str, message: str, sender: str, sent_at: float = None):
+        conversation_id = self.bridge.conversation_for_room(room_id)
+        if not conversation_id and self.bridge.shards.enabled:
+            # The room may have been created by another worker since we last loaded room states
+            await self.bridge.room_manager.load_room_states()
+            conversation_id = self.bridge.conversation_for_room(room_id)
         if conversation_id:
-            try:
-                self.bridge.log.debug(f"Attempting to send message to Hostex: {message}")
-                response = await self.bridge.hostex_api.send_message(conversation_id, message)
-                self.bridge.log.debug(f"Hostex API response: {response}")
-                
-                if response.get('error_code') == 200:
-                    self.bridge.log.info(f"Message sent successfully to Hostex: {message}")
-                    # Record this message as sent from Matrix
-                    if room_id not in self.matrix_sent_messages:
-                        self.matrix_sent_messages[room_id] = {}
-                    self.matrix_sent_messages[room_id][message] = time.time()
-                else:
-                    self.bridge.log.error(f"Failed to send message to Hostex. Error: {response.get('error_msg')}")
-            except Exception as e:
-                self.bridge.log.error(f"Exception when sending message to Hostex: {e}", exc_info=True)
+            # Persisted before we return so the websocket is never held up by Hostex; see HostexSendQueue
+            await self.bridge.send_queue.enqueue(conversation_id, room_id, event_id, message, sent_at)
         else:
             self.bridge.log.error(f"No conversation found for room {room_id}")
             await self.bridge.puppet_intent.send_notice(room_id, "This room is not associated with a Hostex conversation.")
 
+    @property
+    def message_expiry_time(self) -> int:
+        return self.bridge.performance.message_expiry_time
+
+    def trim_processed_events(self):
+        while len(self.processed_events) > self.bridge.performance.processed_events_limit:
+            self.processed_events.pop()
+
+    def is_echo(self, room_id: RoomID, content: str) -> bool:
+        return room_id in self.matrix_sent_messages and content in self.matrix_sent_messages[room_id]
+
+    async def is_shared_echo(self, room_id: RoomID, content: str) -> bool:
+        # With workers the leader sends to Hostex, but the echo arrives at the conversation's owner
+        if not self.bridge.shards.enabled:
+            return False
+        return await self.bridge.database.was_sent_since(room_id, content_hash(content), time.time() - self.message_expiry_time)
+
+    async def share_sent_message(self, room_id: RoomID, message: str):
+        if self.bridge.shards.enabled:
+            await self.bridge.database.record_sent_message(room_id, content_hash(message), time.time())
+
+    def record_sent_message(self, room_id: RoomID, message: str):
+        # Remembered so the copy Hostex hands back on the next poll is not echoed into the room
+        if room_id not in self.matrix_sent_messages:
+            self.matrix_sent_messages[room_id] = {}
+        self.matrix_sent_messages[room_id][message] = time.time()
+
+    def snapshot(self) -> dict:
+        return {
+            'processed_events': list(self.processed_events),
+            'matrix_sent_messages': self.matrix_sent_messages,
+        }
+
+    def restore(self, snapshot: dict):
+        self.processed_events.update(snapshot.get('processed_events', []))
+        for room_id, messages in snapshot.get('matrix_sent_messages', {}).items():
+            self.matrix_sent_messages.setdefault(room_id, {}).update(messages)
+        self.clean_old_messages()
+
     def clean_old_messages(self):
         current_time = time.time()
         for room_id in list(self.matrix_sent_messages.keys()):
@@ -114,6 +189,8 @@ class HostexMessageHandler:
                 del self.matrix_sent_messages[room_id]
 
     async def backfill_messages(self, conversation_id: str, room_id: RoomID):
-        messages = await self.bridge.hostex_api.get_conversation_messages(conversation_id, 5)
+        messages = await self.bridge.api_for(conversation_id).get_conversation_messages(conversation_id, self.bridge.performance.backfill_limit)
         for message in reversed(messages):
-            await self.process_hostex_message(conversation_id, message)
+            # Same transaction IDs as the outbox, so messages it is still retrying are not sent twice
+            txn_id = self.bridge.outbox.txn_id_for(conversation_id, message['id']) if message.get('id') else None
+            await self.process_hostex_message(conversation_id, message, txn_id=txn_id)
@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Fetched Hostex messages are persisted in the outbox table before anything is sent to Matrix.
+# Delivery workers drain it in the background; each conversation always maps to the same
+# worker so its messages stay in order. The bounded per-worker queues push back on the
+# fetcher when Matrix is slow, and the Matrix transaction ID is derived from the Hostex
+# message ID, so redelivering after a crash is deduplicated by the homeserver. A failed
+# delivery is held with the conversation's later messages queued behind it and retried with
+# capped backoff, so one stuck conversation neither reorders its messages nor blocks others.
+class HostexOutbox:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.worker_count = bridge.config.get("bridge.outbox.workers", 4)
+        self.queue_size = bridge.config.get("bridge.outbox.queue_size", 100)
+        self.max_attempts = bridge.config.get("bridge.outbox.max_attempts", 5)
+        self.retry_delay = bridge.config.get("bridge.outbox.retry_delay", 2)
+        self.max_retry_delay = bridge.config.get("bridge.outbox.max_retry_delay", 300)
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.worker_count)]
+        self.worker_tasks = []
+        # (conversation, message) keys of outbox rows already queued or held in this process
+        self.pending_ids = set()
+        # conversation -> entries held behind a failed delivery, the failed one first
+        self.held = {}
+        self.retry_tasks = {}
+
+    async def start(self):
+        if self.worker_tasks:
+            return
+        self.worker_tasks = [asyncio.create_task(self.delivery_worker(queue)) for queue in self.queues]
+        await self.load_pending()
+
+    async def load_pending(self):
+        # Called at startup and whenever ownership moves, so rows left behind by another worker
+        # are picked up; their messages are already marked processed and no poll fetches them again
+        pending = await self.bridge.database.get_pending_outbox_messages()
+        pending = [
+            entry for entry in pending
+            if self.bridge.shards.owns(entry['conversation_id'])
+            and (entry['conversation_id'], entry['message_id']) not in self.pending_ids
+        ]
+        if pending:
+            self.bridge.log.info(f"Resuming delivery of {len(pending)} pending outbox messages")
+        for entry in pending:
+            self.pending_ids.add((entry['conversation_id'], entry['message_id']))
+            self.bridge.status.record_queued(entry['conversation_id'])
+            await self._queue_for(entry['conversation_id']).put(entry)
+
+    async def stop(self):
+        # Held entries are still in the outbox table and resume on the next start
+        for task in self.worker_tasks + list(self.retry_tasks.values()):
+            task.cancel()
+        self.worker_tasks = []
+        self.retry_tasks = {}
+        self.held = {}
+        self.pending_ids = set()
+
+    async def drain(self, timeout: float) -> bool:
+        # Waits for queued deliveries; whatever misses the deadline stays in the outbox table for the next start
+        if not self.worker_tasks:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.bridge.log.warning(f"Outbox not drained before the deadline, {self.queue_depth()} messages resume on next start")
+            return False
+
+    @staticmethod
+    def txn_id_for(conversation_id: str, message_id: str) -> str:
+        return f"hostex-{conversation_id}-{message_id}"
+
+    def _queue_for(self, conversation_id: str) -> asyncio.Queue:
+        index = int.from_bytes(hashlib.md5(conversation_id.encode()).digest()[:4], "big") % len(self.queues)
+        return self.queues[index]
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues) + sum(len(held) for held in self.held.values())
+
+    # live is False for messages fetched while catching up, whose age says nothing about fetch latency
+    async def enqueue(self, conversation_id: str, message: dict, live: bool = True):
+        fetched_at = time.time()
+        created_at = message.get('created_at')
+        if created_at and live:
+            poller = self.bridge.poller_for(conversation_id)
+            created = self.bridge.api_for(conversation_id).parse_timestamp(created_at) + poller.time_offset
+            self.bridge.latency.record(conversation_id, "hostex_to_fetch", fetched_at - created.timestamp())
+        await self.bridge.database.enqueue_outbox_message(conversation_id, message['id'], message)
+        self.pending_ids.add((conversation_id, message['id']))
+        self.bridge.status.record_queued(conversation_id)
+        # Blocks when the delivery worker is behind, which slows down fetching
+        await self._queue_for(conversation_id).put({
+            'conversation_id': conversation_id,
+            'message_id': message['id'],
+            'payload': message,
+            'attempts': 0,
+            'fetched_at': fetched_at,
+        })
+
+    async def delivery_worker(self, queue: asyncio.Queue):
+        while True:
+            try:
+                entry = await queue.get()
+                try:
+                    if entry.get('retry'):
+                        await self.retry_held(entry['conversation_id'])
+                    else:
+                        await self.deliver(entry)
+                finally:
+                    queue.task_done()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error in outbox delivery worker: {e}", exc_info=True)
+
+    async def deliver(self, entry: dict):
+        conv_id = entry['conversation_id']
+        held = self.held.get(conv_id)
+        if held is not None:
+            # An earlier message of this conversation is waiting for a retry
+            held.append(entry)
+            return
+        if not await self.attempt(entry):
+            self.hold(conv_id, deque([entry]))
+
+    async def retry_held(self, conv_id: str):
+        self.retry_tasks.pop(conv_id, None)
+        held = self.held.pop(conv_id, None)
+        while held:
+            if not await self.attempt(held[0]):
+                self.hold(conv_id, held)
+                return
+            held.popleft()
+
+    def hold(self, conv_id: str, entries: deque):
+        self.held[conv_id] = entries
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (entries[0]['attempts'] - 1))
+        self.retry_tasks[conv_id] = asyncio.create_task(self._retry_later(conv_id, delay))
+
+    def wake(self, conv_id: str):
+        # Retry a held conversation now, e.g. once its room exists
+        task = self.retry_tasks.get(conv_id)
+        if task:
+            task.cancel()
+            self.retry_tasks[conv_id] = asyncio.create_task(self._retry_later(conv_id, 0))
+
+    async def _retry_later(self, conv_id: str, delay: float):
+        await asyncio.sleep(delay)
+        await self._queue_for(conv_id).put({'conversation_id': conv_id, 'retry': True})
+
+    async def attempt(self, entry: dict) -> bool:
+        conv_id = entry['conversation_id']
+        message_id = entry['message_id']
+        txn_id = self.txn_id_for(conv_id, message_id)
+        delivered = await self.bridge.message_handler.process_hostex_message(conv_id, entry['payload'], txn_id=txn_id)
+        if delivered:
+            await self.bridge.database.delete_outbox_message(conv_id, message_id)
+            self.pending_ids.discard((conv_id, message_id))
+            # Entries resumed from the database after a restart have no fetch time
+            if entry.get('fetched_at'):
+                self.bridge.latency.record(conv_id, "fetch_to_matrix", time.time() - entry['fetched_at'])
+            created_at = entry['payload'].get('created_at')
+            self.bridge.status.record_delivery(conv_id, self.bridge.hostex_api.parse_timestamp(created_at) if created_at else None)
+            return True
+        entry['attempts'] += 1
+        await self.bridge.database.record_outbox_failure(conv_id, message_id, "Matrix send failed")
+        self.bridge.status.record_error(conv_id, f"Matrix send failed for message {message_id} (attempt {entry['attempts']})")
+        if entry['attempts'] == self.max_attempts:
+            self.bridge.log.error(f"Message {message_id} for conversation {conv_id} still undelivered after "
+                                  f"{entry['attempts']} attempts, retrying every {self.max_retry_delay} seconds at most")
+        return False
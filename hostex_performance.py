@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+
+import yaml
+
+import hostex_json
+
+logger = logging.getLogger(__name__)
+
+OVERRIDES_SETTING = "performance_overrides"
+
+# name -> (type, default, minimum, maximum, description)
+SETTINGS = {
+    "poll_interval": (float, 10, 1, 3600, "seconds between Hostex polls, unless the account sets its own"),
+    "time_offset": (float, 8, -24, 24, "hours added to Hostex timestamps before comparing them with the last poll time"),
+    "message_expiry_time": (int, 300, 10, 86400, "seconds a message sent from Matrix is remembered for echo suppression"),
+    "processed_events_limit": (int, 1000, 100, 1000000, "Matrix event IDs remembered to skip redelivered events"),
+    "active_window_days": (float, 7, 1, 365, "days without messages before a conversation is considered inactive and its room is left"),
+    "conversation_page_size": (int, 20, 1, 100, "conversations fetched from Hostex per request"),
+    "message_page_size": (int, 20, 1, 100, "messages fetched per updated conversation"),
+    "backfill_limit": (int, 5, 1, 100, "messages backfilled into a newly created room"),
+    "reload_interval": (float, 5, 1, 3600, "seconds between checks for config file and 'set' changes"),
+}
+
+def convert(name: str, value):
+    if name not in SETTINGS:
+        raise ValueError(f"Unknown performance setting '{name}'. Known settings: {', '.join(SETTINGS)}")
+    kind, _, minimum, maximum, _ = SETTINGS[name]
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        converted = kind(value) if kind is float else int(str(value))
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be {'a number' if kind is float else 'a whole number'}, got {value!r}") from None
+    if not minimum <= converted <= maximum:
+        raise ValueError(f"{name} must be between {minimum} and {maximum}, got {converted}")
+    return converted
+
+def validate(section: dict) -> dict:
+    if not isinstance(section, dict):
+        raise ValueError("The performance section must be a mapping")
+    values = {}
+    errors = []
+    for name, value in section.items():
+        try:
+            values[name] = convert(name, value)
+        except ValueError as e:
+            errors.append(str(e))
+    if errors:
+        raise ValueError("; ".join(errors))
+    return values
+
+# Tunables from the `performance` config section. Values are layered: built-in defaults, then
+# the config file, then overrides from the admin `set` command, which are stored in the
+# settings table so they survive restarts and reach every worker. A background task re-reads
+# the config file when it changes and picks up overrides set elsewhere. Components read these
+# attributes at use time, so a new value applies from the next poll, message or lookup.
+class HostexPerformanceSettings:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.path = bridge.config.path
+        # Invalid values in the file stop the bridge at startup, but only log on a live reload
+        self.file_values = validate(bridge.config.get("performance", None) or {})
+        self.overrides = {}
+        self.overrides_raw = None
+        self.file_mtime = self._mtime()
+        self.values = {}
+        self.task = None
+        self.apply(notify=False)
+
+    async def start(self):
+        await self.refresh_overrides()
+        if not self.task:
+            self.task = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def apply(self, notify: bool = True):
+        values = {name: spec[1] for name, spec in SETTINGS.items()}
+        values.update(self.file_values)
+        values.update(self.overrides)
+        changed = {name for name, value in values.items() if self.values.get(name) != value}
+        self.values = values
+        for name, value in values.items():
+            setattr(self, name, value)
+        if notify and changed:
+            self.bridge.log.info("Performance settings changed: " + ", ".join(f"{name}={values[name]}" for name in sorted(changed)))
+            self.on_change(changed)
+
+    def on_change(self, changed: set):
+        if "poll_interval" in changed:
+            for poller in self.bridge.pollers.values():
+                poller.wake()
+        if "active_window_days" in changed:
+            self.bridge.expiry.reschedule()
+        if "processed_events_limit" in changed:
+            self.bridge.message_handler.trim_processed_events()
+
+    def reload_file(self) -> bool:
+        try:
+            with open(self.path) as file:
+                data = yaml.safe_load(file) or {}
+            file_values = validate(data.get("performance") or {})
+        except (OSError, yaml.YAMLError, ValueError) as e:
+            self.bridge.log.error(f"Not applying changed performance settings from {self.path}: {e}")
+            return False
+        for name in self.overrides:
+            if file_values.get(name) != self.file_values.get(name):
+                self.bridge.log.warning(f"performance.{name} changed in the config file but is overridden by 'set'; "
+                                        f"run 'set {name} default' to use the file value")
+        self.file_values = file_values
+        self.apply()
+        return True
+
+    async def refresh_overrides(self):
+        raw = await self.bridge.database.get_setting(OVERRIDES_SETTING, "{}")
+        if raw == self.overrides_raw:
+            return
+        self.overrides_raw = raw
+        overrides = {}
+        try:
+            stored = hostex_json.loads(raw)
+        except hostex_json.DecodeError:
+            self.bridge.log.error("Ignoring unreadable performance overrides in the settings table")
+            stored = {}
+        for name, value in stored.items():
+            try:
+                overrides[name] = convert(name, value)
+            except ValueError as e:
+                self.bridge.log.warning(f"Ignoring stored performance override: {e}")
+        self.overrides = overrides
+        self.apply()
+
+    async def set(self, name: str, value: str) -> str:
+        if value == "default":
+            if name not in SETTINGS:
+                raise ValueError(f"Unknown performance setting '{name}'. Known settings: {', '.join(SETTINGS)}")
+            self.overrides.pop(name, None)
+        else:
+            self.overrides[name] = convert(name, value)
+        self.overrides_raw = hostex_json.dumps(self.overrides)
+        await self.bridge.database.set_setting(OVERRIDES_SETTING, self.overrides_raw)
+        self.apply()
+        source = "set at runtime" if name in self.overrides else ("config file" if name in self.file_values else "default")
+        return f"{name} = {self.values[name]} ({source})"
+
+    async def watch(self):
+        while True:
+            try:
+                await asyncio.sleep(self.reload_interval)
+                mtime = self._mtime()
+                if mtime != self.file_mtime:
+                    self.file_mtime = mtime
+                    self.reload_file()
+                await self.refresh_overrides()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error checking for performance setting changes: {e}", exc_info=True)
+
+    def summary(self) -> str:
+        parts = [f"{name}={value}{'*' if name in self.overrides else ''}" for name, value in self.values.items()]
+        return "Performance: " + ", ".join(parts) + (" (* = set at runtime)" if self.overrides else "")
+
+    def describe(self) -> str:
+        lines = ["Performance settings (set <name> <value|default>):"]
+        for name, (_, default, minimum, maximum, description) in SETTINGS.items():
+            source = "set at runtime" if name in self.overrides else ("config file" if name in self.file_values else "default")
+            lines.append(f"{name} = {self.values[name]} ({source}; {minimum}-{maximum}, default {default}) - {description}")
+        return "\n".join(lines)
@@ -1,36 +1,96 @@
 import asyncio
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)
 
 class HostexPoller:
-    def __init__(self, bridge):
+    def __init__(self, bridge, api=None, poll_interval: float = None):
         self.bridge = bridge
-        self.poll_interval = 10  # Poll every 60 seconds
-        self.time_offset = timedelta(hours=8)  # API time is 8 hours behind local time
+        self.api = api or bridge.hostex_api
+        self.poll_interval = poll_interval  # Per-account override of performance.poll_interval
+        self.shard_generation = 0
+        # False until a poll completes after start or an ownership change; until then we are catching up
+        self.caught_up = False
+        # Set to cut the sleep between polls short, e.g. when the poll interval changes
+        self.wakeup = asyncio.Event()
+        # Serializes polling and webhook delivery for the same conversation
+        self.conversation_locks = defaultdict(asyncio.Lock)
+        self.task = None
 
     async def start_polling(self):
         self.bridge.log.debug("Starting Hostex polling")
-        asyncio.create_task(self.poll_hostex_messages())
+        if not self.task:
+            self.task = asyncio.create_task(self.poll_hostex_messages())
+
+    async def stop(self):
+        # Safe at any point: fetched messages are committed to the outbox together with their processed IDs
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    @property
+    def account_key(self) -> str:
+        # Key of this account in bridge.hostex_apis; the default account has no namespace
+        return self.api.account_id or "default"
+
+    @property
+    def interval(self) -> float:
+        return self.poll_interval or self.bridge.performance.poll_interval
+
+    @property
+    def time_offset(self) -> timedelta:
+        # API time is behind local time by this many hours
+        return timedelta(hours=self.bridge.performance.time_offset)
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def sleep(self, delay: float):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def poll_time_key(self):
+        # Poll times are tracked per account and per worker; None selects the legacy single row
+        shards = self.bridge.shards
+        parts = [self.api.account_id, shards.worker_id if shards.enabled else None]
+        return ":".join(part for part in parts if part) or None
 
     async def poll_hostex_messages(self):
         while True:
             try:
                 self.bridge.log.debug("Starting Hostex message poll")
                 
-                last_poll_time = await self.bridge.database.get_last_poll_time()
+                shards = self.bridge.shards
+                poll_time_key = self.poll_time_key()
+                last_poll_time = await self.bridge.database.get_last_poll_time(poll_time_key)
                 if last_poll_time.tzinfo is None:
                     last_poll_time = last_poll_time.replace(tzinfo=timezone.utc)
+                if shards.generation != self.shard_generation:
+                    # Ownership moved; look back far enough to cover a failed worker's unpolled window
+                    if last_poll_time > datetime.min.replace(tzinfo=timezone.utc) + timedelta(seconds=shards.lease_timeout):
+                        last_poll_time -= timedelta(seconds=shards.lease_timeout)
+                    self.shard_generation = shards.generation
+                    self.caught_up = False
+                    # Pick up the rooms and undelivered outbox rows of conversations we just inherited
+                    await self.bridge.room_manager.load_room_states()
+                    await self.bridge.outbox.load_pending()
                 self.bridge.log.debug(f"Last poll time: {last_poll_time}")
                 
-                conversations = await self.bridge.hostex_api.get_conversations()
+                conversations = await self.api.get_conversations(limit=self.bridge.performance.conversation_page_size)
                 self.bridge.log.debug(f"Retrieved {len(conversations.get('data', {}).get('conversations', []))} conversations")
+                self.bridge.status.update_conversations(conversations.get('data', {}).get('conversations', []))
                 
                 updated_conversations = []
                 for conv in conversations.get('data', {}).get('conversations', []):
                     conv_id = conv['id']
-                    conv_last_message_time = self.bridge.hostex_api.parse_timestamp(conv['last_message_at']) + self.time_offset
+                    if not shards.owns(conv_id):
+                        continue
+                    conv_last_message_time = self.api.parse_timestamp(conv['last_message_at']) + self.time_offset
                     self.bridge.log.debug(f"Conversation {conv_id} last message time: {conv_last_message_time}")
                     if conv_last_message_time > last_poll_time:
                         updated_conversations.append(conv)
@@ -44,30 +104,45 @@ class HostexPoller:
                     conv_id = conv['id']
                     self.bridge.log.debug(f"Processing conversation {conv_id}")
                     
-                    messages = await self.bridge.hostex_api.get_conversation_messages(conv_id)
+                    conversation = await self.api.get_conversation(conv_id, self.bridge.performance.message_page_size)
+                    messages = conversation.get('messages', [])
                     self.bridge.log.debug(f"Received {len(messages)} messages for conversation {conv_id}")
-                    
-                    processed_message_ids = await self.bridge.database.get_processed_message_ids(conv_id)
-                    
-                    new_messages = [msg for msg in messages if msg['id'] not in processed_message_ids]
-                    
-                    self.bridge.log.debug(f"Processing {len(new_messages)} new messages for conversation {conv_id}")
-                    for message in new_messages:
-                        message_time = self.bridge.hostex_api.parse_timestamp(message['created_at']) + self.time_offset
-                        self.bridge.log.debug(f"Message {message['id']} time: {message_time}, Last poll time: {last_poll_time}")
-                        if message_time > last_poll_time:
-                            self.bridge.log.debug(f"Processing message: {message}")
-                            await self.bridge.message_handler.process_hostex_message(conv_id, message)
-                            await self.bridge.database.add_processed_message_id(conv_id, message['id'])
-                        else:
-                            self.bridge.log.debug(f"Skipping old message: {message['id']}")
+                    await self.process_new_messages(conv_id, messages, last_poll_time, live=self.caught_up)
+                    # Details are a side effect of the fetch; a failure there must not hold up messages or the poll
+                    if conv_id in self.bridge.conversation_rooms:
+                        try:
+                            await self.bridge.details.observe(conv, conversation)
+                        except Exception as e:
+                            self.bridge.log.warning(f"Failed to update details for conversation {conv_id}: {e}")
 
                 current_time = datetime.now(timezone.utc)
                 self.bridge.log.debug(f"Setting last poll time to {current_time}")
-                await self.bridge.database.set_last_poll_time(current_time)
-                self.bridge.log.debug(f"Polling complete, sleeping for {self.poll_interval} seconds")
-                await asyncio.sleep(self.poll_interval)
+                await self.bridge.database.set_last_poll_time(current_time, poll_time_key)
+                self.bridge.last_poll_time = current_time
+                self.caught_up = True
+                poll_delay = self.bridge.webhook.next_poll_delay(self.account_key, self.interval)
+                self.bridge.log.debug(f"Polling complete, sleeping for {poll_delay} seconds")
+                await self.sleep(poll_delay)
+            except asyncio.CancelledError:
+                break
             except Exception as e:
                 self.bridge.log.error(f"Error polling Hostex messages: {e}", exc_info=True)
-                self.bridge.log.debug(f"Polling error, sleeping for {self.poll_interval} seconds")
-                await asyncio.sleep(self.poll_interval)
+                self.bridge.log.debug(f"Polling error, sleeping for {self.interval} seconds")
+                await self.sleep(self.interval)
+
+    async def process_new_messages(self, conv_id: str, messages: list, since: datetime = None, live: bool = True):
+        async with self.conversation_locks[conv_id]:
+            processed_message_ids = await self.bridge.database.get_processed_message_ids(conv_id)
+            
+            new_messages = [msg for msg in messages if msg['id'] not in processed_message_ids]
+            
+            self.bridge.log.debug(f"Processing {len(new_messages)} new messages for conversation {conv_id}")
+            for message in new_messages:
+                if since is not None:
+                    message_time = self.api.parse_timestamp(message['created_at']) + self.time_offset
+                    self.bridge.log.debug("Message %s time: %s, Last poll time: %s", message['id'], message_time, since)
+                    if message_time <= since:
+                        self.bridge.log.debug(f"Skipping old message: {message['id']}")
+                        continue
+                self.bridge.log.debug("Queueing message for delivery: %s", message)
+                await self.bridge.outbox.enqueue(conv_id, message, live)
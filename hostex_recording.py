@@ -0,0 +1,74 @@
+import logging
+import queue
+import threading
+import time
+
+import hostex_json
+
+logger = logging.getLogger(__name__)
+
+REDACTED = "<redacted>"
+SENSITIVE_KEYS = ("token", "secret", "authorization", "password", "api_key")
+
+def redact(value, secrets: tuple = ()):
+    # Replaces credential-looking fields and any known secret strings, recursively
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if any(word in str(key).lower() for word in SENSITIVE_KEYS) else redact(item, secrets)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item, secrets) for item in value]
+    if isinstance(value, str):
+        for secret in secrets:
+            if secret and secret in value:
+                value = value.replace(secret, REDACTED)
+    return value
+
+# Appends every Hostex API exchange to a JSONL file, one compact object per line:
+#   {"t": <unix time the request started>, "account": ..., "method": ..., "endpoint": ...,
+#    "params": ..., "data": ..., "status": ..., "elapsed": <seconds>, "body": <decoded response>}
+# Request headers are never written and known tokens are scrubbed from everything else.
+# Lines are written by a background thread, so recording never blocks the event loop on disk.
+# hostex_replay.py serves these files back to the bridge.
+class HostexRecorder:
+    def __init__(self, path: str, secrets: tuple = ()):
+        self.path = path
+        self.secrets = tuple(secret for secret in secrets if secret)
+        self.file = open(path, "a", buffering=1, encoding="utf-8")
+        # Lines waiting to be written; None tells the writer thread to finish
+        self.lines = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write_lines, name="hostex-recorder", daemon=True)
+        self.writer.start()
+        logger.info(f"Recording Hostex API traffic to {path}")
+
+    def record(self, account_id, method: str, endpoint: str, params, data, status: int, body: bytes, started_at: float):
+        try:
+            decoded = hostex_json.loads(body) if body else None
+        except hostex_json.DecodeError:
+            decoded = body.decode("utf-8", "replace")
+        entry = {
+            "t": round(started_at, 3),
+            "account": account_id,
+            "method": method,
+            "endpoint": endpoint,
+            "params": redact(params, self.secrets),
+            "data": redact(data, self.secrets),
+            "status": status,
+            "elapsed": round(time.time() - started_at, 3),
+            "body": redact(decoded, self.secrets),
+        }
+        self.lines.put(hostex_json.dumps(entry) + "\n")
+
+    def _write_lines(self):
+        while (line := self.lines.get()) is not None:
+            try:
+                self.file.write(line)
+            except Exception as e:
+                logger.warning(f"Failed to record Hostex API exchange: {e}")
+
+    def close(self):
+        # Writes out what is still queued before closing the file
+        self.lines.put(None)
+        self.writer.join()
+        self.file.close()
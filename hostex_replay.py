@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import bisect
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+import hostex_json
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Serves a capture written by HostexRecorder as a fake Hostex API. Point hostex.api_url at
+# http://<host>:<port> and the bridge sees the recorded responses on the recorded timeline:
+# a request at replay time T gets the latest response recorded for that endpoint at or before
+# capture time T * speed, after the recorded latency scaled down by the same factor. Requests
+# for endpoints that were never recorded get an empty successful response.
+class HostexReplayServer:
+    def __init__(self, entries: list, speed: float = 1.0, shift_timestamps: bool = False, latency: bool = True):
+        self.speed = speed
+        self.latency = latency
+        self.capture_start = min((entry['t'] for entry in entries), default=0)
+        self.started_at = None
+        self.shift_timestamps = shift_timestamps
+        # (method, endpoint) -> [(offset, entry)] sorted by offset
+        self.timeline = defaultdict(list)
+        for entry in sorted(entries, key=lambda entry: entry['t']):
+            self.timeline[(entry['method'], entry['endpoint'])].append((entry['t'] - self.capture_start, entry))
+        self.offsets = {key: [offset for offset, _ in items] for key, items in self.timeline.items()}
+        self.served = 0
+        self.missing = 0
+
+    @classmethod
+    def load(cls, path: str, account: str = None, **kwargs):
+        entries = []
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    entry = hostex_json.loads(line)
+                    if account is None or entry.get('account') == account:
+                        entries.append(entry)
+        logger.info(f"Loaded {len(entries)} recorded exchanges from {path}")
+        return cls(entries, **kwargs)
+
+    def virtual_offset(self) -> float:
+        return (time.time() - self.started_at) * self.speed
+
+    def pick(self, method: str, endpoint: str, params: dict):
+        key = (method, endpoint)
+        items = self.timeline.get(key)
+        if not items:
+            return None
+        index = max(0, bisect.bisect_right(self.offsets[key], self.virtual_offset()) - 1)
+        # Prefer a recording with the same query parameters close to the current point in time
+        for offset, entry in reversed(items[:index + 1]):
+            if self._same_params(entry.get('params'), params):
+                return entry
+        return items[index][1]
+
+    @staticmethod
+    def _same_params(recorded, params: dict) -> bool:
+        recorded = {key: str(value) for key, value in (recorded or {}).items()}
+        return recorded == dict(params)
+
+    def shift_for(self, entry: dict) -> float:
+        # Seconds to add to an entry's timestamps so that it looks as fresh as when it was recorded.
+        # The whole body moves by the same amount, which keeps any clock skew in the data intact.
+        return self.started_at + (entry['t'] - self.capture_start) / self.speed - entry['t']
+
+    def _shift(self, value, shift: float):
+        # Moves recorded *_at timestamps forward so the bridge treats replayed messages as new
+        if isinstance(value, dict):
+            return {
+                key: self._shift_timestamp(item, shift) if key.endswith("_at") and isinstance(item, str) else self._shift(item, shift)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self._shift(item, shift) for item in value]
+        return value
+
+    @staticmethod
+    def _shift_timestamp(value: str, shift: float) -> str:
+        try:
+            parsed = datetime.fromisoformat(value.rstrip('Z'))
+        except ValueError:
+            return value  # Odd formats are replayed untouched
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        shifted = datetime.fromtimestamp(parsed.timestamp() + shift, timezone.utc)
+        return shifted.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    async def handle(self, request: web.Request) -> web.Response:
+        endpoint = request.match_info['endpoint']
+        entry = self.pick(request.method, endpoint, request.query)
+        if entry is None:
+            self.missing += 1
+            logger.warning(f"No recording for {request.method} {endpoint}")
+            return web.json_response({"error_code": 200, "error_msg": "Done.", "data": {}})
+        if self.latency and entry.get('elapsed'):
+            await asyncio.sleep(entry['elapsed'] / self.speed)
+        self.served += 1
+        body = entry.get('body')
+        if self.shift_timestamps:
+            body = self._shift(body, self.shift_for(entry))
+        if isinstance(body, (dict, list)):
+            return web.Response(status=entry['status'], text=hostex_json.dumps(body), content_type="application/json")
+        return web.Response(status=entry['status'], text=body or "")
+
+    def start_clock(self):
+        self.started_at = time.time()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/{endpoint:.*}", self.handle)
+        return app
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Hostex API traffic")
+    parser.add_argument("capture", help="JSONL file written with hostex.record.path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--speed", type=float, default=1.0, help="Timeline speed-up factor (1 = original speed)")
+    parser.add_argument("--account", default=None, help="Only replay exchanges recorded for this account")
+    parser.add_argument("--shift-timestamps", action="store_true", help="Move recorded *_at timestamps to the present")
+    parser.add_argument("--no-latency", action="store_true", help="Answer immediately instead of replaying recorded latency")
+    args = parser.parse_args()
+
+    server = HostexReplayServer.load(args.capture, args.account, speed=args.speed,
+                                     shift_timestamps=args.shift_timestamps, latency=not args.no_latency)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    server.start_clock()
+    logger.info(f"Replaying on http://{args.host}:{args.port} at {args.speed}x")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logger.info(f"Served {server.served} recorded responses, {server.missing} requests had no recording")
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
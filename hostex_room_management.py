@@ -1,13 +1,23 @@
-from mautrix.types import RoomID, RoomCreatePreset, EventType
+from mautrix.types import RoomID, RoomCreatePreset, EventType, Membership
 from datetime import datetime, timezone, timedelta
+import asyncio
 import logging
 from mautrix.errors import MForbidden
 
+from hostex_ratelimit import RateLimiter
+
 logger = logging.getLogger(__name__)
 
 class HostexRoomManager:
     def __init__(self, bridge):
         self.bridge = bridge
+        # Rooms the puppet is known to be joined to, refreshed from joined_rooms during maintenance
+        self.puppet_rooms = set()
+        # Membership of the bridged user per room, learned from invites we send and member events;
+        # rooms missing here have not been seen since startup
+        self.user_memberships = {}
+        self.maintenance_concurrency = bridge.config.get("bridge.maintenance_concurrency", 5)
+        self.homeserver_limiter = RateLimiter(bridge.config.get("bridge.homeserver_rate_limit", 10))
 
     async def load_room_states(self):
         rows = await self.bridge.database.load_room_states()
@@ -18,8 +28,10 @@ class HostexRoomManager:
                 self.bridge.conversation_rooms[row['conversation_id']] = {
                     'room_id': RoomID(row['room_id']),
                     'last_message': row.get('last_message'),
-                    'last_message_time': row.get('last_message_time')
+                    'last_message_time': row.get('last_message_time'),
+                    'room_name': row.get('room_name')
                 }
+                self.bridge.expiry.touch(row['conversation_id'], row.get('last_message_time'))
 
     async def ensure_admin_room(self):
         if not self.bridge.admin_room_id:
@@ -38,31 +50,56 @@ class HostexRoomManager:
             await self.bridge.puppet_intent.send_text(self.bridge.admin_room_id, "Bridge is online, type 'help' for a list of commands.")
             
     async def load_conversations(self):
-        response = await self.bridge.hostex_api.get_conversations()
-        self.bridge.all_conversations = response.get('data', {}).get('conversations', [])
+        self.bridge.all_conversations = []
+        for api in self.bridge.hostex_apis.values():
+            response = await api.get_conversations(limit=self.bridge.performance.conversation_page_size)
+            self.bridge.all_conversations.extend(response.get('data', {}).get('conversations', []))
         self.bridge.all_conversations.sort(key=lambda x: x['last_message_at'])
+        self.bridge.status.update_conversations(self.bridge.all_conversations)
 
-        one_week_ago = datetime.now(timezone.utc) - timedelta(days=7)
+        window_start = datetime.now(timezone.utc) - timedelta(days=self.bridge.performance.active_window_days)
 
         for conv in self.bridge.all_conversations:
             conv_id = conv['id']
+            if not self.bridge.shards.owns(conv_id):
+                continue
             last_message_at = datetime.fromisoformat(conv['last_message_at'].rstrip('Z')).replace(tzinfo=timezone.utc)
 
-            if last_message_at > one_week_ago:
-                if conv_id not in self.bridge.conversation_rooms:
-                    room_id, created = await self.create_conversation_room(conv_id, conv['guest']['name'])
-                    if room_id:
-                        self.bridge.conversation_rooms[conv_id] = {
-                            'room_id': room_id,
-                            'last_message': None,
-                            'last_message_time': last_message_at
-                        }
-                        if created:
-                            await self.bridge.message_handler.backfill_messages(conv_id, room_id)
-            elif conv_id in self.bridge.conversation_rooms:
-                del self.bridge.conversation_rooms[conv_id]
-
-        await self.bridge.database.save_room_states(self.bridge.conversation_rooms)
+            room_data = self.bridge.conversation_rooms.get(conv_id)
+            if room_data:
+                # Rooms that aged out are left by the expiry scheduler
+                stored_time = room_data.get('last_message_time')
+                if not stored_time or last_message_at > stored_time:
+                    room_data['last_message_time'] = last_message_at
+                    self.bridge.expiry.touch(conv_id, last_message_at)
+            elif last_message_at > window_start:
+                await self.add_conversation_room(conv, last_message_at)
+
+        await self.bridge.database.save_room_states(self.bridge.shards.owned_rooms())
+        self.bridge.details.schedule_refresh(self.bridge.all_conversations)
+
+    def room_name_for(self, guest_name: str) -> str:
+        return f"{self.bridge.guest_prefix} {guest_name}"
+
+    async def add_conversation_room(self, conv: dict, last_message_at: datetime):
+        conv_id = conv['id']
+        guest_name = conv.get('guest', {}).get('name', 'Unknown')
+        room_id, created = await self.create_conversation_room(conv_id, guest_name)
+        if room_id:
+            self.bridge.conversation_rooms[conv_id] = {
+                'room_id': room_id,
+                'last_message': None,
+                'last_message_time': last_message_at,
+                'room_name': self.room_name_for(guest_name) if created else None
+            }
+            self.bridge.expiry.touch(conv_id, last_message_at)
+            await self.bridge.database.save_room_states({conv_id: self.bridge.conversation_rooms[conv_id]})
+            self.bridge.outbox.wake(conv_id)
+            if created:
+                self.bridge.details.forget(conv_id)
+                self.bridge.details.schedule_refresh([conv])
+                await self.bridge.message_handler.backfill_messages(conv_id, room_id)
+        return room_id
 
     async def create_conversation_room(self, conversation_id: str, guest_name: str):
         existing_room = self.bridge.conversation_rooms.get(conversation_id, {}).get('room_id')
@@ -70,7 +107,7 @@ class HostexRoomManager:
             self.bridge.log.debug(f"Room already exists for conversation {conversation_id}: {existing_room}")
             return existing_room, False
 
-        room_name = f"{self.bridge.guest_prefix} {guest_name}"
+        room_name = self.room_name_for(guest_name)
         try:
             self.bridge.log.debug(f"Creating room for conversation {conversation_id} with name {room_name}")
             room_id = await self.bridge.puppet_intent.create_room(
@@ -86,6 +123,7 @@ class HostexRoomManager:
             # Invite the user to the room
             try:
                 await self.bridge.puppet_intent.invite_user(room_id, self.bridge.user_id)
+                self.user_memberships[room_id] = Membership.INVITE
                 self.bridge.log.info(f"Invited user {self.bridge.user_id} to room {room_id}")
             except Exception as e:
                 self.bridge.log.error(f"Failed to invite user to room {room_id}: {str(e)}")
@@ -100,36 +138,93 @@ class HostexRoomManager:
         if room_data:
             room_id = room_data['room_id']
             try:
+                await self.homeserver_limiter.acquire()
                 await self.bridge.puppet_intent.set_room_name(room_id, new_name)
+                room_data['room_name'] = new_name
+                await self.bridge.database.save_room_name(conversation_id, new_name)
                 self.bridge.log.info(f"Updated name for room {room_id} to {new_name}")
+                return True
             except Exception as e:
                 self.bridge.log.error(f"Failed to update name for room {room_id}: {str(e)}", exc_info=True)
+        return False
+
+    async def update_room_names(self, progress_callback=None):
+        # Guest names come from the status snapshot, which the poller keeps up to date
+        guest_names = {conv_id: entry['name'] for conv_id, entry in self.bridge.status.conversations.items()}
+        targets = {}
+        for conv_id, room_data in self.bridge.shards.owned_rooms().items():
+            guest_name = guest_names.get(conv_id)
+            if guest_name is None:
+                continue
+            room_name = self.room_name_for(guest_name)
+            if room_data.get('room_name') != room_name:
+                targets[conv_id] = room_name
+
+        semaphore = asyncio.Semaphore(self.maintenance_concurrency)
+        done = 0
+        failed = 0
+        report_every = max(1, len(targets) // 10)
+
+        async def rename(conv_id, room_name):
+            nonlocal done, failed
+            async with semaphore:
+                if not await self.update_room_name(conv_id, room_name):
+                    failed += 1
+                done += 1
+                if progress_callback and done % report_every == 0 and done < len(targets):
+                    await progress_callback(done, len(targets), failed)
+
+        await asyncio.gather(*(rename(conv_id, room_name) for conv_id, room_name in targets.items()))
+        return len(targets), failed
 
     async def leave_old_rooms(self):
-        one_week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        for conv_id, room_data in list(self.bridge.conversation_rooms.items()):
-            last_message_time = room_data.get('last_message_time')
-            if last_message_time and last_message_time < one_week_ago:
+        # Normally rooms are left as they expire; this catches anything the scheduler missed
+        return await self.bridge.expiry.expire_due()
+
+    async def ensure_user_in_rooms(self):
+        owned_rooms = self.bridge.shards.owned_rooms()
+        self.puppet_rooms = set(await self.bridge.puppet_intent.get_joined_rooms())
+
+        # Only rooms that drifted from the expected state need homeserver calls. Memberships are
+        # only known from events seen by this process, so after a restart or on a non-leader an
+        # unknown membership in a room the puppet is joined to counts as fine; a leave or kick
+        # arrives as a member event and marks the room as drifted.
+        drifted = {
+            conv_id: room_data['room_id']
+            for conv_id, room_data in owned_rooms.items()
+            if room_data['room_id'] not in self.puppet_rooms
+            or self.user_memberships.get(room_data['room_id'], Membership.JOIN) not in (Membership.JOIN, Membership.INVITE)
+        }
+        self.bridge.log.info(f"Membership reconciliation: {len(drifted)} of {len(owned_rooms)} rooms need attention")
+
+        semaphore = asyncio.Semaphore(self.maintenance_concurrency)
+
+        async def reconcile(conv_id, room_id):
+            async with semaphore:
                 try:
-                    await self.bridge.puppet_intent.leave_room(room_data['room_id'])
-                    del self.bridge.conversation_rooms[conv_id]
-                    self.bridge.log.info(f"Left room {room_data['room_id']} for old conversation {conv_id}")
+                    await self.ensure_puppet_in_room(room_id)
+                    if self.user_memberships.get(room_id) in (Membership.JOIN, Membership.INVITE):
+                        return
+                    members = await self.bridge.puppet_intent.get_joined_members(room_id)
+                    if self.bridge.user_id in members:
+                        self.user_memberships[room_id] = Membership.JOIN
+                    else:
+                        await self.bridge.puppet_intent.invite_user(room_id, self.bridge.user_id)
+                        self.user_memberships[room_id] = Membership.INVITE
+                        self.bridge.log.info(f"Invited user to room {room_id} for conversation {conv_id}")
                 except Exception as e:
-                    self.bridge.log.error(f"Error leaving room {room_data['room_id']} for conversation {conv_id}: {str(e)}")
+                    self.bridge.log.error(f"Error ensuring user in room {room_id} for conversation {conv_id}: {str(e)}")
 
-        await self.bridge.database.save_room_states(self.bridge.conversation_rooms)
+        await asyncio.gather(*(reconcile(conv_id, room_id) for conv_id, room_id in drifted.items()))
 
-    async def ensure_user_in_rooms(self):
-        for conv_id, room_data in self.bridge.conversation_rooms.items():
-            room_id = room_data['room_id']
-            try:
-                await self.ensure_puppet_in_room(room_id)
-                members = await self.bridge.puppet_intent.get_joined_members(room_id)
-                if self.bridge.user_id not in members:
-                    await self.bridge.puppet_intent.invite_user(room_id, self.bridge.user_id)
-                    self.bridge.log.info(f"Invited user to room {room_id} for conversation {conv_id}")
-            except Exception as e:
-                self.bridge.log.error(f"Error ensuring user in room {room_id} for conversation {conv_id}: {str(e)}")
+    def handle_member_event(self, room_id: RoomID, user_id: str, membership: Membership):
+        if user_id == self.bridge.user_id:
+            self.user_memberships[room_id] = membership
+        elif user_id == self.bridge.puppet_mxid:
+            if membership == Membership.JOIN:
+                self.puppet_rooms.add(room_id)
+            else:
+                self.puppet_rooms.discard(room_id)
 
     async def check_and_fix_room_permissions(self, room_id: RoomID):
         try:
@@ -154,6 +249,8 @@ class HostexRoomManager:
 
     async def ensure_puppet_in_room(self, room_id: RoomID):
         try:
+            if room_id in self.puppet_rooms:
+                return
             self.bridge.log.debug(f"Attempting to ensure puppet {self.bridge.puppet_mxid} is in room {room_id}")
             
             # First, try to get joined members
@@ -161,6 +258,7 @@ class HostexRoomManager:
                 members = await self.bridge.puppet_intent.get_joined_members(room_id)
                 if self.bridge.puppet_mxid in members:
                     self.bridge.log.debug(f"Puppet {self.bridge.puppet_mxid} is already in room {room_id}")
+                    self.puppet_rooms.add(room_id)
                     return
             except MForbidden:
                 self.bridge.log.warning(f"Puppet {self.bridge.puppet_mxid} is not allowed to get members for room {room_id}")
@@ -174,6 +272,7 @@ class HostexRoomManager:
             try:
                 await self.bridge.puppet_intent.join_room(room_id)
                 self.bridge.log.info(f"Puppet {self.bridge.puppet_mxid} successfully joined room {room_id}")
+                self.puppet_rooms.add(room_id)
                 return
             except MForbidden:
                 self.bridge.log.warning(f"Puppet {self.bridge.puppet_mxid} is not allowed to join room {room_id}. Attempting to invite.")
@@ -188,6 +287,7 @@ class HostexRoomManager:
                 # Try joining again after invite
                 await self.bridge.puppet_intent.join_room(room_id)
                 self.bridge.log.info(f"Puppet {self.bridge.puppet_mxid} successfully joined room {room_id} after invite")
+                self.puppet_rooms.add(room_id)
             except Exception as e:
                 self.bridge.log.error(f"Failed to invite and join puppet to room {room_id}: {str(e)}")
                 raise
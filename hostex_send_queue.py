@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DELIVERED_REACTION = "✅"
+FAILED_REACTION = "❌"
+
+# Matrix messages for Hostex are written to the send_queue table and acknowledged to the
+# websocket right away; delivery workers send them in the background. As with the inbound
+# outbox, each conversation always maps to the same worker so replies keep their order.
+# Transient failures (network errors, 429, 5xx) hold the conversation: the failed message
+# and any later ones wait while the worker moves on, and the failed one is retried with
+# capped backoff. After max_attempts it is marked failed but still retried, and the failure
+# reaction is redacted if a later retry succeeds. Other errors are final. The Matrix event
+# gets a reaction once the outcome is known.
+class HostexSendQueue:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.worker_count = bridge.config.get("bridge.send_queue.workers", 2)
+        self.max_attempts = bridge.config.get("bridge.send_queue.max_attempts", 5)
+        self.retry_delay = bridge.config.get("bridge.send_queue.retry_delay", 2)
+        self.max_retry_delay = bridge.config.get("bridge.send_queue.max_retry_delay", 300)
+        self.react = bridge.config.get("bridge.send_queue.reactions", True)
+        # Unbounded: the websocket callback must never wait on a slow Hostex send
+        self.queues = [asyncio.Queue() for _ in range(self.worker_count)]
+        self.worker_tasks = []
+        # Event IDs queued, held or being sent, so a row is never queued twice
+        self.pending_ids = set()
+        # conversation -> entries held behind a failed send, the failed one first
+        self.held = {}
+        self.retry_tasks = {}
+
+    async def start(self):
+        if not self.worker_tasks:
+            self.worker_tasks = [asyncio.create_task(self.delivery_worker(queue)) for queue in self.queues]
+        await self.resume()
+
+    async def resume(self):
+        # Matrix events only arrive on the leader, so it sends whatever is left in the table,
+        # including rows a previous leader did not finish
+        if not self.bridge.shards.is_leader:
+            return
+        pending = [entry for entry in await self.bridge.database.get_pending_sends() if entry['event_id'] not in self.pending_ids]
+        if pending:
+            self.bridge.log.info(f"Resuming {len(pending)} pending sends to Hostex")
+        for entry in pending:
+            self.pending_ids.add(entry['event_id'])
+            self._queue_for(entry['conversation_id']).put_nowait(entry)
+
+    async def stop(self):
+        # Also used when leadership is lost: the rows stay in the table for the new leader, so
+        # nothing queued or held here may be sent any more
+        for task in self.worker_tasks + list(self.retry_tasks.values()):
+            task.cancel()
+        self.worker_tasks = []
+        self.retry_tasks = {}
+        self.held = {}
+        self.pending_ids = set()
+        for queue in self.queues:
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+
+    async def drain(self, timeout: float) -> bool:
+        if not self.worker_tasks:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.bridge.log.warning(f"{self.queue_depth()} sends to Hostex still queued at shutdown, they resume on next start")
+            return False
+
+    def _queue_for(self, conversation_id: str) -> asyncio.Queue:
+        index = int.from_bytes(hashlib.md5(conversation_id.encode()).digest()[:4], "big") % len(self.queues)
+        return self.queues[index]
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues) + sum(len(held) for held in self.held.values())
+
+    async def enqueue(self, conversation_id: str, room_id, event_id, body: str, sent_at: float = None):
+        if event_id in self.pending_ids:
+            return
+        self.pending_ids.add(event_id)
+        try:
+            await self.bridge.database.enqueue_send(event_id, conversation_id, room_id, body, sent_at)
+        except Exception:
+            self.pending_ids.discard(event_id)
+            raise
+        self._queue_for(conversation_id).put_nowait({
+            'event_id': event_id,
+            'conversation_id': conversation_id,
+            'room_id': room_id,
+            'body': body,
+            'sent_at': sent_at,
+            'attempts': 0,
+        })
+
+    async def delivery_worker(self, queue: asyncio.Queue):
+        while True:
+            try:
+                entry = await queue.get()
+                try:
+                    if entry.get('retry'):
+                        await self.retry_held(entry['conversation_id'])
+                    else:
+                        await self.deliver(entry)
+                finally:
+                    queue.task_done()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error in Hostex send worker: {e}", exc_info=True)
+
+    @staticmethod
+    def is_transient(response: dict) -> bool:
+        error_code = response.get('error_code')
+        return not isinstance(error_code, int) or error_code == 429 or error_code >= 500
+
+    async def deliver(self, entry: dict):
+        conv_id = entry['conversation_id']
+        held = self.held.get(conv_id)
+        if held is not None:
+            # An earlier message of this conversation is waiting for a retry
+            held.append(entry)
+            return
+        if not await self.attempt(entry):
+            self.hold(conv_id, deque([entry]))
+
+    async def retry_held(self, conv_id: str):
+        self.retry_tasks.pop(conv_id, None)
+        held = self.held.pop(conv_id, None)
+        while held:
+            if not await self.attempt(held[0]):
+                self.hold(conv_id, held)
+                return
+            held.popleft()
+
+    def hold(self, conv_id: str, entries: deque):
+        self.held[conv_id] = entries
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (entries[0]['attempts'] - 1))
+        self.retry_tasks[conv_id] = asyncio.create_task(self._retry_later(conv_id, delay))
+
+    async def _retry_later(self, conv_id: str, delay: float):
+        await asyncio.sleep(delay)
+        self._queue_for(conv_id).put_nowait({'conversation_id': conv_id, 'retry': True})
+
+    # Returns False when the send failed transiently and should be retried
+    async def attempt(self, entry: dict) -> bool:
+        conv_id = entry['conversation_id']
+        event_id = entry['event_id']
+        try:
+            # Shared before the send, since the owning worker may poll the echo before we hear back
+            await self.bridge.message_handler.share_sent_message(entry['room_id'], entry['body'])
+            response = await self.bridge.api_for(conv_id).send_message(conv_id, entry['body'])
+        except Exception as e:
+            response = {'error_code': 500, 'error_msg': str(e)}
+        if response.get('error_code') == 200:
+            # Before any await, so a poll cannot pick the message up in between
+            self.bridge.message_handler.record_sent_message(entry['room_id'], entry['body'])
+            await self.bridge.database.delete_send(event_id)
+            self.pending_ids.discard(event_id)
+            if entry.get('sent_at'):
+                self.bridge.latency.record(conv_id, "matrix_to_hostex", time.time() - entry['sent_at'])
+            self.bridge.log.info(f"Message {event_id} sent to Hostex conversation {conv_id}")
+            if entry.get('failed_reaction'):
+                await self.remove_reaction(entry, entry['failed_reaction'])
+            await self.set_reaction(entry, DELIVERED_REACTION)
+            return True
+
+        error = response.get('error_msg') or f"error code {response.get('error_code')}"
+        entry['attempts'] += 1
+        if not self.is_transient(response):
+            self.bridge.log.error(f"Hostex rejected message {event_id} for conversation {conv_id}: {error}")
+            await self.bridge.database.delete_send(event_id)
+            self.pending_ids.discard(event_id)
+            await self.set_reaction(entry, FAILED_REACTION)
+            await self.bridge.puppet_intent.send_notice(entry['room_id'], f"Failed to send message to Hostex: {error}")
+            return True
+        await self.bridge.database.record_send_failure(event_id, error)
+        self.bridge.status.record_error(conv_id, f"Hostex send failed for {event_id} (attempt {entry['attempts']}): {error}")
+        if entry['attempts'] == self.max_attempts:
+            # Keep trying, but let the host know it has not arrived yet
+            self.bridge.log.error(f"Message {event_id} for conversation {conv_id} still undelivered after {entry['attempts']} attempts")
+            reaction_id = await self.set_reaction(entry, FAILED_REACTION)
+            if reaction_id:
+                # Stored so whichever worker finally sends it can take the reaction back
+                entry['failed_reaction'] = reaction_id
+                await self.bridge.database.set_send_failed_reaction(event_id, reaction_id)
+        return False
+
+    async def set_reaction(self, entry: dict, key: str):
+        if not self.react:
+            return None
+        try:
+            return await self.bridge.puppet_intent.react(entry['room_id'], entry['event_id'], key)
+        except Exception as e:
+            self.bridge.log.warning(f"Failed to react to {entry['event_id']}: {e}")
+            return None
+
+    async def remove_reaction(self, entry: dict, reaction_id):
+        try:
+            await self.bridge.puppet_intent.redact(entry['room_id'], reaction_id)
+        except Exception as e:
+            self.bridge.log.warning(f"Failed to remove reaction {reaction_id} from {entry['event_id']}: {e}")
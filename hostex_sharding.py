@@ -0,0 +1,106 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import socket
+from datetime import datetime, timezone, timedelta
+
+logger = logging.getLogger(__name__)
+
+ADMIN_LEASE = "admin"
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+# Live workers (those with a recent heartbeat) are placed on a consistent hash ring and
+# each owns the conversations hashing to its segments. One worker also holds the admin
+# lease, which covers the admin room and the appservice websocket.
+class HostexShardManager:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.enabled = bool(bridge.config.get("bridge.workers.enabled", False))
+        self.worker_id = bridge.config.get("bridge.workers.worker_id", None) or f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat_interval = bridge.config.get("bridge.workers.heartbeat_interval", 10)
+        self.lease_timeout = bridge.config.get("bridge.workers.lease_timeout", 30)
+        self.virtual_nodes = bridge.config.get("bridge.workers.virtual_nodes", 64)
+        self.live_workers = [self.worker_id]
+        self.ring = []
+        self.ring_keys = []
+        self.is_leader = not self.enabled
+        # Bumped whenever ownership may have moved, so the poller can widen its catch-up window.
+        self.generation = 0
+        self.heartbeat_task = None
+        self._build_ring()
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self.bridge.log.info(f"Starting in worker mode as {self.worker_id}")
+        await self.heartbeat()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+
+    async def stop(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.enabled:
+            try:
+                await self.bridge.database.remove_worker(self.worker_id, ADMIN_LEASE)
+            except Exception as e:
+                self.bridge.log.error(f"Failed to deregister worker {self.worker_id}: {e}")
+
+    async def heartbeat_loop(self):
+        while True:
+            try:
+                await asyncio.sleep(self.heartbeat_interval)
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error in worker heartbeat: {e}", exc_info=True)
+
+    async def heartbeat(self):
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=self.lease_timeout)
+        await self.bridge.database.record_worker_heartbeat(self.worker_id, now)
+        live_workers = sorted(await self.bridge.database.get_live_workers(cutoff))
+        if self.worker_id not in live_workers:
+            live_workers = sorted(live_workers + [self.worker_id])
+        if live_workers != self.live_workers:
+            self.bridge.log.info(f"Worker set changed: {self.live_workers} -> {live_workers}")
+            self.live_workers = live_workers
+            self._build_ring()
+            self.generation += 1
+
+        holder = await self.bridge.database.acquire_lease(
+            ADMIN_LEASE, self.worker_id, now + timedelta(seconds=self.lease_timeout), now
+        )
+        was_leader = self.is_leader
+        self.is_leader = holder == self.worker_id
+        if self.is_leader != was_leader:
+            await self.bridge.on_leadership_change(self.is_leader)
+
+    def _build_ring(self):
+        self.ring = sorted(
+            (_hash(f"{worker}#{i}"), worker)
+            for worker in self.live_workers
+            for i in range(self.virtual_nodes)
+        )
+        self.ring_keys = [key for key, _ in self.ring]
+
+    def owner_of(self, conversation_id: str) -> str:
+        if not self.enabled:
+            return self.worker_id
+        index = bisect.bisect(self.ring_keys, _hash(conversation_id)) % len(self.ring)
+        return self.ring[index][1]
+
+    def owns(self, conversation_id: str) -> bool:
+        return not self.enabled or self.owner_of(conversation_id) == self.worker_id
+
+    def owned_rooms(self):
+        return {
+            conv_id: room_data
+            for conv_id, room_data in self.bridge.conversation_rooms.items()
+            if self.owns(conv_id)
+        }
@@ -0,0 +1,139 @@
+import html
+import logging
+from datetime import datetime, timezone, timedelta
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 25
+FILTERS = ("all", "active", "lagging")
+
+# In-memory view of every conversation the poller has seen, so the admin status command can
+# answer without calling the Hostex API. The poller refreshes conversation metadata, the
+# outbox reports deliveries, queue depth and errors.
+class HostexStatusSnapshot:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.conversations = {}
+        self.lag_threshold = timedelta(seconds=bridge.config.get("bridge.status.lag_threshold", 60))
+        self.updated_at = None
+
+    def _entry(self, conv_id: str) -> dict:
+        entry = self.conversations.get(conv_id)
+        if entry is None:
+            entry = self.conversations[conv_id] = {
+                'id': conv_id,
+                'name': 'Unknown',
+                'phone': '',
+                'last_message_at': None,
+                'last_delivered_at': None,
+                'queue_depth': 0,
+                'last_error': None,
+            }
+        return entry
+
+    def update_conversations(self, conversations: list):
+        for conv in conversations:
+            entry = self._entry(conv['id'])
+            guest = conv.get('guest') or {}
+            entry['name'] = guest.get('name', 'Unknown')
+            entry['phone'] = guest.get('phone', '')
+            if conv.get('last_message_at'):
+                entry['last_message_at'] = self.bridge.hostex_api.parse_timestamp(conv['last_message_at'])
+        self.updated_at = datetime.now(timezone.utc)
+
+    def record_queued(self, conv_id: str):
+        self._entry(conv_id)['queue_depth'] += 1
+
+    def record_delivery(self, conv_id: str, timestamp: datetime = None):
+        entry = self._entry(conv_id)
+        entry['queue_depth'] = max(0, entry['queue_depth'] - 1)
+        entry['last_error'] = None
+        if timestamp and (entry['last_delivered_at'] is None or timestamp > entry['last_delivered_at']):
+            entry['last_delivered_at'] = timestamp
+
+    def record_error(self, conv_id: str, error: str):
+        self._entry(conv_id)['last_error'] = error
+
+    def lag(self, entry: dict) -> timedelta:
+        if entry['last_message_at'] is None or entry['last_delivered_at'] is None:
+            return timedelta(0)
+        return max(timedelta(0), entry['last_message_at'] - entry['last_delivered_at'])
+
+    @property
+    def active_window(self) -> timedelta:
+        return timedelta(days=self.bridge.performance.active_window_days)
+
+    def is_active(self, entry: dict, now: datetime) -> bool:
+        return (
+            entry['id'] in self.bridge.conversation_rooms
+            and entry['last_message_at'] is not None
+            and entry['last_message_at'] >= now - self.active_window
+        )
+
+    def is_lagging(self, entry: dict) -> bool:
+        return entry['queue_depth'] > 0 or entry['last_error'] is not None or self.lag(entry) > self.lag_threshold
+
+    def select(self, status_filter: str = "all") -> list:
+        now = datetime.now(timezone.utc)
+        entries = list(self.conversations.values())
+        if status_filter == "active":
+            entries = [entry for entry in entries if self.is_active(entry, now)]
+        elif status_filter == "lagging":
+            entries = [entry for entry in entries if self.is_lagging(entry)]
+        min_time = datetime.min.replace(tzinfo=timezone.utc)
+        entries.sort(key=lambda entry: entry['last_message_at'] or min_time, reverse=True)
+        return entries
+
+    def render(self, status_filter: str = "all", page: int = 1):
+        entries = self.select(status_filter)
+        page_count = max(1, (len(entries) + PAGE_SIZE - 1) // PAGE_SIZE)
+        page = min(max(1, page), page_count)
+        page_entries = entries[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+
+        summary = (
+            f"Last poll time: {self.bridge.last_poll_time or 'Never'} | "
+            f"Conversations: {len(self.conversations)} | Bridged rooms: {len(self.bridge.conversation_rooms)} | "
+            f"Outbox queue: {self.bridge.outbox.queue_depth()} | Send queue: {self.bridge.send_queue.queue_depth()} | "
+            f"Filter: {status_filter} | Page {page}/{page_count} ({len(entries)} matching)"
+        )
+        if self.bridge.shards.is_leader:
+            summary += f" | {self.bridge.websocket.summary()}"
+        if self.bridge.loop_monitor.enabled:
+            summary += f" | {self.bridge.loop_monitor.summary()}"
+        headers = ["Name", "Last 4 of Phone", "Last Activity", "Lag", "Queue", "Last Error", "Room ID"]
+        rows = [self._row(entry) for entry in page_entries]
+
+        performance = self.bridge.performance.summary()
+        plain_lines = [summary, performance, ""] + [" | ".join(row) for row in rows]
+        html_rows = "".join(
+            "<tr>" + "".join(f"<td>{html.escape(cell)}</td>" for cell in row) + "</tr>"
+            for row in rows
+        )
+        html_body = (
+            f"<p>{html.escape(summary)}<br>{html.escape(performance)}</p>"
+            "<table><thead><tr>" + "".join(f"<th>{header}</th>" for header in headers) + "</tr></thead>"
+            f"<tbody>{html_rows}</tbody></table>"
+        )
+        if page < page_count:
+            hint = f"Type 'status {status_filter} {page + 1}' for the next page."
+            plain_lines.append(hint)
+            html_body += f"<p>{html.escape(hint)}</p>"
+        return "\n".join(plain_lines), html_body
+
+    def _row(self, entry: dict) -> list:
+        phone = entry['phone']
+        if isinstance(phone, str) and len(phone) > 4:
+            phone = f"...{phone[-4:]}"
+        else:
+            phone = "N/A"
+        last_activity = entry['last_message_at'].strftime('%Y-%m-%d %H:%M:%S') if entry['last_message_at'] else "Unknown"
+        room_id = self.bridge.conversation_rooms.get(entry['id'], {}).get('room_id', 'Not bridged')
+        return [
+            str(entry['name']),
+            phone,
+            last_activity,
+            f"{int(self.lag(entry).total_seconds())}s",
+            str(entry['queue_depth']),
+            entry['last_error'] or "",
+            str(room_id),
+        ]
@@ -0,0 +1,190 @@
+import asyncio
+import hmac
+import logging
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+import hostex_json
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_EVENTS = ("message_created", "message.created", "new_message")
+CONVERSATION_EVENTS = ("conversation_created", "conversation.created", "conversation_updated", "conversation.updated")
+
+# Receives Hostex webhook calls on the appservice HTTP server and feeds them straight into
+# the message-processing path. While webhooks keep arriving the poller only runs a slow
+# reconciliation sweep; when they go quiet for too long the poller drops back to fast polling.
+# Tracked per account, since each Hostex account has its own webhook configuration. In worker
+# mode a webhook can land on any worker; events for conversations owned by another worker are
+# staged in the database, and each worker picks up the staged events it owns every few seconds.
+class HostexWebhookReceiver:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.enabled = bool(bridge.config.get("hostex.webhook.enabled", False))
+        self.secret = bridge.config.get("hostex.webhook.secret", None)
+        self.path = bridge.config.get("hostex.webhook.path", "/_hostex/webhook")
+        self.reconcile_interval = bridge.config.get("hostex.webhook.reconcile_interval", 300)
+        self.silence_timeout = bridge.config.get("hostex.webhook.silence_timeout", 600)
+        self.forward_interval = bridge.config.get("hostex.webhook.forward_interval", 2)
+        self.queue = asyncio.Queue(maxsize=bridge.config.get("hostex.webhook.queue_size", 1000))
+        # account ID -> monotonic time of the last webhook, and the accounts currently demoted to sweeps
+        self.last_event_times = {}
+        self.healthy = set()
+        self.accepting = True
+        self.worker_task = None
+        self.forward_task = None
+
+        if self.enabled:
+            if not self.secret:
+                raise ValueError("hostex.webhook.secret is required when webhooks are enabled")
+            # Routes must be registered before the appservice runner is set up
+            bridge.appservice.app.router.add_post(self.path, self.handle_webhook)
+
+    async def start(self):
+        if self.enabled and not self.worker_task:
+            self.bridge.log.info(f"Listening for Hostex webhooks on {self.path}")
+            self.worker_task = asyncio.create_task(self.process_queue())
+        if self.enabled and self.bridge.shards.enabled and not self.forward_task:
+            self.forward_task = asyncio.create_task(self.process_staged())
+
+    async def drain(self, timeout: float):
+        # Stop accepting webhooks and finish the queued ones; the next reconciliation sweep covers the rest
+        self.accepting = False
+        if not self.worker_task or self.queue.empty():
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.bridge.log.warning(f"{self.queue.qsize()} Hostex webhooks left unprocessed at shutdown")
+
+    async def stop(self):
+        if self.worker_task:
+            self.worker_task.cancel()
+            self.worker_task = None
+        if self.forward_task:
+            self.forward_task.cancel()
+            self.forward_task = None
+
+    def _verify_secret(self, request: web.Request) -> bool:
+        provided = request.headers.get("X-Hostex-Webhook-Secret") or request.query.get("secret", "")
+        return hmac.compare_digest(provided.encode(), self.secret.encode())
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        if not self._verify_secret(request):
+            self.bridge.log.warning(f"Rejected Hostex webhook from {request.remote}: bad secret")
+            return web.json_response({"error": "forbidden"}, status=403)
+        if not self.accepting:
+            # Shutting down; Hostex retries and the next instance picks it up
+            return web.json_response({"error": "shutting down"}, status=503)
+        try:
+            payload = hostex_json.loads(await request.read())
+        except hostex_json.DecodeError:
+            return web.json_response({"error": "invalid JSON"}, status=400)
+        # With several Hostex accounts, each webhook URL carries ?account=<id>
+        account_id = request.query.get("account")
+        if account_id is None:
+            account_id = "default" if "default" in self.bridge.hostex_apis else next(iter(self.bridge.hostex_apis))
+        elif account_id not in self.bridge.hostex_apis:
+            return web.json_response({"error": "unknown account"}, status=404)
+
+        try:
+            self.queue.put_nowait((account_id, payload))
+        except asyncio.QueueFull:
+            # Let Hostex retry later; the reconciliation sweep covers anything it gives up on
+            self.bridge.log.warning("Hostex webhook queue is full, rejecting event")
+            return web.json_response({"error": "busy"}, status=503)
+
+        self.record_arrival(account_id)
+        return web.json_response({})
+
+    def record_arrival(self, account_id: str):
+        self.last_event_times[account_id] = time.monotonic()
+        if account_id not in self.healthy:
+            self.healthy.add(account_id)
+            self.bridge.log.info(f"Hostex webhooks are arriving for account {account_id}, polling demoted to reconciliation sweeps")
+
+    async def process_queue(self):
+        while True:
+            try:
+                account_id, payload = await self.queue.get()
+                try:
+                    await self.handle_event(account_id, payload)
+                finally:
+                    self.queue.task_done()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error processing Hostex webhook: {e}", exc_info=True)
+
+    async def process_staged(self):
+        while True:
+            try:
+                await asyncio.sleep(self.forward_interval)
+                staged = await self.bridge.database.get_staged_webhook_events()
+                handled = []
+                for event in staged:
+                    if not self.bridge.shards.owns(event['conversation_id']):
+                        continue
+                    try:
+                        await self.handle_event(event['account_id'], event['payload'])
+                        # Forwarded events mean webhooks work for this account, wherever they land
+                        self.record_arrival(event['account_id'])
+                    except Exception as e:
+                        # Dropped rather than retried forever; the reconciliation sweep covers it
+                        self.bridge.log.error(f"Error processing staged Hostex webhook {event['id']}: {e}", exc_info=True)
+                    handled.append(event['id'])
+                await self.bridge.database.delete_webhook_events(handled)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.bridge.log.error(f"Error checking for staged Hostex webhooks: {e}", exc_info=True)
+
+    async def handle_event(self, account_id: str, payload: dict):
+        api = self.bridge.hostex_apis[account_id]
+        poller = self.bridge.pollers[account_id]
+        event_type = payload.get("event") or payload.get("type")
+        data = payload.get("data", payload)
+        conversation = data.get("conversation") or {}
+        conv_id = data.get("conversation_id") or conversation.get("id")
+        if conv_id:
+            conv_id = api.conversation_key(conv_id)
+        self.bridge.log.debug(f"Hostex webhook {event_type} for conversation {conv_id}")
+        if not conv_id:
+            self.bridge.log.warning(f"Ignoring Hostex webhook without conversation ID: {event_type}")
+            return
+        if not self.bridge.shards.owns(conv_id):
+            # The owner handles it from the staged events within forward_interval
+            await self.bridge.database.stage_webhook_event(account_id, conv_id, payload)
+            return
+
+        if conv_id not in self.bridge.conversation_rooms and conversation:
+            last_message_at = datetime.now(timezone.utc)
+            if conversation.get("last_message_at"):
+                last_message_at = api.parse_timestamp(conversation["last_message_at"])
+            await self.bridge.room_manager.add_conversation_room({**conversation, "id": conv_id}, last_message_at)
+
+        if event_type in MESSAGE_EVENTS and data.get("message"):
+            await poller.process_new_messages(conv_id, [data["message"]])
+        elif event_type in MESSAGE_EVENTS or event_type in CONVERSATION_EVENTS:
+            # Only bridge what arrived since the last sweep, like the poller does
+            since = await self.bridge.database.get_last_poll_time(poller.poll_time_key())
+            messages = await api.get_conversation_messages(conv_id, self.bridge.performance.message_page_size)
+            await poller.process_new_messages(conv_id, messages, since)
+        else:
+            self.bridge.log.debug(f"Unhandled Hostex webhook event: {event_type}")
+
+    def next_poll_delay(self, account_id: str, poll_interval: float) -> float:
+        last_event_time = self.last_event_times.get(account_id)
+        if not self.enabled or last_event_time is None:
+            return poll_interval
+        silent_for = time.monotonic() - last_event_time
+        if silent_for >= self.silence_timeout:
+            if account_id in self.healthy:
+                self.healthy.discard(account_id)
+                self.bridge.log.warning(f"No Hostex webhooks for account {account_id} for {int(silent_for)} seconds, "
+                                        "falling back to fast polling")
+            return poll_interval
+        # Wake up when the silence timeout would expire so the fallback kicks in on time
+        return max(poll_interval, min(self.reconcile_interval, self.silence_timeout - silent_for))